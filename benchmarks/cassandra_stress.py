@@ -0,0 +1,120 @@
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Validate the Cassandra tuning profiles.
+
+Usage: cassandra_stress.py profiles [MEM_MB CORES NODES CONTAINERS_PER_HOST]
+       cassandra_stress.py run NODE[,NODE...] [OPS] [THREADS]
+
+'profiles' prints the settings that each profile generates for a host
+with the given resources (the default is a 16GB, 8 core host running a
+single container of a 3 node cluster).
+
+'run' drives a running cluster with cassandra-stress (a write, a read,
+and a mixed 1:3 write/read phase) and prints the throughput and latency
+of each phase. Start the cluster once per profile (set 'profile' in the
+args of the storage backend) and compare the results. The stress tool
+is taken from CASSANDRA_STRESS, or the PATH.
+"""
+
+import os
+import sys
+import time
+from subprocess import Popen, PIPE
+from ferry.config.cassandra.profile import CassandraProfile, PROFILES
+
+PHASES = [ ('write', 'write'),
+           ('read', 'read'),
+           ('mixed', 'mixed ratio(write=1,read=3)') ]
+
+# Summary lines of cassandra-stress that we report.
+METRICS = [ 'op rate',
+            'latency mean',
+            'latency 95th percentile',
+            'latency 99th percentile' ]
+
+class _FixedSystem(object):
+    def __init__(self, mem, cores):
+        self.mem = mem
+        self.cores = cores
+
+    def get_total_memory(self):
+        return self.mem
+
+    def get_num_cores(self):
+        return self.cores
+
+def show_profiles(args):
+    mem, cores, nodes, colocated = 16384, 8, 3, 1
+    if len(args) == 4:
+        mem, cores, nodes, colocated = [int(a) for a in args]
+
+    system = _FixedSystem(mem, cores)
+    profiles = []
+    for name in PROFILES:
+        p = CassandraProfile.from_system(system, colocated, nodes, { 'profile' : name })
+        profiles.append(p.json())
+
+    keys = sorted(k for k in profiles[0].keys() if k != 'profile')
+    print "%-22s" % "" + "".join(["%-13s" % n for n in PROFILES])
+    for k in keys:
+        print "%-22s" % k + "".join(["%-13s" % str(j[k]) for j in profiles])
+
+def _parse(output):
+    results = {}
+    for line in output.split("\n"):
+        s = line.split(":", 1)
+        if len(s) == 2 and s[0].strip() in METRICS:
+            results[s[0].strip()] = s[1].strip()
+    return results
+
+def run_stress(args):
+    nodes = args[0]
+    ops = 100000
+    threads = 50
+    if len(args) > 1:
+        ops = int(args[1])
+    if len(args) > 2:
+        threads = int(args[2])
+
+    stress = os.environ.get('CASSANDRA_STRESS', 'cassandra-stress')
+    print "%-7s %-10s" % ("phase", "time") + "".join(["%-26s" % m for m in METRICS])
+    for name, cmd in PHASES:
+        cmd = "%s %s n=%d -rate threads=%d -node %s" % (stress, cmd, ops, threads, nodes)
+        start = time.time()
+        proc = Popen(cmd.split(), stdout=PIPE, stderr=PIPE)
+        output, err = proc.communicate()
+        elapsed = time.time() - start
+        if proc.returncode != 0:
+            print "%s failed: %s" % (name, err.strip())
+            return 1
+
+        results = _parse(output)
+        print "%-7s %-10s" % (name, "%.1fs" % elapsed) + "".join(["%-26s" % results.get(m, '-') for m in METRICS])
+    return 0
+
+def main(args):
+    if len(args) > 0 and args[0] == 'profiles':
+        show_profiles(args[1:])
+    elif len(args) > 1 and args[0] == 'run':
+        return run_stress(args[1:])
+    else:
+        print __doc__
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
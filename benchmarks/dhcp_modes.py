@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Compare the per-allocation latency of the HTTP DHCP service against
+the in-process network allocator. 
+
+Usage: MONGODB=<mongo ip> dhcp_modes.py [-n ALLOCATIONS] [http] [local]
+
+The HTTP mode expects the DHCP service to be running (started by
+'ferry server'), and both modes modify the network state stored in
+Mongo, so run this against a test controller. 
+"""
+
+import sys
+import time
+from ferry.ip.client import DHCPClient, MODE_HTTP, MODE_LOCAL
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+def _report(name, latencies):
+    print "%-12s n=%-5d mean=%.3fms p50=%.3fms p95=%.3fms" % (name,
+                                                              len(latencies),
+                                                              1000 * sum(latencies) / len(latencies),
+                                                              1000 * _percentile(latencies, 0.5),
+                                                              1000 * _percentile(latencies, 0.95))
+
+def _run(client, num):
+    alloc = []
+    free = []
+    for i in range(num):
+        start = time.time()
+        ip = client.assign_ip({})
+        alloc.append(time.time() - start)
+
+        start = time.time()
+        client.free_ip(ip)
+        free.append(time.time() - start)
+    return alloc, free
+
+def main(args):
+    num = 500
+    if '-n' in args:
+        i = args.index('-n')
+        num = int(args[i + 1])
+        args = args[:i] + args[i + 2:]
+    modes = args
+    if len(modes) == 0:
+        modes = [MODE_HTTP, MODE_LOCAL]
+
+    for mode in modes:
+        alloc, free = _run(DHCPClient(mode=mode), num)
+        _report(mode + ' alloc', alloc)
+        _report(mode + ' free', free)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Measure how long it takes to generate the configuration files for
+a Hadoop service. The service has NODES compute/storage nodes
+plus the YARN and HDFS masters. 
+
+Usage: hadoop_templates.py [NODES]
+
+The default is 200 nodes. The system information is fixed so that
+only the configuration generation is measured. The files are rendered
+into in-memory bundles, just like when a real stack is started. 
+"""
+
+import sys
+import time
+from ferry.install import DEFAULT_TEMPLATE_DIR
+from ferry.config.hadoop.hadoopconfig import HadoopInitializer
+
+class _FixedSystem(object):
+    def get_total_memory(self):
+        return 16384
+
+    def get_free_memory(self):
+        return 8192
+
+    def get_num_cores(self):
+        return 8
+
+def _containers(num):
+    containers = []
+    for i in range(num):
+        containers.append( { 'container' : 'bench%d' % i,
+                             'data_ip' : '10.1.%d.%d' % (i / 250, i % 250 + 2),
+                             'host_name' : 'hadoop%d' % i,
+                             'type' : 'hadoop' } )
+    return containers
+
+def main(args):
+    nodes = 200
+    if len(args) > 0:
+        nodes = int(args[0])
+
+    hadoop = HadoopInitializer(_FixedSystem())
+    hadoop.template_dir = DEFAULT_TEMPLATE_DIR + '/hadoop/'
+    containers = _containers(nodes + 2)
+
+    # The first run also loads and compiles the templates. 
+    for run in ['cold', 'warm']:
+        config = hadoop.generate(nodes + 2)
+        config.uuid = 'bench-' + run
+        start = time.time()
+        config_dirs, entry_point = hadoop.apply(config, containers)
+        elapsed = time.time() - start
+        print "%-5s containers=%-4d total=%.3fs per-container=%.2fms" % (run,
+                                                                          len(containers),
+                                                                          elapsed,
+                                                                          1000 * elapsed / len(containers))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Measure how long it takes to allocate and free every address
+in a CIDR block. 
+
+Usage: ip_pool.py [CIDR]
+
+The default block is a full /16 (10.1.0.1/16). 
+"""
+
+import sys
+import time
+from ferry.ip.pool import IPPool
+
+def _report(name, num, elapsed):
+    print "%-8s n=%-6d total=%.3fs per-op=%.2fus" % (name,
+                                                     num,
+                                                     elapsed,
+                                                     1000000 * elapsed / max(num, 1))
+
+def main(args):
+    cidr = '10.1.0.1/16'
+    if len(args) > 0:
+        cidr = args[0]
+
+    start = time.time()
+    pool = IPPool(cidr)
+    _report('init', 1, time.time() - start)
+
+    start = time.time()
+    ips = []
+    while True:
+        ip = pool.alloc()
+        if not ip:
+            break
+        ips.append(ip)
+    _report('alloc', len(ips), time.time() - start)
+
+    start = time.time()
+    for ip in ips:
+        pool.free(ip)
+    _report('free', len(ips), time.time() - start)
+
+    start = time.time()
+    for ip in ips:
+        pool.alloc()
+    _report('realloc', len(ips), time.time() - start)
+
+    start = time.time()
+    pool = IPPool(cidr)
+    pool.rebuild(ips[::2], ips)
+    _report('rebuild', len(ips), time.time() - start)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
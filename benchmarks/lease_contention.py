@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Allocate IP addresses from several processes at once, and check that
+no address was handed out twice. Each process manages the network
+itself, just like several API workers in local network mode. 
+
+Usage: MONGODB=<mongo ip> lease_contention.py [-p PROCESSES] [-n ALLOCATIONS]
+
+The addresses are freed afterwards, but this modifies the network
+state stored in Mongo, so run this against a test controller. 
+"""
+
+import multiprocessing
+import sys
+import time
+from ferry.ip.dhcp import DHCP
+
+def _allocate(num):
+    dhcp = DHCP(cache=False)
+    ips = []
+    start = time.time()
+    for i in range(num):
+        ips.append(dhcp.assign_ip({}))
+    return ips, time.time() - start
+
+def _arg(args, flag, default):
+    if flag in args:
+        return int(args[args.index(flag) + 1])
+    return default
+
+def main(args):
+    procs = _arg(args, '-p', 4)
+    num = _arg(args, '-n', 200)
+
+    pool = multiprocessing.Pool(procs)
+    results = pool.map(_allocate, [num] * procs)
+    pool.close()
+
+    ips = [ip for r in results for ip in r[0] if ip]
+    elapsed = max([r[1] for r in results])
+    print "processes=%d allocated=%d duplicates=%d rate=%.1f/s" % (procs,
+                                                                 len(ips),
+                                                                 len(ips) - len(set(ips)),
+                                                                 len(ips) / elapsed)
+    DHCP(cache=False).free_ips(list(set(ips)))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Measure per-command ssh latency against a running stack, with and
+without pooled (multiplexed) ssh sessions. 
+
+Usage: ssh_sessions.py KEY USER IP [IP ...] [-n COMMANDS_PER_HOST]
+
+For example, to measure a 20-container stack, pass the 20 internal
+container IPs listed by 'ferry inspect'. 
+"""
+
+import sys
+import time
+from ferry.fabric.execute import execute
+from ferry.fabric.ssh import SSHSessionPool, SSH_OPTS
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+def _report(name, latencies):
+    print "%-8s n=%-5d mean=%.1fms p50=%.1fms p95=%.1fms" % (name,
+                                                             len(latencies),
+                                                             1000 * sum(latencies) / len(latencies),
+                                                             1000 * _percentile(latencies, 0.5),
+                                                             1000 * _percentile(latencies, 0.95))
+
+def _run(make_cmd, hosts, num):
+    latencies = []
+    for i in range(num):
+        for ip in hosts:
+            start = time.time()
+            execute(make_cmd(ip))
+            latencies.append(time.time() - start)
+    return latencies
+
+def main(args):
+    num = 5
+    if '-n' in args:
+        i = args.index('-n')
+        num = int(args[i + 1])
+        args = args[:i] + args[i + 2:]
+    key, user, hosts = args[0], args[1], args[2:]
+
+    plain = lambda ip: 'ssh %s -i %s %s@%s true' % (SSH_OPTS, key, user, ip)
+    _report('plain', _run(plain, hosts, num))
+
+    pool = SSHSessionPool(max_sessions=len(hosts))
+    pooled = lambda ip: 'ssh %s -i %s %s@%s true' % (pool.opts(key, ip, user), key, user, ip)
+    _report('pooled', _run(pooled, hosts, num))
+    pool.close_all()
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print __doc__
+        sys.exit(1)
+    main(sys.argv[1:])
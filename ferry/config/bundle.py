@@ -0,0 +1,112 @@
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import hashlib
+import os
+import tarfile
+import time
+from StringIO import StringIO
+from ferry.config.template import render_template
+
+class ConfigBundle(object):
+    """
+    The configuration files for a container. The files are kept in memory
+    and streamed to the container as a tar archive, so nothing is staged
+    under /tmp. Paths are relative to the directory that the bundle is
+    unpacked into. 
+
+    Bundles are identified by the hash of their contents, so containers
+    with identical configurations can share a single bundle. 
+    """
+    def __init__(self, name):
+        self.name = name
+        self.files = {}
+        self._digest = None
+        self._archives = {}
+
+    def add(self, path, content, mode=0644):
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        self.files[path] = (content, mode)
+        self._digest = None
+        self._archives = {}
+
+    def copy(self, name):
+        """
+        Start a new bundle with the same files (e.g., the files
+        that are common to all the containers). 
+        """
+        bundle = ConfigBundle(name)
+        bundle.files = dict(self.files)
+        return bundle
+
+    def digest(self):
+        """
+        Hash of the paths, modes, and contents of the files. 
+        """
+        if not self._digest:
+            h = hashlib.sha1()
+            for path in sorted(self.files.keys()):
+                content, mode = self.files[path]
+                h.update("%s\0%o\0%d\0" % (path, mode, len(content)))
+                h.update(content)
+            self._digest = h.hexdigest()
+        return self._digest
+
+    def render(self, template, path, changes=None, mode=0644):
+        """
+        Render the template into the bundle. 
+        """
+        self.add(path, render_template(template, changes), mode)
+
+    def archive(self, compress=False):
+        """
+        Pack the files into a (possibly gzipped) tar archive. The archive
+        is kept around, since a shared bundle is sent to many containers. 
+        """
+        if compress in self._archives:
+            return self._archives[compress]
+
+        buf = StringIO()
+        if compress:
+            tar = tarfile.open(fileobj=buf, mode='w:gz')
+        else:
+            tar = tarfile.open(fileobj=buf, mode='w')
+
+        now = time.time()
+        for path in sorted(self.files.keys()):
+            content, mode = self.files[path]
+            info = tarfile.TarInfo(path)
+            info.size = len(content)
+            info.mode = mode
+            info.mtime = now
+            tar.addfile(info, StringIO(content))
+        tar.close()
+        self._archives[compress] = buf.getvalue()
+        return self._archives[compress]
+
+    def dump(self, root):
+        """
+        Write the files to disk (for debugging) and return the directory. 
+        """
+        bundle_dir = os.path.join(root, self.name)
+        for path, (content, mode) in self.files.items():
+            file_path = os.path.join(bundle_dir, path)
+            if not os.path.isdir(os.path.dirname(file_path)):
+                os.makedirs(os.path.dirname(file_path))
+            with open(file_path, 'w') as f:
+                f.write(content)
+            os.chmod(file_path, mode)
+        return bundle_dir
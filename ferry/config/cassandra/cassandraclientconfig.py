@@ -14,8 +14,8 @@
 #
 
 import sys
-import sh
-from string import Template
+from ferry.config.bundle import ConfigBundle
+from ferry.config.cassandra.profile import CassandraProfile
 
 class CassandraClientInitializer(object):
     """
@@ -87,35 +87,33 @@ class CassandraClientInitializer(object):
     def generate(self, num):
         return CassandraClientConfig(num)
 
-    def _apply_cassandra(self, host_dir, entry_point, config, container):
-        yaml_in_file = open(self.template_dir + '/cassandra.yaml.template', 'r')
-        yaml_out_file = open(host_dir + '/cassandra.yaml', 'w+')
-
+    def _apply_cassandra(self, bundle, entry_point, storage_entry, config, container):
         # Now make the changes to the template file. 
         changes = { "LOCAL_ADDRESS":container['data_ip'], 
                     "DATA_DIR":config.data_directory,
                     "CACHE_DIR":config.cache_directory,
                     "COMMIT_DIR":config.commit_directory,
-                    "SEEDS":entry_point['cassandra_url']}
+                    "SEEDS":entry_point['cassandra_url'],
+                    "INITIAL_TOKEN":"",
+                    "SNITCH":"SimpleSnitch"}
 
-        for line in yaml_in_file:
-            s = Template(line).substitute(changes)
-            yaml_out_file.write(s)
+        # Use the same settings as the cluster. 
+        profile = CassandraProfile()
+        if 'profile' in storage_entry:
+            profile = CassandraProfile.from_json(storage_entry['profile'])
+        changes.update(profile.yaml_changes())
 
-        yaml_out_file.close()
-        yaml_in_file.close()
+        bundle.render(self.template_dir + '/cassandra.yaml.template',
+                      'cassandra.yaml',
+                      changes)
 
-    def _apply_titan(self, host_dir, storage_entry, container):
-        in_file = open(self.template_dir + '/titan.properties', 'r')
-        out_file = open(host_dir + '/titan.properties', 'w+')
+    def _apply_titan(self, bundle, storage_entry, container):
         changes = { "BACKEND":"cassandrathrift", 
                     "DB":container['args']['db'],
                     "IP":storage_entry['seed']}
-        for line in in_file:
-            s = Template(line).substitute(changes)
-            out_file.write(s)
-        out_file.close()
-        in_file.close()
+        bundle.render(self.template_dir + '/titan.properties',
+                      'titan.properties',
+                      changes)
 
     def _find_cassandra_storage(self, containers):
         """
@@ -143,31 +141,24 @@ class CassandraClientInitializer(object):
         # Otherwise record the storage type and get the seed node. 
         entry_point['cassandra_url'] = storage_entry['seed']
 
-        # Create a new configuration directory, and place
-        # into the template directory. 
+        # Create a new configuration bundle. 
         config_dirs = []
 
         try:
-            host_dir = "/tmp/" + self._generate_config_dir(config.uuid)
-            try:
-                sh.mkdir('-p', host_dir)
-            except:
-                sys.stderr.write('could not create config dir ' + host_dir)
+            bundle = ConfigBundle(self._generate_config_dir(config.uuid))
 
-            self._apply_cassandra(host_dir, entry_point, config, containers[0])
+            self._apply_cassandra(bundle, entry_point, storage_entry, config, containers[0])
 
             # See if we need to apply
             if 'titan' in storage_entry:
-                self._apply_titan(host_dir, storage_entry, containers[0])
-                out_file = open(host_dir + '/servers', 'w+')
-                out_file.write("%s %s" % (storage_entry['titan']['ip'], 'rexserver'))
-                out_file.close
+                self._apply_titan(bundle, storage_entry, containers[0])
+                bundle.add('servers', "%s %s" % (storage_entry['titan']['ip'], 'rexserver'))
 
             # The config dirs specifies what to transfer over. We want to 
             # transfer over specific files into a directory. 
             for c in containers:
                 config_dirs.append([c['container'], 
-                                    host_dir + '/*', 
+                                    bundle, 
                                     config.config_directory])
         except IOError as err:
             sys.stderr.write('' + str(err))
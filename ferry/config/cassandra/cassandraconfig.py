@@ -15,8 +15,10 @@
 
 import os
 import sys
-import sh
-from string import Template
+from ferry.config.bundle import ConfigBundle
+from ferry.config.cassandra.profile import CassandraProfile
+from ferry.config.cassandra.topology import CassandraTopology
+from ferry.config.system.info import colocated
 from ferry.install import FERRY_HOME
 from ferry.config.titan.titanconfig import *
 
@@ -26,6 +28,7 @@ class CassandraInitializer(object):
     Param user The user login for the git repo
     """
     def __init__(self, system):
+        self.system = system
         self.template_dir = None
         self.template_repo = None
 
@@ -113,35 +116,36 @@ class CassandraInitializer(object):
     def _apply_titan(self, config, cass_entry, cass_containers):
         return self.titan.apply(config, cass_containers, cass_entry)
 
-    def _generate_yaml_config(self, container, seed, host_dir, config):
-        yaml_in_file = open(self.template_dir + '/cassandra.yaml.template', 'r')
-        yaml_out_file = open(host_dir + '/cassandra.yaml', 'w+')
-
+    def _generate_yaml_config(self, container, seed, tokens, profile, bundle, config):
         changes = { "LOCAL_ADDRESS":container['data_ip'], 
                     "DATA_DIR":config.data_directory,
                     "CACHE_DIR":config.cache_directory,
                     "COMMIT_DIR":config.commit_directory,
-                    "SEEDS":seed}
+                    "SEEDS":seed,
+                    "INITIAL_TOKEN":','.join(tokens),
+                    "SNITCH":"GossipingPropertyFileSnitch"}
+        changes.update(profile.yaml_changes())
 
-        for line in yaml_in_file:
-            s = Template(line).substitute(changes)
-            yaml_out_file.write(s)
+        bundle.render(self.template_dir + '/cassandra.yaml.template',
+                      'cassandra.yaml',
+                      changes)
 
-        yaml_out_file.close()
-        yaml_in_file.close()
+    def _generate_rackdc_config(self, container, topology, bundle):
+        bundle.add('cassandra-rackdc.properties', topology.rackdc(container))
 
-    def _generate_log4j_config(self, host_dir, config):
-        log4j_in_file = open(self.template_dir + '/log4j-server.properties', 'r')
-        log4j_out_file = open(host_dir + '/log4j-server.properties', 'w+')
+    def _generate_env_config(self, profile, bundle):
+        """
+        The heap sizes are read by cassandra-env.sh, so
+        the startnode script sources this before starting. 
+        """
+        bundle.add('cassandra-tuning.sh', profile.env())
 
+    def _generate_log4j_config(self, bundle, config):
         changes = { "LOG_DIR":config.log_directory } 
 
-        for line in log4j_in_file:
-            s = Template(line).substitute(changes)
-            log4j_out_file.write(s)
-
-        log4j_out_file.close()
-        log4j_in_file.close()
+        bundle.render(self.template_dir + '/log4j-server.properties',
+                      'log4j-server.properties',
+                      changes)
 
     """
     Apply the configuration to the instances
@@ -158,38 +162,49 @@ class CassandraInitializer(object):
             elif c['type'] == 'titan':
                 titan_containers.append(c)
 
+        # Place the nodes into racks (one per host). We don't need the
+        # entire list of containers as seeds, just one from each rack. 
+        topology = CassandraTopology(cass_containers)
+        seeds = topology.seeds()
+        seed = ','.join(seeds)
+        entry_point['racks'] = topology.json()
+
         # In Cassandra all nodes are equal, so just pick one
         # as the "entry" node
-        entry_point['seed'] = str(containers[0]['data_ip'])
-
-        # Generate list of the seed nodes. We don't need the entire
-        # list of containers, just a few. 
-        seed = ''
-        for i in range(0, len(cass_containers)):
-            if i < 6:
-                if i != 0:
-                    seed += ','
-                seed += cass_containers[i]['data_ip']
-
-        # Create a new configuration directory, and place
-        # into the template directory. 
+        entry_point['seed'] = str(seeds[0])
+
+        # Pick the tuning profile. 
+        args = None
+        if len(cass_containers) > 0:
+            args = cass_containers[0].get('args')
+        profile = CassandraProfile.from_system(self.system, 
+                                               colocated(cass_containers), 
+                                               len(cass_containers), 
+                                               args)
+        entry_point['profile'] = profile.json()
+
+        # Spread the tokens evenly instead of picking them at random. 
+        tokens = topology.tokens(profile.num_tokens)
+
+        # Create a new configuration bundle. Only the cassandra.yaml
+        # differs between the containers. 
         config_dirs = []
         try:
+            common = ConfigBundle('cassandra_' + str(config.uuid))
+            self._generate_log4j_config(common, config)
+            self._generate_env_config(profile, common)
+
             for c in cass_containers:
-                host_dir = "/tmp/" + self._generate_config_dir(config.uuid, c)
-                try:
-                    sh.mkdir('-p', host_dir)
-                except:
-                    sys.stderr.write('could not create config dir ' + host_dir)
+                bundle = common.copy(self._generate_config_dir(config.uuid, c))
 
                 # The config dirs specifies what to transfer over. We want to 
                 # transfer over specific files into a directory. 
                 config_dirs.append([c['container'], 
-                                    host_dir + '/*', 
+                                    bundle, 
                                     config.config_directory])
 
-                self._generate_yaml_config(c, seed, host_dir, config)
-                self._generate_log4j_config(host_dir, config)
+                self._generate_yaml_config(c, seed, tokens[c['data_ip']], profile, bundle, config)
+                self._generate_rackdc_config(c, topology, bundle)
         except IOError as err:
             sys.stderr.write('' + str(err))
 
@@ -0,0 +1,146 @@
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+from ferry.config.system.info import HostShare
+
+BALANCED = 'balanced'
+READ_HEAVY = 'read-heavy'
+WRITE_HEAVY = 'write-heavy'
+PROFILES = [BALANCED, READ_HEAVY, WRITE_HEAVY]
+
+# Cassandra won't run well with less heap (MB) than this.
+MIN_HEAP = 512
+
+class CassandraProfile(HostShare):
+    """
+    Heap, thread pool, memtable, and compaction settings for a Cassandra
+    node. Memory is in MB. A key cache size of None lets Cassandra pick.
+    """
+    FIELDS = ['heap_size', 'heap_newsize', 'num_tokens',
+              'concurrent_reads', 'concurrent_writes',
+              'memtable_heap', 'memtable_offheap', 'flush_writers',
+              'compactors', 'compaction_throughput', 'key_cache']
+
+    def __init__(self, name=BALANCED):
+        self.name = name
+        self.heap_size = 1024
+        self.heap_newsize = 256
+        self.num_tokens = 256
+        self.concurrent_reads = 32
+        self.concurrent_writes = 32
+        self.memtable_heap = 256
+        self.memtable_offheap = 256
+        self.flush_writers = 1
+        self.compactors = 1
+        self.compaction_throughput = 16
+        self.key_cache = None
+
+    @staticmethod
+    def from_system(system, colocated=1, num_nodes=1, args=None):
+        """
+        Derive the settings from the host resources (split between the
+        containers sharing the host) and the size of the cluster. The
+        profile is picked with the 'profile' plan argument, and other
+        plan arguments (e.g., 'concurrent_writes') take precedence.
+        """
+        name = BALANCED
+        if args and 'profile' in args:
+            name = str(args['profile'])
+            if not name in PROFILES:
+                logging.warning("unknown cassandra profile %s, using %s" % (name, BALANCED))
+                name = BALANCED
+
+        mem, cores = HostShare.share(system, colocated)
+
+        p = CassandraProfile(name)
+
+        # Same rule as cassandra-env.sh, but applied to our share of the host.
+        p.heap_size = max(max(min(mem / 2, 1024), min(mem / 4, 8192)), MIN_HEAP)
+        p.heap_newsize = min(100 * cores, p.heap_size / 4)
+
+        # Vnodes make repairs and streaming more expensive
+        # on big clusters, so use fewer tokens there.
+        if num_nodes <= 16:
+            p.num_tokens = 256
+        elif num_nodes <= 64:
+            p.num_tokens = 128
+        else:
+            p.num_tokens = 64
+
+        # Reads are bound by the disk (16 per drive), writes by the
+        # cores (8 per core). We assume one data drive per container.
+        p.concurrent_reads = 32
+        p.concurrent_writes = max(32, 8 * cores)
+        p.memtable_heap = p.heap_size / 4
+        p.memtable_offheap = p.heap_size / 4
+        p.flush_writers = 1
+        p.compactors = max(1, min(cores / 2, 4))
+        p.compaction_throughput = 16
+
+        if name == WRITE_HEAVY:
+            # Bigger memtables mean fewer flushes and less compaction,
+            # and compaction needs to keep up with the writes.
+            p.concurrent_writes = max(64, 8 * cores)
+            p.memtable_heap = p.heap_size / 3
+            p.memtable_offheap = p.heap_size / 2
+            p.flush_writers = max(1, min(cores / 2, 4))
+            p.compactors = max(1, min(cores, 8))
+            p.compaction_throughput = 64
+        elif name == READ_HEAVY:
+            # Leave the heap to the caches and keep the
+            # number of sstables per read down.
+            p.concurrent_reads = 64
+            p.memtable_heap = p.heap_size / 8
+            p.memtable_offheap = p.heap_size / 8
+            p.compaction_throughput = 32
+            p.key_cache = min(p.heap_size / 10, 512)
+
+        p._override(args, p.FIELDS)
+        return p
+
+    @staticmethod
+    def from_json(json):
+        return CassandraProfile(str(json.get('profile', BALANCED)))._load(json)
+
+    def yaml_changes(self):
+        """
+        Values substituted into cassandra.yaml.
+        """
+        key_cache = ''
+        if self.key_cache is not None:
+            key_cache = self.key_cache
+        return { "NUM_TOKENS":self.num_tokens,
+                 "CONCURRENT_READS":self.concurrent_reads,
+                 "CONCURRENT_WRITES":self.concurrent_writes,
+                 "MEMTABLE_HEAP":self.memtable_heap,
+                 "MEMTABLE_OFFHEAP":self.memtable_offheap,
+                 "FLUSH_WRITERS":self.flush_writers,
+                 "COMPACTORS":self.compactors,
+                 "COMPACTION_THROUGHPUT":self.compaction_throughput,
+                 "KEY_CACHE":key_cache }
+
+    def env(self):
+        """
+        Environment read by cassandra-env.sh when the node starts.
+        """
+        return ("# Cassandra %s profile\n" % self.name +
+                "export MAX_HEAP_SIZE=%dM\n" % self.heap_size +
+                "export HEAP_NEWSIZE=%dM\n" % self.heap_newsize)
+
+    def json(self):
+        j = HostShare.json(self)
+        j['profile'] = self.name
+        return j
@@ -0,0 +1,86 @@
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import collections
+from ferry.config.system.info import hosts_of, interleave
+
+DATA_CENTER = 'dc1'
+
+# Cassandra recommends a few seeds per data center. We
+# pick one per rack, but no more than this many.
+MAX_SEEDS = 6
+
+# Try to have at least this many seeds, even if
+# all the nodes are in the same rack.
+MIN_SEEDS = 3
+
+# Murmur3Partitioner token range.
+MIN_TOKEN = -2**63
+TOKEN_RANGE = 2**64
+
+class CassandraTopology(object):
+    """
+    Place the Cassandra nodes into racks based on the host that each
+    container runs on (every docker host or cloud instance is a rack),
+    pick the seeds, and assign evenly spaced tokens.
+    """
+    def __init__(self, containers):
+        self.racks = collections.OrderedDict()
+        self.rack_of = {}
+        for i, members in enumerate(hosts_of(containers).values()):
+            rack = 'rack%d' % (i + 1)
+            self.racks[rack] = members
+            for c in members:
+                self.rack_of[c['data_ip']] = rack
+
+        # Walk the racks round-robin so that neighbouring
+        # nodes (and tokens) are in different racks.
+        self.ring = interleave(containers)
+
+    def rack(self, container):
+        return self.rack_of[container['data_ip']]
+
+    def seeds(self):
+        """
+        One seed per rack, and a few more if there are only a few racks.
+        """
+        num = min(max(len(self.racks), MIN_SEEDS), MAX_SEEDS, len(self.ring))
+        return [c['data_ip'] for c in self.ring[:num]]
+
+    def tokens(self, num_tokens):
+        """
+        Split the token range into equal pieces and deal them out to the
+        nodes in ring order, so every node owns the same share of the
+        data and consecutive ranges belong to different racks.
+        """
+        num_nodes = len(self.ring)
+        total = num_nodes * num_tokens
+        tokens = {}
+        for i in range(total):
+            ip = self.ring[i % num_nodes]['data_ip']
+            if not ip in tokens:
+                tokens[ip] = []
+            tokens[ip].append(str(MIN_TOKEN + (i * TOKEN_RANGE) / total))
+        return tokens
+
+    def rackdc(self, container):
+        """
+        Contents of cassandra-rackdc.properties (read by
+        the GossipingPropertyFileSnitch).
+        """
+        return "dc=%s\nrack=%s\n" % (DATA_CENTER, self.rack(container))
+
+    def json(self):
+        return dict((rack, [c['data_ip'] for c in containers]) for rack, containers in self.racks.items())
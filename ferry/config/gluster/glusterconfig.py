@@ -13,11 +13,12 @@
 # limitations under the License.
 #
 
-import sh
 import os
 import stat
 import logging
-from string import Template
+from ferry.config.bundle import ConfigBundle
+from ferry.config.system.info import colocated, interleave
+from ferry.config.gluster.volume import GlusterVolume
 
 """
 Create Gluster configurations and apply them to a set of instances
@@ -30,6 +31,7 @@ class GlusterInitializer(object):
     def __init__(self, system):
         self.template_dir = None
         self.template_repo = None
+        self.system = system
 
         self.MOUNT_VOLUME = '/gv0'
         self.MOUNT_ROOT = '/service'
@@ -50,16 +52,12 @@ class GlusterInitializer(object):
         slave nodes before the master, since the master assumes everything is
         waiting for it to start. 
         """
-        all_output = {}
         master_ip = entry_point['gluster']
-        for c in containers:
-            if c.internal_ip != master_ip:
-                output = fabric.cmd([c], '/service/sbin/startnode %s slave' % cmd)
-                all_output = dict(all_output.items() + output.items())
-        for c in containers:
-            if c.internal_ip == master_ip:
-                output = fabric.cmd([c], '/service/sbin/startnode %s master' % cmd)
-                all_output = dict(all_output.items() + output.items())
+        slaves = [c for c in containers if c.internal_ip != master_ip]
+        masters = [c for c in containers if c.internal_ip == master_ip]
+        all_output = fabric.cmd(slaves, '/service/sbin/startnode %s slave' % cmd)
+        output = fabric.cmd(masters, '/service/sbin/startnode %s master' % cmd)
+        all_output = dict(all_output.items() + output.items())
         return all_output
     def start_service(self, containers, entry_point, fabric):
         return self._execute_service(containers, entry_point, fabric, "start")
@@ -129,14 +127,8 @@ class GlusterInitializer(object):
         # For gluster this is the IP address of the "master" and the volume name. 
         entry_point = { 'type' : 'gluster' }
 
-        # Create a new configuration directory, and place
-        # into the template directory. 
-        new_config_dir = "/tmp/" + self.generate_config_dir(config.uuid)
-
-        try:
-            sh.mkdir('-p', new_config_dir)
-        except:
-            logging.warning("gluster " + new_config_dir + " already exists")
+        # Create a new configuration bundle. 
+        bundle = ConfigBundle(self.generate_config_dir(config.uuid))
 
         # Choose one of the instances as the "head" node. 
         # The head node is special since it "runs" the installation. 
@@ -150,43 +142,50 @@ class GlusterInitializer(object):
             for server in containers:
                 entry_point['instances'].append([server['data_ip'], server['host_name']])
 
-            # These are the commands the head node will execute. 
-            in_file = open(self.template_dir + '/configure.template', 'r')
-            out_file = open(new_config_dir + '/configure', 'w+')
+            # Pick the layout and the performance options. 
+            volume = GlusterVolume.from_system(self.system,
+                                               len(containers),
+                                               colocated(containers),
+                                               containers[0].get('args'))
 
+            # These are the commands the head node will execute. 
             probe = ""
             volume_id = "gluster-volume-" + str(config.uuid)
-            volumes = "gluster volume create " + str(volume_id) + " "
+            volumes = "gluster volume create " + str(volume_id) + " " + volume.layout()
             for server in containers:
                 # The head node should not list itself in the peer probe.
                 if server != config.head_node:
                     probe += "gluster peer probe " + str(server['data_ip']) + "\n"
 
-                # All vumes get listed including the head node. 
+            # All volumes get listed including the head node. Consecutive
+            # bricks form the replica (or disperse) sets, so list them
+            # round-robin across the hosts to keep copies on different hosts. 
+            for server in interleave(containers):
                 volumes += str(server['data_ip']) + ":/" + config.data_directory + " "
 
+            options = ""
+            for key, value in volume.options():
+                options += "gluster volume set %s %s %s >> /tmp/gluster_deploy.log 2>> /tmp/gluster_deploy.err\n" % (volume_id, key, value)
+
             # Now make the changes to the template file. 
             entry_point['volume'] = volume_id
+            entry_point['layout'] = volume.json()
             changes = { "BRICK_DIR":config.data_directory, 
                         "PEER_PROBE":probe,
                         "VOLUME_LIST":volumes,
+                        "VOLUME_OPTIONS":options,
                         "VOLUME_ID":volume_id }
-            for line in in_file:
-                s = Template(line).substitute(changes)
-                out_file.write(s)
-
-            in_file.close()
-            out_file.close()
-
-            # Change the permissions of the configure file to be executable.
-            os.chmod(new_config_dir + '/configure', 
-                     stat.S_IRUSR |
-                     stat.S_IWUSR |
-                     stat.S_IXUSR | 
-                     stat.S_IRGRP |
-                     stat.S_IWGRP |
-                     stat.S_IXGRP |
-                     stat.S_IROTH)
+            # The configure file needs to be executable. 
+            bundle.render(self.template_dir + '/configure.template',
+                          'configure',
+                          changes,
+                          stat.S_IRUSR |
+                          stat.S_IWUSR |
+                          stat.S_IXUSR | 
+                          stat.S_IRGRP |
+                          stat.S_IWGRP |
+                          stat.S_IXGRP |
+                          stat.S_IROTH)
         except IOError as e:
             logging.error(e.strerror)
 
@@ -194,7 +193,7 @@ class GlusterInitializer(object):
         config_dirs = []
         for c in containers:
             config_dirs.append([c['container'],
-                                new_config_dir, 
+                                bundle, 
                                 config.config_directory])
 
         return config_dirs, entry_point
@@ -0,0 +1,132 @@
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+from ferry.config.system.info import HostShare
+
+# Bounds for the number of io threads on each brick.
+MIN_IO_THREADS = 8
+MAX_IO_THREADS = 64
+
+# Bounds for the read cache (MB) of each client.
+MIN_CACHE_SIZE = 32
+MAX_CACHE_SIZE = 1024
+
+WRITE_BEHIND_WINDOW = 4
+
+# GlusterFS release installed in the image, and the first
+# release that can create disperse volumes.
+GLUSTER_VERSION = '3.5'
+DISPERSE_VERSION = '3.6'
+
+def _on_off(value):
+    if str(value).lower() in ['off', 'false', 'no', '0']:
+        return 'off'
+    return 'on'
+
+class GlusterVolume(HostShare):
+    """
+    Layout (replica, disperse, or stripe counts) and performance
+    options of a Gluster volume. The layout is picked with the plan
+    arguments, and the options are derived from the host resources
+    unless they are also given as plan arguments.
+    """
+    FIELDS = ['replica', 'stripe', 'disperse', 'redundancy',
+              'io_threads', 'cache_size', 'write_behind_window']
+    SWITCHES = ['io_cache', 'read_ahead', 'write_behind']
+
+    def __init__(self, num_bricks):
+        self.num_bricks = num_bricks
+        self.replica = 1
+        self.stripe = 1
+        self.disperse = 0
+        self.redundancy = 0
+        self.io_cache = 'on'
+        self.read_ahead = 'on'
+        self.write_behind = 'on'
+        self.io_threads = 16
+        self.cache_size = MIN_CACHE_SIZE
+        self.write_behind_window = WRITE_BEHIND_WINDOW
+
+    @staticmethod
+    def from_system(system, num_bricks, colocated=1, args=None):
+        """
+        Scale the io threads of each brick with its cores, and the
+        client read cache with its memory. The layout only comes from
+        the plan arguments (e.g., 'replica'), which also replace the
+        derived options.
+        """
+        v = GlusterVolume(num_bricks)
+
+        mem, cores = HostShare.share(system, colocated)
+        v.io_threads = min(max(2 * cores, MIN_IO_THREADS), MAX_IO_THREADS)
+        v.cache_size = min(max(mem / 16, MIN_CACHE_SIZE), MAX_CACHE_SIZE)
+
+        v._override(args, v.FIELDS)
+        for k in v.SWITCHES:
+            if args and k in args:
+                setattr(v, k, _on_off(args[k]))
+        v._check_layout()
+        return v
+
+    def _check_layout(self):
+        """
+        Fall back to a plain distributed volume if the layout
+        doesn't fit the number of bricks. Disperse volumes need
+        GlusterFS 3.6, and the image ships 3.5, so they always
+        fall back.
+        """
+        if self.disperse > 0:
+            logging.warning("gluster: disperse volumes need GlusterFS %s (the image has %s)" % (DISPERSE_VERSION, GLUSTER_VERSION))
+        elif self.num_bricks % (self.replica * self.stripe) == 0:
+            return
+        else:
+            logging.warning("gluster: %d bricks is not a multiple of replica %d x stripe %d" % (self.num_bricks, self.replica, self.stripe))
+
+        self.replica = 1
+        self.stripe = 1
+        self.disperse = 0
+        self.redundancy = 0
+
+    def layout(self):
+        """
+        Layout arguments of 'gluster volume create'.
+        """
+        layout = ""
+        if self.disperse > 0:
+            layout += "disperse %d redundancy %d " % (self.disperse, self.redundancy)
+        if self.stripe > 1:
+            layout += "stripe %d " % self.stripe
+        if self.replica > 1:
+            layout += "replica %d " % self.replica
+        return layout
+
+    def options(self):
+        return [ ('performance.io-cache', self.io_cache),
+                 ('performance.read-ahead', self.read_ahead),
+                 ('performance.write-behind', self.write_behind),
+                 ('performance.io-thread-count', self.io_threads),
+                 ('performance.cache-size', '%dMB' % self.cache_size),
+                 ('performance.write-behind-window-size', '%dMB' % self.write_behind_window) ]
+
+    def json(self):
+        """
+        The layout and options, keyed by the names of the plan
+        arguments (these end up in the connector environment).
+        """
+        j = HostShare.json(self)
+        for k in self.SWITCHES:
+            j[k] = getattr(self, k)
+        return j
@@ -15,8 +15,8 @@
 
 import os
 import sys
-import sh
-from string import Template
+from ferry.config.bundle import ConfigBundle
+from ferry.config.hadoop.resources import YarnResources, java_opts
 from ferry.install import FERRY_HOME
 from ferry.config.hadoop.hiveconfig import *
 
@@ -96,87 +96,56 @@ class HadoopClientInitializer(object):
     """
     Generate the core-site configuration for a local filesystem. 
     """
-    def _generate_gluster_core_site(self, mount_point, new_config_dir):
-        core_in_file = open(self.template_dir + '/core-site.xml.template', 'r')
-        core_out_file = open(new_config_dir + '/core-site.xml', 'w+')
-
+    def _generate_gluster_core_site(self, mount_point, bundle):
         changes = { "DEFAULT_NAME":"file:///", 
-                    "DATA_TMP":"/service/data/client/tmp" }
-        for line in core_in_file:
-            s = Template(line).substitute(changes)
-            core_out_file.write(s)
-
-        core_in_file.close()
-        core_out_file.close()
-
-    def _generate_log4j(self, new_config_dir):
-        in_file = open(self.template_dir + '/log4j.properties', 'r')
-        out_file = open(new_config_dir + '/log4j.properties', 'w+')
+                    "DATA_TMP":"/service/data/client/tmp",
+                    "TOPOLOGY":"" }
+        bundle.render(self.template_dir + '/core-site.xml.template',
+                      'core-site.xml',
+                      changes)
 
-        for line in in_file:
-            out_file.write(line)
+    def _generate_log4j(self, bundle):
+        bundle.render(self.template_dir + '/log4j.properties',
+                      'log4j.properties')
 
-        in_file.close()
-        out_file.close()
-
-    def _generate_core_site(self, hdfs_master, new_config_dir):
+    def _generate_core_site(self, hdfs_master, bundle):
         """
         Generate the core-site configuration. 
         """
-        core_in_file = open(self.template_dir + '/core-site.xml.template', 'r')
-        core_out_file = open(new_config_dir + '/core-site.xml', 'w+')
-
         default_name = "%s://%s:%s" % ("hdfs",
                                        hdfs_master,
                                        HadoopClientConfig.HDFS_MASTER)
         changes = { "DEFAULT_NAME":default_name,
-                    "DATA_TMP":"/service/data/client/tmp" }
-        for line in core_in_file:
-            s = Template(line).substitute(changes)
-            core_out_file.write(s)
-
-        core_in_file.close()
-        core_out_file.close()
+                    "DATA_TMP":"/service/data/client/tmp",
+                    "TOPOLOGY":"" }
+        bundle.render(self.template_dir + '/core-site.xml.template',
+                      'core-site.xml',
+                      changes)
 
     """
     Generate the yarn-site configuration. 
     """
-    def _generate_yarn_site(self, yarn_master, new_config_dir):
-        yarn_in_file = open(self.template_dir + '/yarn-site.xml.template', 'r')
-        yarn_out_file = open(new_config_dir + '/yarn-site.xml', 'w+')
-
+    def _generate_yarn_site(self, yarn_master, resources, bundle):
         changes = { "YARN_MASTER":yarn_master,
                     "DATA_STAGING":"/service/data/client/staging" }
 
-        # Get memory information.
-        mem = self.system.get_total_memory()
-        if mem < 1024:
-            mem = 1024
-        changes['MEM'] = mem
-        changes['CMEM'] = max(mem / 8, 512)
-        changes['RMEM'] = 2 * changes['CMEM']
-        changes['ROPTS'] = '-Xmx' + str(int(0.8 * changes['RMEM'])) + 'm'
-
-        cores = self.system.get_num_cores() / 2
-        if cores < 1:
-            cores = 1
-        changes['CORES'] = cores
-
-        for line in yarn_in_file:
-            s = Template(line).substitute(changes)
-            yarn_out_file.write(s)
+        # Jobs are submitted from the client, so these
+        # need to match the cluster. 
+        changes['MEM'] = resources.node_memory
+        changes['CMEM'] = resources.min_allocation()
+        changes['RMEM'] = resources.am_memory
+        changes['ROPTS'] = java_opts(resources.am_memory)
+        changes['CORES'] = resources.vcores
 
-        yarn_in_file.close()
-        yarn_out_file.close()
+        bundle.render(self.template_dir + '/yarn-site.xml.template',
+                      'yarn-site.xml',
+                      changes)
 
 
     """
     Generate the mapred-site configuration. 
     """
-    def _generate_mapred_site(self, config, containers, new_config_dir):
-        mapred_in_file = open(self.template_dir + '/mapred-site.xml.template', 'r')
-        mapred_out_file = open(new_config_dir + '/mapred-site.xml', 'w+')
-
+    def _generate_mapred_site(self, config, containers, resources, bundle):
         # Most of these values aren't applicable for the client,
         # so just make up fake numbers. 
         changes = { "NODE_REDUCES":1, 
@@ -186,21 +155,24 @@ class HadoopClientInitializer(object):
                     "HISTORY_SERVER":config.yarn_master, 
                     "DATA_TMP":"/service/data/client/tmp" }
 
-        # Get memory information.
-        mem = self.system.get_total_memory()
-        if mem < 1024:
-            mem = 1024
-        changes['MMEM'] = max(mem / 8, 512)
-        changes['RMEM'] = 2 * changes['MMEM']
-        changes['MOPTS'] = '-Xmx' + str(int(0.8 * changes['MMEM'])) + 'm'
-        changes['ROPTS'] = '-Xmx' + str(int(0.8 * changes['RMEM'])) + 'm'
+        # Size of the map and reduce containers. 
+        changes['MMEM'] = resources.map_memory
+        changes['RMEM'] = resources.reduce_memory
+        changes['MOPTS'] = java_opts(resources.map_memory)
+        changes['ROPTS'] = java_opts(resources.reduce_memory)
 
-        for line in mapred_in_file:
-            s = Template(line).substitute(changes)
-            mapred_out_file.write(s)
+        bundle.render(self.template_dir + '/mapred-site.xml.template',
+                      'mapred-site.xml',
+                      changes)
 
-        mapred_in_file.close()
-        mapred_out_file.close()
+    """
+    Use the same container sizes as the cluster. Older clusters
+    don't record them, so fall back to sizing for this host. 
+    """
+    def _get_resources(self, containers, backend):
+        if 'resources' in backend:
+            return YarnResources.from_json(backend['resources'])
+        return YarnResources.from_system(self.system, 1, containers[0].get('args'))
 
     """
     Apply the Hive client configuration
@@ -215,13 +187,8 @@ class HadoopClientInitializer(object):
         entry_point = { 'type' : 'hadoop-client' }
         entry_point['ip'] = containers[0]['manage_ip']
 
-        # Create a new configuration directory, and place
-        # into the template directory. 
-        new_config_dir = "/tmp/" + self._generate_config_dir(config.uuid)
-        try:
-            sh.mkdir('-p', new_config_dir)
-        except:
-            sys.stderr.write('could not create config dir ' + new_config_dir)
+        # Create a new configuration bundle. 
+        bundle = ConfigBundle(self._generate_config_dir(config.uuid))
 
         # Check if there is an explicit compute cluster. If there
         # is, then we use that for YARN information. 
@@ -232,6 +199,7 @@ class HadoopClientInitializer(object):
 
         if compute and 'yarn' in compute:
             config.yarn_master = compute['yarn']
+            resources = self._get_resources(containers, compute)
             if 'db' in compute:
                 config.hive_meta = compute['db']                
         else:
@@ -239,6 +207,7 @@ class HadoopClientInitializer(object):
             # check if the storage is compatible.
             if 'yarn' in storage:
                 config.yarn_master = storage['yarn']
+                resources = self._get_resources(containers, storage)
             if 'db' in storage:
                 config.hive_meta = storage['db']
 
@@ -246,23 +215,23 @@ class HadoopClientInitializer(object):
         entry_point['hdfs_type'] = storage['type']
         if storage['type'] == 'hadoop':
             config.hdfs_master = storage['hdfs']
-            self._generate_core_site(config.hdfs_master, new_config_dir)
+            self._generate_core_site(config.hdfs_master, bundle)
         elif storage['type'] == 'gluster':
             mount_url = "%s:/%s" % (storage['gluster'], storage['volume'])
             entry_point['gluster_url'] = mount_url
-            self._generate_gluster_core_site('/data', new_config_dir)
+            self._generate_gluster_core_site('/data', bundle)
 
         # Generate the Hadoop conf files.
         if config.yarn_master:
-            self._generate_log4j(new_config_dir)
-            self._generate_mapred_site(config, containers, new_config_dir)
-            self._generate_yarn_site(config.yarn_master, new_config_dir)
+            self._generate_log4j(bundle)
+            self._generate_mapred_site(config, containers, resources, bundle)
+            self._generate_yarn_site(config.yarn_master, resources, bundle)
 
         # Each container needs to point to a new config dir. 
         config_dirs = []
         for c in containers:
             config_dirs.append([c['container'],
-                                new_config_dir + '/*',
+                                bundle,
                                 config.config_directory])
 
         # Now configure the Hive client.
@@ -15,11 +15,14 @@
 
 import logging
 import os
+import stat
 import sys
 import time
-import sh
-from string import Template
 from ferry.install import FERRY_HOME
+from ferry.config.bundle import ConfigBundle
+from ferry.config.template import render_template
+from ferry.config.hadoop.resources import YarnResources, colocated, java_opts
+from ferry.config.system.info import hosts_of
 from ferry.config.hadoop.hiveconfig import *
 from ferry.config.hadoop.metastore  import *
 
@@ -55,15 +58,20 @@ class HadoopInitializer(object):
         yarn_master = entry_point['yarn']
         hdfs_master = None
 
-        # Now start the HDFS cluster. 
+        # Now start the HDFS cluster. The namenode must be running
+        # before the datanodes, but the datanodes can start together. 
         if entry_point['hdfs_type'] == 'hadoop':
             hdfs_master = entry_point['hdfs']
+            namenodes = []
+            datanodes = []
             for c in containers:
                 if c.service_type == 'hadoop':
                     if c.internal_ip == hdfs_master:
-                        output = fabric.cmd([c], '/service/sbin/startnode %s namenode' % cmd)
+                        namenodes.append(c)
                     elif c.internal_ip != yarn_master:
-                        output = fabric.cmd([c], '/service/sbin/startnode %s datanode' % cmd)
+                        datanodes.append(c)
+            output = fabric.cmd(namenodes, '/service/sbin/startnode %s namenode' % cmd)
+            output = fabric.cmd(datanodes, '/service/sbin/startnode %s datanode' % cmd)
 
             # Now wait a couple seconds to make sure
             # everything has started.
@@ -73,13 +81,17 @@ class HadoopInitializer(object):
             output = fabric.cmd(containers, 
                                 '/service/sbin/startnode %s gluster %s' % (cmd, mount_url))
                                 
-        # Now start the YARN cluster. 
+        # Now start the YARN cluster. Again, the master goes first. 
+        masters = []
+        slaves = []
         for c in containers:
             if c.service_type == 'hadoop' or c.service_type == 'yarn':
                 if c.internal_ip == yarn_master:
-                    output = fabric.cmd([c], '/service/sbin/startnode %s yarnmaster' % cmd)
+                    masters.append(c)
                 elif c.internal_ip != hdfs_master:
-                    output = fabric.cmd([c], '/service/sbin/startnode %s yarnslave' % cmd)
+                    slaves.append(c)
+        output = fabric.cmd(masters, '/service/sbin/startnode %s yarnmaster' % cmd)
+        output = fabric.cmd(slaves, '/service/sbin/startnode %s yarnslave' % cmd)
 
         # Now start the Hive metastore. 
         for c in containers:
@@ -94,11 +106,13 @@ class HadoopInitializer(object):
     def stop_service(self, containers, entry_point, fabric):
         output = fabric.cmd(containers, '/service/sbin/startnode stop')
 
-    def _generate_config_dir(self, uuid, container):
+    def _generate_config_dir(self, uuid, container=None):
         """
         Generate a new configuration.
         """
-        return 'hadoop_' + str(uuid) + '_' + str(container['data_ip'])
+        if container:
+            return 'hadoop_' + str(uuid) + '_' + str(container['data_ip'])
+        return 'hadoop_' + str(uuid)
 
     def get_public_ports(self, num_instances):
         """
@@ -162,94 +176,106 @@ class HadoopInitializer(object):
         """
         return HadoopConfig(num)
 
-    def _generate_gluster_core_site(self, new_config_dir, container):
+    def _generate_gluster_core_site(self, bundle, container):
         """
         Generate the core-site configuration for a local filesystem. 
         """
-        core_in_file = open(self.template_dir + '/core-site.xml.template', 'r')
-        core_out_file = open(new_config_dir + '/core-site.xml', 'w+')
-
         changes = { "DEFAULT_NAME":"file:///", 
-                    "DATA_TMP":"/service/data/%s/tmp" % container['host_name'] }
-        for line in core_in_file:
-            s = Template(line).substitute(changes)
-            core_out_file.write(s)
-
-        core_in_file.close()
-        core_out_file.close()
+                    "DATA_TMP":"/service/data/%s/tmp" % container['host_name'],
+                    "TOPOLOGY":"" }
+        bundle.render(self.template_dir + '/core-site.xml.template',
+                      'core-site.xml',
+                      changes)
 
-    def _generate_core_site(self, hdfs_master, new_config_dir):
+    def _generate_core_site(self, config, hdfs_master, bundle):
         """
-        Generate the core-site configuration. 
+        Generate the core-site configuration. The topology script
+        is used by both the namenode and the resource manager. 
         """
-        core_in_file = open(self.template_dir + '/core-site.xml.template', 'r')
-        core_out_file = open(new_config_dir + '/core-site.xml', 'w+')
-
         default_name = "%s://%s:%s" % ("hdfs",
                                        hdfs_master['data_ip'],
                                        HadoopConfig.HDFS_MASTER)
+        topology = ("  <property>\n" + 
+                    "    <name>net.topology.script.file.name</name>\n" + 
+                    "    <value>%s/topology.sh</value>\n" % config.config_directory + 
+                    "  </property>\n")
         changes = { "DEFAULT_NAME":default_name,
-                    "DATA_TMP":"/service/data/tmp" }
-        for line in core_in_file:
-            s = Template(line).substitute(changes)
-            core_out_file.write(s)
-
-        core_in_file.close()
-        core_out_file.close()
-
-    def _generate_hdfs_site(self, config, hdfs_master, new_config_dir):
+                    "DATA_TMP":"/service/data/tmp",
+                    "TOPOLOGY":topology }
+        bundle.render(self.template_dir + '/core-site.xml.template',
+                      'core-site.xml',
+                      changes)
+
+    def _generate_topology(self, containers, bundle):
+        """
+        Generate the topology script. Containers on the same docker
+        host (or cloud instance) are placed in the same rack. 
+        """
+        racks = {}
+        lines = ""
+        for i, members in enumerate(hosts_of(containers).values()):
+            rack = '/rack%d' % (i + 1)
+            racks[rack] = [c['data_ip'] for c in members]
+            for c in members:
+                lines += '\t%s|%s) echo -n "%s " ;;\n' % (c['data_ip'], c['host_name'], rack)
+
+        changes = { "RACKS":lines,
+                    "DEFAULT_RACK":"/default-rack" }
+        bundle.render(self.template_dir + '/topology.sh.template',
+                      'topology.sh',
+                      changes,
+                      stat.S_IRWXU |
+                      stat.S_IRGRP |
+                      stat.S_IXGRP |
+                      stat.S_IROTH |
+                      stat.S_IXOTH)
+        return racks
+
+    def _generate_hdfs_site(self, config, hdfs_master, bundle, args=None):
+        """
+        Generate the hdfs-site configuration. Short-circuit reads
+        can be turned off with the 'short_circuit' argument. 
+        """
+        short_circuit = 'true'
+        if args and str(args.get('short_circuit', 'true')).lower() in ['false', 'off', 'no', '0']:
+            short_circuit = 'false'
+
+        changes = { "DATA_DIR":config.data_directory,
+                    "SHORT_CIRCUIT":short_circuit,
+                    "SOCKET_PATH":config.socket_path,
+                    "STREAMS_CACHE":256 }
+        bundle.render(self.template_dir + '/hdfs-site.xml.template',
+                      'hdfs-site.xml',
+                      changes)
+
+    def _generate_httpfs_site(self, config, bundle):
         """
         Generate the hdfs-site configuration. 
         """
-        hdfs_in_file = open(self.template_dir + '/hdfs-site.xml.template', 'r')
-        hdfs_out_file = open(new_config_dir + '/hdfs-site.xml', 'w+')
-
-        changes = { "DATA_DIR":config.data_directory }
-        for line in hdfs_in_file:
-            s = Template(line).substitute(changes)
-            hdfs_out_file.write(s)
+        bundle.render(self.template_dir + '/httpfs-site.xml.template',
+                      'httpfs-site.xml',
+                      {})
 
-        hdfs_in_file.close()
-        hdfs_out_file.close()
-
-    def _generate_httpfs_site(self, config, new_config_dir):
+    def _get_resources(self, containers):
         """
-        Generate the hdfs-site configuration. 
+        Size the YARN containers based on the host resources and
+        the number of containers sharing each host. 
         """
-        in_file = open(self.template_dir + '/httpfs-site.xml.template', 'r')
-        out_file = open(new_config_dir + '/httpfs-site.xml', 'w+')
+        args = containers[0].get('args')
+        return YarnResources.from_system(self.system, colocated(containers), args)
 
-        changes = {}
-        for line in in_file:
-            s = Template(line).substitute(changes)
-            out_file.write(s)
-
-        in_file.close()
-        out_file.close()
-
-    def _generate_yarn_site(self, yarn_master, new_config_dir, container=None):
+    def _generate_yarn_site(self, yarn_master, resources, bundle, container=None):
         """
         Generate the yarn-site configuration. 
         """
-        yarn_in_file = open(self.template_dir + '/yarn-site.xml.template', 'r')
-        yarn_out_file = open(new_config_dir + '/yarn-site.xml', 'w+')
-
         changes = { "YARN_MASTER":yarn_master['data_ip'] } 
 
-        # Get memory information.
-        mem = self.system.get_total_memory()
-        if mem < 1024:
-            logging.warning("hadoop requires at least 1024MB (%sMB given)" % str(mem))
-            mem = 1024
-        changes['MEM'] = mem
-        changes['CMEM'] = max(mem / 8, 512)
-        changes['RMEM'] = 2 * changes['CMEM']
-        changes['ROPTS'] = '-Xmx' + str(int(0.8 * changes['RMEM'])) + 'm'
-
-        cores = self.system.get_num_cores() / 2
-        if cores < 1:
-            cores = 1
-        changes['CORES'] = cores
+        # Memory and cores that the node manager may hand out. 
+        changes['MEM'] = resources.node_memory
+        changes['CMEM'] = resources.min_allocation()
+        changes['RMEM'] = resources.am_memory
+        changes['ROPTS'] = java_opts(resources.am_memory)
+        changes['CORES'] = resources.vcores
 
         # Generate the staging table. This differs depending on whether
         # we need to be container specific or not. 
@@ -258,76 +284,50 @@ class HadoopInitializer(object):
         else:
             changes['DATA_STAGING'] = '/service/data/staging'
 
-        for line in yarn_in_file:
-            s = Template(line).substitute(changes)
-            yarn_out_file.write(s)
-
-        yarn_in_file.close()
-        yarn_out_file.close()
-
-    def _generate_log4j(self, new_config_dir):
-        in_file = open(self.template_dir + '/log4j.properties', 'r')
-        out_file = open(new_config_dir + '/log4j.properties', 'w+')
+        bundle.render(self.template_dir + '/yarn-site.xml.template',
+                      'yarn-site.xml',
+                      changes)
 
-        for line in in_file:
-            out_file.write(line)
+    def _generate_log4j(self, bundle):
+        bundle.render(self.template_dir + '/log4j.properties',
+                      'log4j.properties')
 
-        in_file.close()
-        out_file.close()
-
-    def _generate_yarn_env(self, yarn_master, new_config_dir):
+    def _generate_yarn_env(self, yarn_master, resources, bundle):
         """
-        Generate the yarn-env configuration. 
+        Generate the yarn-env configuration. The daemon heap sizes
+        are appended, since the script itself isn't a template. 
         """
-        yarn_in_file = open(self.template_dir + '/yarn-env.sh.template', 'r')
-        yarn_out_file = open(new_config_dir + '/yarn-env.sh', 'w+')
-
-        for line in yarn_in_file:
-            yarn_out_file.write(line)
+        env = render_template(self.template_dir + '/yarn-env.sh.template')
+        env += "\n# Daemon heap sizes (MB)\n"
+        env += "export YARN_RESOURCEMANAGER_HEAPSIZE=%d\n" % resources.daemon_heap
+        env += "export YARN_NODEMANAGER_HEAPSIZE=%d\n" % resources.daemon_heap
+        bundle.add('yarn-env.sh', env)
 
-        yarn_in_file.close()
-        yarn_out_file.close()
-
-    def _generate_mapred_env(self, new_config_dir):
+    def _generate_mapred_env(self, resources, bundle):
         """
-        Generate the yarn-env configuration. 
+        Generate the mapred-env configuration. 
         """
-        in_file = open(self.template_dir + '/mapred-env.sh', 'r')
-        out_file = open(new_config_dir + '/mapred-env.sh', 'w+')
-
-        for line in in_file:
-            out_file.write(line)
+        env = render_template(self.template_dir + '/mapred-env.sh')
+        env += "\nexport HADOOP_JOB_HISTORYSERVER_HEAPSIZE=%d\n" % resources.daemon_heap
+        bundle.add('mapred-env.sh', env)
 
-        in_file.close()
-        out_file.close()
-
-    def _generate_mapred_site(self, yarn_master, config, containers, new_config_dir, container=None):
+    def _generate_mapred_site(self, yarn_master, config, containers, resources, bundle, container=None):
         """
         Generate the mapred-site configuration. 
         """
-        mapred_in_file = open(self.template_dir + '/mapred-site.xml.template', 'r')
-        mapred_out_file = open(new_config_dir + '/mapred-site.xml', 'w+')
         changes = {"HISTORY_SERVER":yarn_master['data_ip']}
 
-        # Get memory information.
-        mem = self.system.get_total_memory()
-        if mem < 1024:
-            mem = 1024
-        changes['MMEM'] = max(mem / 8, 512)
-        changes['RMEM'] = 2 * changes['MMEM']
-        changes['MOPTS'] = '-Xmx' + str(int(0.8 * changes['MMEM'])) + 'm'
-        changes['ROPTS'] = '-Xmx' + str(int(0.8 * changes['RMEM'])) + 'm'
+        # Size of the map and reduce containers. 
+        changes['MMEM'] = resources.map_memory
+        changes['RMEM'] = resources.reduce_memory
+        changes['MOPTS'] = java_opts(resources.map_memory)
+        changes['ROPTS'] = java_opts(resources.reduce_memory)
 
         # These are the mapred variables.
-        cores = self.system.get_num_cores()
-        if cores < 1:
-            cores = 1
-
-        # changes['NODE_REDUCES'] = mem / ( len(containers) - 2 ) / 2
-        changes['NODE_REDUCES'] = cores
-        changes['NODE_MAPS'] = changes['NODE_REDUCES'] * 4
-        changes['JOB_MAPS'] = changes['NODE_MAPS'] * ( len(containers) - 2 )
-        changes['JOB_REDUCES'] = changes['NODE_REDUCES'] * ( len(containers) - 2 )
+        changes['NODE_REDUCES'] = resources.reduce_slots()
+        changes['NODE_MAPS'] = resources.map_slots()
+        changes['JOB_MAPS'] = changes['NODE_MAPS'] * max( len(containers) - 2, 1 )
+        changes['JOB_REDUCES'] = changes['NODE_REDUCES'] * max( len(containers) - 2, 1 )
 
         # Generate the temp area. This differs depending on whether
         # we need to be container specific or not. 
@@ -336,12 +336,9 @@ class HadoopInitializer(object):
         else:
             changes['DATA_TMP'] = '/service/data/tmp'
 
-        for line in mapred_in_file:
-            s = Template(line).substitute(changes)
-            mapred_out_file.write(s)
-
-        mapred_in_file.close()
-        mapred_out_file.close()
+        bundle.render(self.template_dir + '/mapred-site.xml.template',
+                      'mapred-site.xml',
+                      changes)
 
     def _apply_hive_metastore(self, config, containers):
         """
@@ -371,41 +368,41 @@ class HadoopInitializer(object):
         entry_point['hdfs'] = str(hdfs_master['data_ip'])
         entry_point['instances'] = []
 
-        # Create a new configuration directory, and place
-        # into the template directory. 
-        config_dirs = []
-        for c in containers:
-            new_config_dir = "/tmp/" + self._generate_config_dir(config.uuid, c)
-            try:
-                sh.mkdir('-p', new_config_dir)
-            except:
-                sys.stderr.write('could not create config dir ' + new_config_dir)
+        # Size the containers and let the clients know. 
+        resources = self._get_resources(containers)
+        entry_point['resources'] = resources.json()
 
-            # Only add the container to the instances list once. 
-            entry_point['instances'].append([c['data_ip'], c['host_name']])
+        # Create a new configuration bundle. The configuration does not
+        # depend on the container, so all the containers share one bundle. 
+        bundle = ConfigBundle(self._generate_config_dir(config.uuid))
 
-            # Generate some mapred-site config
-            self._generate_mapred_site(yarn_master, config, containers, new_config_dir)
-            self._generate_mapred_env(new_config_dir)
+        # Generate some mapred-site config
+        self._generate_mapred_site(yarn_master, config, containers, resources, bundle)
+        self._generate_mapred_env(resources, bundle)
 
-            # Now generate the yarn config files
-            self._generate_yarn_site(yarn_master, new_config_dir)
-            self._generate_yarn_env(yarn_master, new_config_dir)
+        # Now generate the yarn config files
+        self._generate_yarn_site(yarn_master, resources, bundle)
+        self._generate_yarn_env(yarn_master, resources, bundle)
 
-            # Now generate the core config
-            self._generate_core_site(hdfs_master, new_config_dir)
+        # Now generate the core config
+        self._generate_core_site(config, hdfs_master, bundle)
+        entry_point['racks'] = self._generate_topology(containers, bundle)
 
-            # Now generate the HDFS config
-            self._generate_hdfs_site(config, hdfs_master, new_config_dir)
+        # Now generate the HDFS config
+        self._generate_hdfs_site(config, hdfs_master, bundle, containers[0].get('args'))
 
-            # Now generate the HDFS config
-            self._generate_httpfs_site(config, new_config_dir)
+        # Now generate the HDFS config
+        self._generate_httpfs_site(config, bundle)
 
-            # Generate the log4j config
-            self._generate_log4j(new_config_dir)
+        # Generate the log4j config
+        self._generate_log4j(bundle)
 
+        config_dirs = []
+        for c in containers:
+            # Only add the container to the instances list once. 
+            entry_point['instances'].append([c['data_ip'], c['host_name']])
             config_dirs.append([c['container'], 
-                                new_config_dir + '/*',
+                                bundle,
                                 config.config_directory])
 
         return config_dirs, entry_point
@@ -431,41 +428,42 @@ class HadoopInitializer(object):
         entry_point['yarn'] = str(yarn_master['data_ip'])
         entry_point['instances'] = []
 
-        # Create a new configuration directory, and place
-        # into the template directory. 
+        # Size the containers and let the clients know. 
+        resources = self._get_resources(containers)
+        entry_point['resources'] = resources.json()
+
+        # The log4j and environment files are the same for every container,
+        # so only render those once. 
+        common = ConfigBundle(self._generate_config_dir(config.uuid))
+        self._generate_log4j(common)
+        self._generate_mapred_env(resources, common)
+        self._generate_yarn_env(yarn_master, resources, common)
+
+        # Create a new configuration bundle. 
         config_dirs = []
         for c in containers:            
-            new_config_dir = "/tmp/" + self._generate_config_dir(config.uuid, c)
-            try:
-                sh.mkdir('-p', new_config_dir)
-            except:
-                sys.stderr.write('could not create config dir ' + new_config_dir)
+            bundle = common.copy(self._generate_config_dir(config.uuid, c))
 
             # Slaves file used to figure out who hosts the actual work/data
             for server in containers:
                 entry_point['instances'].append([server['data_ip'], server['host_name']])
 
-            # Generate the log4j config
-            self._generate_log4j(new_config_dir)
-
             # Generate some mapred-site config
-            self._generate_mapred_site(yarn_master, config, containers, new_config_dir, c)
-            self._generate_mapred_env(new_config_dir)
+            self._generate_mapred_site(yarn_master, config, containers, resources, bundle, c)
 
             # Now generate the yarn config files
-            self._generate_yarn_site(yarn_master, new_config_dir, c)
-            self._generate_yarn_env(yarn_master, new_config_dir)
+            self._generate_yarn_site(yarn_master, resources, bundle, c)
 
             # Now we need to configure additional storage parameters. For example,
             # for Gluster, etc. 
             storage_entry = self._find_hadoop_storage(containers)
             entry_point['hdfs_type'] = storage_entry['type']
             if storage_entry['type'] == 'gluster':
-                url = self._apply_gluster(config, storage_entry, new_config_dir, c)
+                url = self._apply_gluster(config, storage_entry, bundle, c)
                 entry_point['gluster_url'] = url
 
             config_dirs.append([c['container'], 
-                                new_config_dir + '/*',
+                                bundle,
                                 config.config_directory])
         return config_dirs, entry_point
 
@@ -486,10 +484,10 @@ class HadoopInitializer(object):
         hive_dirs.extend(ms_dirs)
         return hive_dirs, hive_config
 
-    def _apply_gluster(self, config, storage_entry, new_config_dir, container):
+    def _apply_gluster(self, config, storage_entry, bundle, container):
         # We assume that the new configuration directory has already 
         # been created. In the future, may want to check for this. 
-        self._generate_gluster_core_site(new_config_dir, container)
+        self._generate_gluster_core_site(bundle, container)
 
         # The mount URL specifies how to connect to Gluster. 
         mount_url = "%s:/%s" % (storage_entry['gluster'], storage_entry['volume'])
@@ -535,6 +533,9 @@ class HadoopConfig(object):
     tmp_directory = '/service/data/tmp'
     config_directory = '/service/conf/hadoop'
 
+    # The datanode port is appended to the socket name. 
+    socket_path = '/var/run/hadoop-hdfs/dn._PORT'
+
     YARN_SCHEDULER = '8030'
     YARN_TRACKER = '8031'
     YARN_IPC = '8032'
@@ -566,4 +567,5 @@ class HadoopConfig(object):
         self.log_directory = HadoopConfig.log_directory
         self.tmp_directory = HadoopConfig.tmp_directory
         self.config_directory = HadoopConfig.config_directory
+        self.socket_path = HadoopConfig.socket_path
         self.system_info = None
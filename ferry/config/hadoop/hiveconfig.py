@@ -14,9 +14,8 @@
 #
 
 import os
-import sh
 import sys
-from string import Template
+from ferry.config.bundle import ConfigBundle
 
 class HiveClientInitializer(object):
     """
@@ -76,18 +75,12 @@ class HiveClientInitializer(object):
     """
     Generate the hive site configuration. 
     """
-    def _generate_hive_site(self, config, new_config_dir):
-        in_file = open(self.template_dir + '/hive-site.xml.template', 'r')
-        out_file = open(new_config_dir + '/hive-site.xml', 'w+')
-        
+    def _generate_hive_site(self, config, bundle):
         changes = { "DB":config.metastore,
                     "USER": os.environ['USER'] }
-        for line in in_file:
-            s = Template(line).substitute(changes)
-            out_file.write(s)
-
-        in_file.close()
-        out_file.close()
+        bundle.render(self.template_dir + '/hive-site.xml.template',
+                      'hive-site.xml',
+                      changes)
 
     """
     Apply the configuration to the instances
@@ -97,20 +90,15 @@ class HiveClientInitializer(object):
         # For gluster this is the IP address of the "master" and the volume name. 
         entry_point = { 'type' : 'hive' }
 
-        # Create a new configuration directory, and place
-        # into the template directory. 
+        # Create a new configuration bundle. 
         config_dirs = []
-        new_config_dir = "/tmp/" + self._generate_config_dir(config.uuid)
-        try:
-            sh.mkdir('-p', new_config_dir)
-        except:
-            sys.stderr.write('could not create config dir ' + new_config_dir)
+        bundle = ConfigBundle(self._generate_config_dir(config.uuid))
 
-        self._generate_hive_site(config, new_config_dir)
+        self._generate_hive_site(config, bundle)
 
         # Each container needs to point to a new config dir. 
         for c in containers:
-            config_files = new_config_dir + '/*'
+            config_files = bundle
             config_dirs.append([c['container'],
                                 config_files, 
                                 config.config_directory])
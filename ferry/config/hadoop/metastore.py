@@ -14,9 +14,8 @@
 #
 
 import os
-import sh
 import sys
-from string import Template
+from ferry.config.bundle import ConfigBundle
 
 class MetaStoreInitializer(object):
     """
@@ -81,54 +80,36 @@ class MetaStoreInitializer(object):
         """
         return MetaStoreConfig(num)
 
-    def _generate_postgres_site(self, new_config_dir):
+    def _generate_postgres_site(self, bundle):
         """
         Generate the postgres configuration. 
         """
-        in_file = open(self.template_dir + '/postgresql.conf', 'r')
-        out_file = open(new_config_dir + '/postgresql.conf', 'w+')
-
-        for line in in_file:
-            out_file.write(line)
-
-        in_file.close()
-        out_file.close()
+        bundle.render(self.template_dir + '/postgresql.conf',
+                      'postgresql.conf')
 
     """
     Generate the security configuration. 
     """
-    def _generate_security_site(self, entry_point, new_config_dir):
-        in_file = open(self.template_dir + '/pg_hba.conf', 'r')
-        out_file = open(new_config_dir + '/pg_hba.conf', 'w+')
-
+    def _generate_security_site(self, entry_point, bundle):
         # We need to figure out the local mask so that clients can connect
         # to the statistics database. Right now we're guessing. 
         p = entry_point['db'].split(".")
         subnet = "%s.%s.%s.1/24" % (p[0], p[1], p[2])
         changes = { "LOCAL_IP" : entry_point['db'],
                     "LOCAL_MASK" : subnet }
-        for line in in_file:
-            s = Template(line).substitute(changes)
-            out_file.write(s)
-
-        in_file.close()
-        out_file.close()
+        bundle.render(self.template_dir + '/pg_hba.conf',
+                      'pg_hba.conf',
+                      changes)
 
     """
     Generate the hive site configuration. 
     """
-    def _generate_hive_site(self, entry_point, config, new_config_dir):
-        in_file = open(self.template_dir + '/hive-site.xml.template', 'r')
-        out_file = open(new_config_dir + '/hive-site.xml', 'w+')
-        
+    def _generate_hive_site(self, entry_point, config, bundle):
         changes = { "DB": entry_point['db'],
                     "USER": os.environ['USER'] }
-        for line in in_file:
-            s = Template(line).substitute(changes)
-            out_file.write(s)
-
-        in_file.close()
-        out_file.close()
+        bundle.render(self.template_dir + '/hive-site.xml.template',
+                      'hive-site.xml',
+                      changes)
 
     """
     Apply the configuration to the instances
@@ -141,31 +122,25 @@ class MetaStoreInitializer(object):
         # Remember the entry points
         entry_point['db'] = str(containers[0]['data_ip'])
 
-        # Create a new configuration directory, and place
-        # into the template directory. 
+        # Create a new configuration bundle. 
         config_dirs = []
-        new_config_dir = "/tmp/postgres/" + self._generate_config_dir(config.uuid)
-        hive_config_dir = "/tmp/hive/" + self._generate_config_dir(config.uuid)
-        try:
-            sh.mkdir('-p', new_config_dir)
-            sh.mkdir('-p', hive_config_dir)
-        except:
-            sys.stderr.write('could not create config dir ' + new_config_dir)
-
-        self._generate_postgres_site(new_config_dir)
-        self._generate_security_site(entry_point, new_config_dir)
-        self._generate_hive_site(entry_point, config, hive_config_dir)
+        bundle = ConfigBundle('postgres_' + self._generate_config_dir(config.uuid))
+        hive_bundle = ConfigBundle('hive_' + self._generate_config_dir(config.uuid))
+
+        self._generate_postgres_site(bundle)
+        self._generate_security_site(entry_point, bundle)
+        self._generate_hive_site(entry_point, config, hive_bundle)
 
         # Each container needs to point to a new config dir. 
         for c in containers:
-            config_files = new_config_dir + '/*'
+            config_files = bundle
             config_dirs.append([c['container'],
                                 config_files, 
                                 config.config_directory])
 
         # Transfer the Hive config
         for c in containers:
-            config_files = hive_config_dir + '/*'
+            config_files = hive_bundle
             config_dirs.append([c['container'],
                                 config_files, 
                                 config.hive_config])
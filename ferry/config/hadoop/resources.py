@@ -0,0 +1,126 @@
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+from ferry.config.system.info import HostShare, colocated
+
+# YARN needs at least this much memory (MB) on each node.
+MIN_NODE_MEMORY = 1024
+
+# Memory (MB) kept away from YARN for the OS and the Hadoop daemons.
+MIN_RESERVED = 512
+MAX_RESERVED = 8192
+
+# Heap (MB) of the resource manager, node manager, and history server.
+MIN_DAEMON_HEAP = 256
+MAX_DAEMON_HEAP = 2048
+
+# Fraction of a container that is given to the JVM heap.
+HEAP_FRACTION = 0.8
+
+def _min_container(mem):
+    """
+    Smallest container worth handing out on a node with this much memory.
+    """
+    if mem <= 4096:
+        return 256
+    elif mem <= 8192:
+        return 512
+    elif mem <= 24576:
+        return 1024
+    else:
+        return 2048
+
+def java_opts(mem):
+    return '-Xmx%dm' % int(HEAP_FRACTION * mem)
+
+class YarnResources(HostShare):
+    """
+    Memory (MB) and cores that YARN hands out on each node, and the
+    size of the MapReduce containers.
+    """
+    FIELDS = ['node_memory', 'vcores', 'container_memory', 'map_memory',
+              'reduce_memory', 'am_memory', 'daemon_heap']
+    OVERRIDES = { 'yarn_memory' : 'node_memory',
+                  'yarn_vcores' : 'vcores' }
+
+    def __init__(self):
+        self.node_memory = MIN_NODE_MEMORY
+        self.vcores = 1
+        self.container_memory = 512
+        self.map_memory = 512
+        self.reduce_memory = 1024
+        self.am_memory = 1024
+        self.daemon_heap = 1000
+
+    @staticmethod
+    def from_system(system, colocated=1, args=None):
+        """
+        Hand YARN the container's share of the host, less a reserve
+        for the OS and the daemons, and cut it into about two
+        MapReduce containers per core. Plan arguments (e.g.,
+        'map_memory') replace the derived sizes.
+        """
+        share, cores = HostShare.share(system, colocated)
+
+        r = YarnResources()
+        reserved = min(max(share / 5, MIN_RESERVED), MAX_RESERVED)
+        r.node_memory = share - reserved
+        if r.node_memory < MIN_NODE_MEMORY:
+            # Don't promise YARN memory the host doesn't have. Shrink
+            # the reserve instead, but keep at least half the share
+            # back on very small hosts.
+            r.node_memory = max(share - MIN_RESERVED, share / 2)
+            logging.warning("hadoop requires at least %dMB (%dMB available)" % (MIN_NODE_MEMORY, r.node_memory))
+        r.vcores = cores
+        r.daemon_heap = min(max(share / 8, MIN_DAEMON_HEAP), MAX_DAEMON_HEAP)
+        r._override(args, ['yarn_memory', 'yarn_vcores', 'daemon_heap'])
+
+        # Aim for about two containers per core, but don't make
+        # the containers too small to be useful.
+        min_container = _min_container(r.node_memory)
+        num = max(1, min(2 * r.vcores, r.node_memory / min_container))
+        r.container_memory = max(min_container, r.node_memory / num)
+        r._override(args, ['container_memory'])
+
+        r.map_memory = r.container_memory
+        r.reduce_memory = min(2 * r.container_memory, r.node_memory)
+        r.am_memory = min(2 * r.container_memory, r.node_memory)
+        r._override(args, ['map_memory', 'reduce_memory', 'am_memory'])
+        r._clamp(['container_memory', 'map_memory', 'reduce_memory', 'am_memory'])
+        return r
+
+    @staticmethod
+    def from_json(json):
+        return YarnResources()._load(json)
+
+    def _clamp(self, keys):
+        """
+        YARN rejects requests above its maximum allocation (the node
+        memory), so don't let the overrides ask for more than that.
+        """
+        for k in keys:
+            if getattr(self, k) > self.node_memory:
+                logging.warning("hadoop %s %dMB is larger than the node memory, using %dMB" % (k, getattr(self, k), self.node_memory))
+                setattr(self, k, self.node_memory)
+
+    def min_allocation(self):
+        return min(self.container_memory, self.map_memory, self.reduce_memory, self.am_memory)
+
+    def map_slots(self):
+        return max(1, self.node_memory / self.map_memory)
+
+    def reduce_slots(self):
+        return max(1, self.node_memory / self.reduce_memory)
@@ -0,0 +1,151 @@
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+from ferry.config.system.info import interleave
+
+STANDALONE = 'standalone'
+REPLICA = 'replica'
+SHARDED = 'sharded'
+MODES = [STANDALONE, REPLICA, SHARDED]
+
+# Clients always connect on the default port. In a sharded
+# cluster that is the mongos router, and the shard and config
+# servers use the usual ports for their roles.
+CLIENT_PORT = 27017
+SHARD_PORT = 27018
+CONFIG_PORT = 27019
+
+REPLICA_SET = 'rs0'
+CONFIG_SET = 'cfg'
+
+# A replica set can only have this many voting members.
+MAX_VOTES = 7
+
+# Number of config servers in a sharded cluster.
+NUM_CONFIG_SERVERS = 3
+
+class MongoCluster(object):
+    """
+    Assign the MongoDB roles to the containers. A single instance is a
+    standalone server, and multiple instances form a replica set by
+    default. A sharded cluster runs a shard member and a mongos router
+    on every container, and a config server on a few of them. Each
+    shard is a replica set with 'shard_replicas' members (picked with
+    the plan arguments).
+    """
+    def __init__(self, containers, args=None):
+        self.mode = STANDALONE
+        if len(containers) > 1:
+            self.mode = REPLICA
+        if args and 'mode' in args:
+            mode = str(args['mode'])
+            if not mode in MODES:
+                logging.warning("unknown mongodb mode %s, using %s" % (mode, self.mode))
+            elif mode == STANDALONE and len(containers) > 1:
+                logging.warning("mongodb standalone mode needs a single instance, using %s" % self.mode)
+            else:
+                self.mode = mode
+
+        self.head = containers[0]
+        self.replica_sets = {}
+        self.config_servers = []
+        self.routers = []
+        self.shards = []
+
+        # Interleave the hosts, so that the members of a set
+        # (and the config servers) are on different hosts.
+        ordered = interleave(containers)
+        if self.mode == REPLICA:
+            self.replica_sets[REPLICA_SET] = [self.head] + [c for c in ordered if c != self.head]
+        elif self.mode == SHARDED:
+            replicas = 1
+            if args and 'shard_replicas' in args:
+                replicas = max(int(args['shard_replicas']), 1)
+            if len(containers) % replicas != 0:
+                logging.warning("mongodb: %d instances is not a multiple of %d shard replicas" % (len(containers), replicas))
+                replicas = 1
+
+            for i in range(0, len(ordered), replicas):
+                name = 'shard%d' % (i / replicas)
+                self.shards.append(name)
+                self.replica_sets[name] = ordered[i:i + replicas]
+
+            self.config_servers = ordered[:min(NUM_CONFIG_SERVERS, len(ordered))]
+            self.replica_sets[CONFIG_SET] = self.config_servers
+            self.routers = list(containers)
+
+    def port(self, name):
+        """
+        Port of the mongod serving the replica set.
+        """
+        if name == CONFIG_SET:
+            return CONFIG_PORT
+        elif self.mode == SHARDED:
+            return SHARD_PORT
+        return CLIENT_PORT
+
+    def replica_set(self, container):
+        """
+        Name of the (data) replica set that the container belongs to.
+        """
+        for name, members in self.replica_sets.items():
+            if name != CONFIG_SET and container in members:
+                return name
+        return None
+
+    def members(self, name):
+        return ["%s:%d" % (c['data_ip'], self.port(name)) for c in self.replica_sets[name]]
+
+    def replica_config(self, name):
+        """
+        Replica set configuration passed to rs.initiate. The first
+        member is preferred as the primary.
+        """
+        members = []
+        for i, host in enumerate(self.members(name)):
+            m = { '_id' : i, 'host' : host }
+            if i == 0:
+                m['priority'] = 2
+            elif i >= MAX_VOTES:
+                m['votes'] = 0
+                m['priority'] = 0
+            members.append(m)
+
+        config = { '_id' : name, 'members' : members }
+        if name == CONFIG_SET:
+            config['configsvr'] = True
+        return config
+
+    def seeds(self):
+        """
+        Addresses that clients can connect to.
+        """
+        if self.mode == SHARDED:
+            servers = self.routers
+        elif self.mode == REPLICA:
+            servers = self.replica_sets[REPLICA_SET]
+        else:
+            servers = [self.head]
+        return ["%s:%d" % (c['data_ip'], CLIENT_PORT) for c in servers]
+
+    def url(self):
+        url = "mongodb://" + ",".join(self.seeds()) + "/"
+        if self.mode == REPLICA:
+            url += "?replicaSet=" + REPLICA_SET
+        return url
+
+    def json(self):
+        return dict((name, self.members(name)) for name in self.replica_sets.keys())
@@ -13,13 +13,14 @@
 # limitations under the License.
 #
 
+import base64
 import json
 import logging
 import os
-import sh
 import sys
 import time
-from string import Template
+from ferry.config.bundle import ConfigBundle
+from ferry.config.mongo.cluster import MongoCluster, STANDALONE, REPLICA, SHARDED, REPLICA_SET, CONFIG_SET
 
 class MongoInitializer(object):
     def __init__(self, system):
@@ -41,16 +42,44 @@ class MongoInitializer(object):
 
     def _execute_service(self, containers, entry_point, fabric, cmd):
         """
-        Start the service on the containers. 
+        Start the service on the containers. Replica sets are initiated
+        once all the mongod servers are running, and the mongos routers
+        are started once the config servers are ready. 
         """
         all_output = {}
+        trusted = False
         for c in containers:
-            if c.args:
-                args = c.args
+            if c.args == 'trust':
+                args = 'trust'
+                trusted = True
             else:
                 args = 'notrust'
             output = fabric.cmd([c], '/service/sbin/startnode %s %s' % (cmd, args))
             all_output = dict(all_output.items() + output.items())
+
+        if cmd != "stop" and not trusted:
+            mode = entry_point.get('mode', STANDALONE)
+            if mode == STANDALONE:
+                head = containers
+            else:
+                head = [c for c in containers if c.internal_ip == entry_point['mongo']]
+            if cmd == "start":
+                for name, members in entry_point.get('replica_sets', {}).items():
+                    port = members[0].split(":")[1]
+                    first = [c for c in containers if c.internal_ip == members[0].split(":")[0]]
+                    output = fabric.cmd(first, '/service/sbin/startnode initiate %s %s' % (name, port))
+                    all_output = dict(all_output.items() + output.items())
+            if mode == SHARDED:
+                output = fabric.cmd(containers, '/service/sbin/startnode mongos')
+                all_output = dict(all_output.items() + output.items())
+            if cmd == "start":
+                # The localhost exception only lets us create the administrator,
+                # so the shards are added afterwards using that account. 
+                output = fabric.cmd(head, '/service/sbin/startnode admin')
+                all_output = dict(all_output.items() + output.items())
+                if mode == SHARDED:
+                    output = fabric.cmd(head, '/service/sbin/startnode shards')
+                    all_output = dict(all_output.items() + output.items())
             
         # Now wait a couple seconds to make sure
         # everything has started.
@@ -87,7 +116,9 @@ class MongoInitializer(object):
         """
         Ports necessary to get things working. 
         """
-        return [MongoConfig.MONGO_PORT]
+        return [MongoConfig.MONGO_PORT,
+                MongoConfig.SHARD_PORT,
+                MongoConfig.CONFIG_PORT]
 
     def get_total_instances(self, num_instances, layers):
         instances = []
@@ -105,7 +136,7 @@ class MongoInitializer(object):
         """
         return MongoConfig(num)
 
-    def _generate_mongo_config(self, host_dir, config, arg):
+    def _generate_mongo_config(self, bundle, config, arg, cluster=None, container=None):
         """
         Generate the MongoDB configuration file. 
         """
@@ -114,18 +145,72 @@ class MongoInitializer(object):
         else:
             conf_file = "mongodb.conf"
 
-        in_file = open(self.template_dir + '/%s.template' % conf_file, 'r')
-        out_file = open(host_dir + '/%s' % conf_file, 'w+')
-
         changes = { "MONGO_LOG":config.log_directory, 
-                    "MONGO_DATA":config.data_directory }
+                    "MONGO_DATA":config.data_directory,
+                    "MONGO_PORT":config.mongo_port,
+                    "LOG_NAME":"mongodb.log",
+                    "KEY_FILE":"",
+                    "CLUSTER":"" }
+
+        name = None
+        if cluster and cluster.mode != STANDALONE:
+            name = cluster.replica_set(container)
+            changes["MONGO_PORT"] = cluster.port(name)
+            changes["KEY_FILE"] = "   keyFile: \"%s\"" % config.key_file
+            changes["CLUSTER"] = "replication:\n   replSetName: %s\n" % name
+            if cluster.mode == SHARDED:
+                changes["CLUSTER"] += "sharding:\n   clusterRole: shardsvr\n"
+
+        bundle.render(self.template_dir + '/%s.template' % conf_file,
+                      conf_file,
+                      changes)
+
+        if name and cluster.replica_sets[name][0] == container:
+            self._generate_initiate(bundle, cluster, name)
+
+    def _generate_initiate(self, bundle, cluster, name):
+        """
+        Generate the script that initiates the replica set. This
+        is run on the first member of the set. 
+        """
+        changes = { "CONFIG":json.dumps(cluster.replica_config(name)) }
+        bundle.render(self.template_dir + '/initiate.js.template',
+                      '%s.js' % name,
+                      changes)
 
-        for line in in_file:
-            s = Template(line).substitute(changes)
-            out_file.write(s)
+    def _generate_sharding_config(self, bundle, config, cluster, container):
+        """
+        Generate the config server and mongos router configurations. 
+        The config servers keep their data next to the shard data. 
+        """
+        if container in cluster.config_servers:
+            changes = { "MONGO_LOG":config.log_directory, 
+                        "MONGO_DATA":config.data_directory + "configdb",
+                        "MONGO_PORT":cluster.port(CONFIG_SET),
+                        "LOG_NAME":"configsvr.log",
+                        "KEY_FILE":"   keyFile: \"%s\"" % config.key_file,
+                        "CLUSTER":"replication:\n   replSetName: %s\nsharding:\n   clusterRole: configsvr\n" % CONFIG_SET }
+            bundle.render(self.template_dir + '/mongodb.conf.template',
+                          'configsvr.conf',
+                          changes)
+            if cluster.config_servers[0] == container:
+                self._generate_initiate(bundle, cluster, CONFIG_SET)
 
-        out_file.close()
-        in_file.close()
+        changes = { "MONGO_LOG":config.log_directory, 
+                    "MONGO_PORT":config.mongo_port,
+                    "KEY_FILE":config.key_file,
+                    "CONFIG_DB":"%s/%s" % (CONFIG_SET, ",".join(cluster.members(CONFIG_SET))) }
+        bundle.render(self.template_dir + '/mongos.conf.template',
+                      'mongos.conf',
+                      changes)
+
+        if container == cluster.head:
+            shards = ""
+            for name in cluster.shards:
+                shards += "sh.addShard(\"%s/%s\");\n" % (name, ",".join(cluster.members(name)))
+            bundle.render(self.template_dir + '/shards.js.template',
+                          'shards.js',
+                          { "SHARDS":shards })
 
     def apply(self, config, containers):
         """
@@ -138,11 +223,7 @@ class MongoInitializer(object):
         entry_point['mongo'] = containers[0]['data_ip']
         entry_point['ip'] = containers[0]['manage_ip']
 
-        new_config_dir = "/tmp/" + self._generate_config_dir(config.uuid)
-        try:
-            sh.mkdir('-p', new_config_dir)
-        except:
-            sys.stderr.write('could not create config dir ' + new_config_dir)
+        bundle = ConfigBundle(self._generate_config_dir(config.uuid))
 
         # This file records all instances so that we can
         # generate the hosts file. 
@@ -150,13 +231,34 @@ class MongoInitializer(object):
         for server in containers:
             entry_point['instances'].append([server['data_ip'], server['host_name']])
 
+        bundles = {}
         if not 'storage' in containers[0]:
             # This is being called as a storage service. 
             # The client service doesn't do anything right now. 
-            if 'args' in containers[0] and containers[0]['args']:
-                self._generate_mongo_config(new_config_dir, config, containers[0]['args'])
+            args = containers[0].get('args')
+            if args == 'trust':
+                self._generate_mongo_config(bundle, config, 'trust')
             else:
-                self._generate_mongo_config(new_config_dir, config, 'notrust')
+                args = args or {}
+                cluster = MongoCluster(containers, args)
+                entry_point['mode'] = cluster.mode
+                entry_point['seeds'] = ",".join(cluster.seeds())
+                entry_point['mongo_url'] = cluster.url()
+                if cluster.mode == STANDALONE:
+                    self._generate_mongo_config(bundle, config, 'notrust')
+                else:
+                    # The members of the cluster authenticate
+                    # each other using a shared key. 
+                    bundle.add('keyfile', base64.b64encode(os.urandom(756)), 0400)
+                    entry_point['replica_sets'] = cluster.json()
+                    if cluster.mode == REPLICA:
+                        entry_point['replica_set'] = REPLICA_SET
+
+                    for c in containers:
+                        bundles[c['data_ip']] = bundle.copy(self._generate_config_dir(config.uuid) + '_' + c['host_name'])
+                        self._generate_mongo_config(bundles[c['data_ip']], config, 'notrust', cluster, c)
+                        if cluster.mode == SHARDED:
+                            self._generate_sharding_config(bundles[c['data_ip']], config, cluster, c)
 
             # Expose the login info. 
             output = self.fabric.cmd_raw(key = containers[0]['container'].privatekey, 
@@ -170,7 +272,7 @@ class MongoInitializer(object):
 
         # Transfer the configuration. 
         for c in containers:
-            config_files = new_config_dir + '/*'
+            config_files = bundles.get(c['data_ip'], bundle)
             config_dirs.append([c['container'],
                                 config_files, 
                                 config.config_directory])
@@ -182,6 +284,8 @@ class MongoConfig(object):
     config_directory = '/service/conf/mongodb/'
     data_directory = '/service/data/'
     MONGO_PORT = '27017'
+    SHARD_PORT = '27018'
+    CONFIG_PORT = '27019'
 
     def __init__(self, num):
         self.num = num
@@ -189,3 +293,4 @@ class MongoConfig(object):
         self.config_directory = MongoConfig.config_directory
         self.log_directory = MongoConfig.log_directory
         self.data_directory = MongoConfig.data_directory
+        self.key_file = MongoConfig.config_directory + 'keyfile'
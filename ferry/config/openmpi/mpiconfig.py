@@ -14,9 +14,8 @@
 #
 
 import logging
-import sh
 import sys
-from string import Template
+from ferry.config.bundle import ConfigBundle
 
 class OpenMPIInitializer(object):
     def __init__(self, system):
@@ -99,23 +98,17 @@ class OpenMPIInitializer(object):
 
         return config
 
-    def _generate_mca_params(self, config, new_config_dir):
+    def _generate_mca_params(self, config, bundle):
         """
         Generate the mca-params configuration. 
         """
-        in_file = open(self.template_dir + '/openmpi-mca-params.conf', 'r')
-        out_file = open(new_config_dir + '/openmpi-mca-params.conf', 'w+')
-
         changes = { "BTL_PORT_MIN": config.btl_port_min,
                     "BTL_PORT_RANGE": config.btl_port_range,
                     "OOB_PORT_MIN": config.oob_port_min,
                     "OOB_PORT_RANGE": config.oob_port_range }
-        for line in in_file:
-            s = Template(line).substitute(changes)
-            out_file.write(s)
-
-        in_file.close()
-        out_file.close()
+        bundle.render(self.template_dir + '/openmpi-mca-params.conf',
+                      'openmpi-mca-params.conf',
+                      changes)
 
     def _find_mpi_storage(self, containers):
         """
@@ -142,11 +135,7 @@ class OpenMPIInitializer(object):
         entry_point = { 'type' : 'openmpi' }
         config_dirs = []
 
-        new_config_dir = "/tmp/" + self._generate_config_dir(config.uuid)
-        try:
-            sh.mkdir('-p', new_config_dir)
-        except:
-            sys.stderr.write('could not create config dir ' + new_config_dir)
+        bundle = ConfigBundle(self._generate_config_dir(config.uuid))
 
         # For now the MPI client assumes there is only one storage and that it is
         # a Gluster end point. 
@@ -171,13 +160,11 @@ class OpenMPIInitializer(object):
                 entry_point['ip'] = containers[0]['manage_ip']
                 compute = self._find_mpi_compute(containers)
                 if compute and 'hosts' in compute:
-                    with open(new_config_dir + '/hosts', 'w+') as hosts_file:
-                        for c in compute['hosts']:
-                            hosts_file.write(c[0] + "\n")
-                    self._generate_mca_params(config, new_config_dir)
+                    bundle.add('hosts', ''.join([c[0] + "\n" for c in compute['hosts']]))
+                    self._generate_mca_params(config, bundle)
 
             for c in containers:
-                config_files = new_config_dir + '/*'
+                config_files = bundle
                 config_dirs.append([c['container'],
                                     config_files, 
                                     config.config_directory])
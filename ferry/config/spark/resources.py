@@ -0,0 +1,103 @@
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+from ferry.config.system.info import HostShare
+
+# Spark workers need at least this much memory (MB).
+MIN_WORKER_MEMORY = 512
+
+# Memory (MB) kept away from the executors for the OS and the daemons.
+MIN_RESERVED = 1024
+MAX_RESERVED = 8192
+
+# Largest driver heap (MB) we give out by default.
+MAX_DRIVER_MEMORY = 4096
+
+SERIALIZERS = { 'kryo' : 'org.apache.spark.serializer.KryoSerializer',
+                'java' : 'org.apache.spark.serializer.JavaSerializer' }
+
+class SparkResources(HostShare):
+    """
+    Memory (MB) and cores of each Spark worker, the executor and driver
+    sizes, and the defaults for the jobs.
+    """
+    FIELDS = ['num_workers', 'worker_memory', 'worker_cores',
+              'executor_memory', 'driver_memory', 'parallelism']
+
+    def __init__(self):
+        self.num_workers = 1
+        self.worker_memory = MIN_WORKER_MEMORY
+        self.worker_cores = 1
+        self.executor_memory = MIN_WORKER_MEMORY
+        self.driver_memory = 512
+        self.parallelism = 2
+        self.serializer = 'kryo'
+
+    @staticmethod
+    def from_system(system, colocated=1, num_workers=1, args=None):
+        """
+        Give each worker the container's share of the host, less a
+        reserve for the OS and the daemons, and size the executor and
+        the default parallelism from the workers. Plan arguments (e.g.,
+        'worker_memory') replace the derived sizes.
+        """
+        mem, cores = HostShare.share(system, colocated)
+
+        r = SparkResources()
+        r.num_workers = max(num_workers, 1)
+        r.worker_memory = mem - min(max(mem / 5, MIN_RESERVED), MAX_RESERVED)
+        if r.worker_memory < MIN_WORKER_MEMORY:
+            logging.warning("spark requires at least %dMB (%dMB available)" % (MIN_WORKER_MEMORY, r.worker_memory))
+            r.worker_memory = MIN_WORKER_MEMORY
+        r.worker_cores = cores
+        r._override(args, ['worker_memory', 'worker_cores'])
+
+        # In standalone mode an application gets one executor per worker,
+        # so let it use the whole worker. Spark recommends 2-3 tasks per core.
+        r.executor_memory = r.worker_memory
+        r.driver_memory = max(512, min(r.worker_memory / 4, MAX_DRIVER_MEMORY))
+        r.parallelism = 2 * r.worker_cores * r.num_workers
+        r._override(args, ['executor_memory', 'driver_memory', 'parallelism'])
+
+        if args and 'serializer' in args:
+            if str(args['serializer']) in SERIALIZERS:
+                r.serializer = str(args['serializer'])
+            else:
+                logging.warning("unknown spark serializer " + str(args['serializer']))
+        return r
+
+    @staticmethod
+    def from_json(json):
+        r = SparkResources()._load(json)
+        if 'serializer' in json:
+            r.serializer = str(json['serializer'])
+        return r
+
+    def changes(self):
+        """
+        Values substituted into spark-env.sh and spark-defaults.conf.
+        """
+        return { "WORKER_MEMORY":self.worker_memory,
+                 "WORKER_CORES":self.worker_cores,
+                 "EXECUTOR_MEMORY":self.executor_memory,
+                 "DRIVER_MEMORY":self.driver_memory,
+                 "PARALLELISM":self.parallelism,
+                 "SERIALIZER":SERIALIZERS[self.serializer] }
+
+    def json(self):
+        j = HostShare.json(self)
+        j['serializer'] = self.serializer
+        return j
@@ -15,10 +15,11 @@
 
 import logging
 import os
-import sh
 import sys
 import time
-from string import Template
+from ferry.config.bundle import ConfigBundle
+from ferry.config.spark.resources import SparkResources
+from ferry.config.system.info import colocated
 
 class SparkInitializer(object):
     """
@@ -26,6 +27,7 @@ class SparkInitializer(object):
     Param user The user login for the git repo
     """
     def __init__(self, system):
+        self.system = system
         self.template_dir = None
         self.template_repo = None
 
@@ -42,14 +44,12 @@ class SparkInitializer(object):
         """
         Start the service on the containers. 
         """
-        all_output = {}
         master = entry_point['master']
-        for c in containers:
-            if c.host_name == master:
-                output = fabric.cmd([c], '/service/sbin/startnode %s master' % cmd)
-            else:
-                output = fabric.cmd([c], '/service/sbin/startnode %s slave' % cmd)
-            all_output = dict(all_output.items() + output.items())
+        masters = [c for c in containers if c.host_name == master]
+        slaves = [c for c in containers if c.host_name != master]
+        all_output = fabric.cmd(masters, '/service/sbin/startnode %s master' % cmd)
+        output = fabric.cmd(slaves, '/service/sbin/startnode %s slave' % cmd)
+        all_output = dict(all_output.items() + output.items())
 
         # Now wait a couple seconds to make sure
         # everything has started.
@@ -108,24 +108,28 @@ class SparkInitializer(object):
         """
         return SparkConfig(num)
 
-    def _generate_spark_env(self, new_config_dir, master):
+    def _generate_spark_env(self, bundle, master, resources):
         """
-        Generate the core-site configuration for a local filesystem. 
+        Generate the spark-env configuration. 
         """
-        in_file = open(self.template_dir + '/spark_env.sh.template', 'r')
-        out_file = open(new_config_dir + '/spark_env.sh', 'w+')
-
-        changes = { "MASTER": master }
-        for line in in_file:
-            s = Template(line).substitute(changes)
-            out_file.write(s)
-
-        in_file.close()
-        out_file.close()
-
         # The Spark env file is a shell script, so should be
         # executable by all. 
-        os.chmod(new_config_dir + '/spark_env.sh', 0755)
+        changes = { "MASTER": master }
+        changes.update(resources.changes())
+        bundle.render(self.template_dir + '/spark_env.sh.template',
+                      'spark-env.sh',
+                      changes,
+                      0755)
+
+    def _generate_spark_defaults(self, bundle, master, resources):
+        """
+        Generate the default job properties. 
+        """
+        changes = { "MASTER": master }
+        changes.update(resources.changes())
+        bundle.render(self.template_dir + '/spark-defaults.conf.template',
+                      'spark-defaults.conf',
+                      changes)
 
     def apply(self, config, containers):
         """
@@ -135,11 +139,7 @@ class SparkInitializer(object):
         entry_point['ip'] = containers[0]['manage_ip']
         config_dirs = []
 
-        new_config_dir = "/tmp/" + self._generate_config_dir(config.uuid)
-        try:
-            sh.mkdir('-p', new_config_dir)
-        except:
-            sys.stderr.write('could not create config dir ' + new_config_dir)
+        bundle = ConfigBundle(self._generate_config_dir(config.uuid))
 
         # This file records all instances so that we can
         # generate the hosts file. 
@@ -149,23 +149,39 @@ class SparkInitializer(object):
 
         if not 'compute' in containers[0]:
             # This is being called as a compute service. 
-            slave_file = open(new_config_dir + '/slaves', 'w+')
             entry_point['master'] = containers[0]['host_name']
             entry_point['instances'] = []
             master = entry_point['master']
+            slaves = ""
             for server in containers:
                 if server != master:
-                    slave_file.write("%s\n" % server['host_name'])
-            slave_file.close()
+                    slaves += "%s\n" % server['host_name']
+            bundle.add('slaves', slaves)
+
+            # Size the workers and let the clients know. 
+            resources = SparkResources.from_system(self.system,
+                                                   colocated(containers),
+                                                   len(containers),
+                                                   containers[0].get('args'))
+            entry_point['resources'] = resources.json()
         else:
             # This is being called as a client service. 
             # For the client, also include the host/IP of the compute service. 
             compute = containers[0]['compute'][0]
             entry_point['master'] = compute['master']
 
+            # Use the same job defaults as the cluster. 
+            if 'resources' in compute:
+                resources = SparkResources.from_json(compute['resources'])
+            else:
+                resources = SparkResources.from_system(self.system, 1, 1, containers[0].get('args'))
+
+        self._generate_spark_env(bundle, entry_point['master'], resources)
+        self._generate_spark_defaults(bundle, entry_point['master'], resources)
+
         # Transfer the configuration. 
         for c in containers:
-            config_files = new_config_dir + '/*'
+            config_files = bundle
             config_dirs.append([c['container'],
                                 config_files, 
                                 config.config_directory])
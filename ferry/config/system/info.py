@@ -13,10 +13,48 @@
 # limitations under the License.
 #
 
+import collections
 import os
 import sys
 from subprocess import Popen, PIPE
 
+def host_of(container):
+    """
+    The host that the container runs on. Cloud containers are managed
+    through the address of their instance, and local containers all
+    run on the same docker host. 
+    """
+    return getattr(container.get('container'), 'manage_ip', None) or 'local'
+
+def hosts_of(containers):
+    """
+    Group the containers by the host that they run on (in the
+    order that the hosts first appear). 
+    """
+    hosts = collections.OrderedDict()
+    for c in containers:
+        hosts.setdefault(host_of(c), []).append(c)
+    return hosts
+
+def interleave(containers):
+    """
+    Order the containers round-robin across the hosts, so that
+    neighbouring containers run on different hosts. 
+    """
+    hosts = [list(h) for h in hosts_of(containers).values()]
+    ordered = []
+    while len(ordered) < len(containers):
+        for h in hosts:
+            if len(h) > 0:
+                ordered.append(h.pop(0))
+    return ordered
+
+def colocated(containers):
+    """
+    Largest number of these containers that share the same host.
+    """
+    return max([len(h) for h in hosts_of(containers).values()] or [1])
+
 class System(object):
     def get_total_memory(self):
         """
@@ -41,3 +79,37 @@ class System(object):
         cmd = "nproc"
         output = Popen(cmd, stdout=PIPE, shell=True).stdout.read()
         return int(output.strip())
+
+class HostShare(object):
+    """
+    Base of the classes that size a service from its share of the
+    host. FIELDS are the (integer) settings saved in the connector
+    entry point, and OVERRIDES renames the plan arguments that don't
+    have the same name as the setting they replace. 
+    """
+    FIELDS = []
+    OVERRIDES = {}
+
+    @staticmethod
+    def share(system, colocated=1):
+        """
+        Memory (MB) and cores of each container sharing the host. 
+        """
+        colocated = max(colocated, 1)
+        mem = int(system.get_total_memory()) / colocated
+        cores = max(int(system.get_num_cores()) / colocated, 1)
+        return mem, cores
+
+    def _override(self, args, keys):
+        for k in keys:
+            if args and k in args:
+                setattr(self, self.OVERRIDES.get(k, k), int(args[k]))
+
+    def _load(self, json):
+        for k in self.FIELDS:
+            if k in json and json[k] is not None:
+                setattr(self, k, int(json[k]))
+        return self
+
+    def json(self):
+        return dict((k, getattr(self, k)) for k in self.FIELDS)
@@ -0,0 +1,75 @@
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import threading
+from string import Template
+
+class TemplateRegistry(object):
+    """
+    Load and compile each configuration template once per process. The
+    generators render whole files in memory instead of re-reading the
+    template and building a new Template for every line of every file
+    for every container. 
+    """
+    def __init__(self):
+        self.templates = {}
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        """
+        Get the compiled template. 
+        """
+        path = os.path.normpath(path)
+        with self.lock:
+            if not path in self.templates:
+                with open(path, 'r') as f:
+                    self.templates[path] = Template(f.read())
+            return self.templates[path]
+
+    def render(self, path, changes=None):
+        """
+        Render the template. Without any changes, the file
+        is returned as is (e.g., for shell scripts). 
+        """
+        template = self.get(path)
+        if changes is None:
+            return template.template
+        return template.substitute(changes)
+
+    def write(self, path, out_path, changes=None):
+        """
+        Render the template into the output file. 
+        """
+        with open(out_path, 'w+') as f:
+            f.write(self.render(path, changes))
+
+    def clear(self):
+        """
+        Forget all the templates (e.g., after they've been modified). 
+        """
+        with self.lock:
+            self.templates = {}
+
+_registry = TemplateRegistry()
+
+def render_template(path, changes=None):
+    return _registry.render(path, changes)
+
+def write_template(path, out_path, changes=None):
+    _registry.write(path, out_path, changes)
+
+def clear_templates():
+    _registry.clear()
@@ -13,9 +13,8 @@
 # limitations under the License.
 #
 
-import sh
 import sys
-from string import Template
+from ferry.config.bundle import ConfigBundle
 
 class TitanInitializer(object):
     """
@@ -76,30 +75,22 @@ class TitanInitializer(object):
         """
         return TitanConfig(num)
 
-    def _apply_rexster(self, host_dir, storage_entry, container):
-        in_file = open(self.template_dir + '/rexster.xml.template', 'r')
-        out_file = open(host_dir + '/rexster.xml', 'w+')
+    def _apply_rexster(self, bundle, storage_entry, container):
         changes = { "GRAPH_BACKEND":storage_entry['type'], 
                     "GRAPH_HOST":storage_entry['seed'],
                     "GRAPH_NAME":container['args']['db'],
                     "IP":container['data_ip']}
-        for line in in_file:
-            s = Template(line).substitute(changes)
-            out_file.write(s)
-        out_file.close()
-        in_file.close()
-
-    def _apply_titan(self, host_dir, storage_entry, container):
-        in_file = open(self.template_dir + '/titan.properties', 'r')
-        out_file = open(host_dir + '/titan.properties', 'w+')
+        bundle.render(self.template_dir + '/rexster.xml.template',
+                      'rexster.xml',
+                      changes)
+
+    def _apply_titan(self, bundle, storage_entry, container):
         changes = { "BACKEND":"cassandrathrift", 
                     "DB":container['args']['db'],
                     "IP":storage_entry['seed']}
-        for line in in_file:
-            s = Template(line).substitute(changes)
-            out_file.write(s)
-        out_file.close()
-        in_file.close()
+        bundle.render(self.template_dir + '/titan.properties',
+                      'titan.properties',
+                      changes)
 
     """
     Apply the configuration to the instances
@@ -115,19 +106,15 @@ class TitanInitializer(object):
         config_dirs = []
         try:
             for c in containers:
-                host_dir = "/tmp/" + self._generate_config_dir(config.uuid, c)
-                try:
-                    sh.mkdir('-p', host_dir)
-                except:
-                    sys.stderr.write('could not create config dir ' + host_dir)
+                bundle = ConfigBundle(self._generate_config_dir(config.uuid, c))
 
-                self._apply_rexster(host_dir, storage_entry, c)
-                self._apply_titan(host_dir, storage_entry, c)
+                self._apply_rexster(bundle, storage_entry, c)
+                self._apply_titan(bundle, storage_entry, c)
 
                 # The config dirs specifies what to transfer over. We want to 
                 # transfer over specific files into a directory. 
                 config_dirs.append([c['container'], 
-                                    host_dir + '/*', 
+                                    bundle, 
                                     config.config_directory])
 
         except IOError as err:
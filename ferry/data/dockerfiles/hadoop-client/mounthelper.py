@@ -4,17 +4,24 @@ import sys
 import logging
 from subprocess import Popen, PIPE
 
+# FUSE options for the gluster client. Leave the caching to the
+# performance translators of the volume (io-cache, read-ahead, and
+# write-behind), let the kernel cache the attributes and directory
+# entries for a while, and fetch them with readdirp.
+MOUNT_OPTIONS = 'direct-io-mode=disable,use-readdirp=yes,attribute-timeout=10,entry-timeout=10,log-level=WARNING'
+
 def mkdir(directory):
     if not os.path.isdir(directory):
         cmd = 'mkdir -p %s' % directory
         Popen(cmd, shell=True)
 
-def mount(entry_point, mount_point):
+def mount(entry_point, mount_point, options=MOUNT_OPTIONS):
     # Check if the mount point exists. If not
     # go ahead and create it. 
     # mount -t glusterfs entry_point mount_point
-    cmd = 'mount -t glusterfs %s %s' % (entry_point,
-                                        mount_point)
+    cmd = 'mount -t glusterfs -o %s %s %s' % (options,
+                                              entry_point,
+                                              mount_point)
     output = Popen(cmd, stdout=PIPE, shell=True).stdout.read()
     logging.info(cmd)
     logging.info(output)
@@ -31,7 +38,10 @@ def umount(mount_point):
 cmd = sys.argv[1]
 if cmd == "mount":
     entry = sys.argv[2]
+    options = MOUNT_OPTIONS
+    if len(sys.argv) > 3:
+        options = sys.argv[3]
     mkdir('/service/data')
-    mount(entry, '/service/data')
+    mount(entry, '/service/data', options)
 elif cmd == "umount":
     umount('/service/data')
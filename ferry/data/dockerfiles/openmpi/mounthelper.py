@@ -4,11 +4,18 @@ import sys
 import logging
 from subprocess import Popen, PIPE
 
-def mount(entry_point, mount_point):
+# FUSE options for the gluster client. Leave the caching to the
+# performance translators of the volume (io-cache, read-ahead, and
+# write-behind), let the kernel cache the attributes and directory
+# entries for a while, and fetch them with readdirp.
+MOUNT_OPTIONS = 'direct-io-mode=disable,use-readdirp=yes,attribute-timeout=10,entry-timeout=10,log-level=WARNING'
+
+def mount(entry_point, mount_point, options=MOUNT_OPTIONS):
     # Check if the mount point exists. If not
     # go ahead and create it. 
-    cmd = 'mount -t glusterfs %s %s' % (entry_point,
-                                        mount_point)
+    cmd = 'mount -t glusterfs -o %s %s %s' % (options,
+                                              entry_point,
+                                              mount_point)
     proc = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=True)
     output = proc.stdout.read()
     err = proc.stderr.read()
@@ -25,6 +32,9 @@ def umount(mount_point):
 cmd = sys.argv[1]
 if cmd == "mount":
     entry = sys.argv[2]
-    mount(entry, '/service/data')
+    options = MOUNT_OPTIONS
+    if len(sys.argv) > 3:
+        options = sys.argv[3]
+    mount(entry, '/service/data', options)
 elif cmd == "umount":
     umount('/service/data')
@@ -14,12 +14,12 @@
 #
 
 from ferry.fabric.com import robust_com
+from ferry.fabric.execute import execute, spawn
 import json
 import logging
 import os
 import re
 import sys
-from subprocess import Popen, PIPE
 
 DOCKER_SOCK='unix:////var/run/ferry.sock'
 
@@ -119,56 +119,54 @@ class DockerCLI(object):
         self.lxc_flag = ' -lxc-conf'
         self.disable_net = ' -n=false'
         self.host_flag = ' -h'
+        self.dns_flag = ' -dns'
         self.fs_flag = ' -s'
         self.env_flag = ' -e'
         self.registry = registry
         self.docker_user = 'root'
+        self.sessions = None
 
-    def _execute_cmd(self, cmd, server=None, user=None, read_output=True):
+    def _execute_cmd(self, cmd, server=None, user=None, read_output=True, timeout=None, on_output=None):
         """
         Execute the command on the server via ssh. 
         """
 
-        if not server:
-            # The server is not supplied, so just execute
-            # the command locally. 
-            proc = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=True)
-            if read_output:
-                out = proc.stdout.read()
-                err = proc.stderr.read()
-        else:
-            # Do not store results in hosts file or warn about 
-            # changing ssh keys. Also use the key given to us by the fabric. 
-            flags = " -o ConnectTimeout=10 -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null "
-            flags += " -i " + self.key
-
+        if server:
             # If the user is given explicitly use that. Otherwise use the
             # default user (which is probably root). 
-            if user:
-                ip = user + '@' + server
+            if not user:
+                user = self.docker_user
+            ip = user + '@' + server
+
+            # Do not store results in hosts file or warn about 
+            # changing ssh keys. Also use the key given to us by the fabric. 
+            # If the fabric keeps pooled ssh sessions, reuse those. 
+            if self.sessions:
+                flags = " " + self.sessions.opts(self.key, server, user) + " "
             else:
-                ip = self.docker_user + '@' + server
+                flags = " -o ConnectTimeout=10 -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null "
+            flags += " -i " + self.key
             flags += " -t -t " + ip
 
             # Wrap the command around an ssh command. 
-            ssh = 'ssh ' + flags + ' \'%s\'' % cmd
-            logging.warning(ssh)
-
+            cmd = 'ssh ' + flags + ' \'%s\'' % cmd
+            logging.warning(cmd)
+
+        if not read_output:
+            # The user does not want us to wait for the output. The
+            # output is still drained in the background (and optionally
+            # handed to the callback) so the command never blocks. 
+            return spawn(cmd, on_stdout=on_output, on_stderr=on_output)
+        elif server:
             # All the possible errors that might happen when
-            # we try to connect via ssh. 
-            if read_output:
-                out, err, success = robust_com(ssh)
-            else:
-                # The user does not want us to read the output.
-                # That means we can't really check for errors :(
-                proc = Popen(ssh, stdout=PIPE, stderr=PIPE, shell=True)
-
-        if read_output:
-            # Read both the standard out and error. 
+            # we try to connect via ssh are handled here. 
+            out, err, success = robust_com(cmd, timeout=timeout, host=server)
             return out, err
         else:
-            # The user does not want to read the output.
-            return proc
+            # The server is not supplied, so just execute
+            # the command locally. 
+            result = execute(cmd, timeout=timeout, on_stdout=on_output)
+            return result.stdout, result.stderr
         
     def get_fs_type(self, server=None):
         """
@@ -190,18 +188,23 @@ class DockerCLI(object):
         output, _ = self._execute_cmd(cmd, server)
         return output.strip()
         
-    def list(self, server=None):
+    def list(self, server=None, all=False):
         """
-        List all the containers. 
+        List all the running containers. If 'all' is set, the
+        stopped containers and the full container IDs are included. 
+        Returns None if the containers could not be listed. 
         """
         cmd = self.docker + ' ' + self.ps_cmd + ' -q' 
+        if all:
+            cmd += ' -a --no-trunc'
         logging.warning(cmd)
 
-        output, _ = self._execute_cmd(cmd, server)
-        output = output.strip()
+        output, err = self._execute_cmd(cmd, server)
+        if output is None or (err and err.strip() != '' and output.strip() == ''):
+            return None
 
         # There is a container ID for each line
-        return output.split()
+        return output.strip().split()
 
     def images(self, image_name=None, server=None):
         """
@@ -250,26 +253,21 @@ class DockerCLI(object):
             logging.error(output.strip())
             return False
 
+    def _log_output(self, line):
+        logging.warning(line.rstrip())
+
     def _continuous_print(self, process, msg):
-        while True:
-            try:
-                out = process.stdout.read(161)
-                if out == '':
-                    break
-                else:
-                    logging.warning(out)
-            except IOError as e:
-                logging.warning(e)
-
-        try:
-            errmsg = process.stderr.readline()
-            if errmsg and errmsg != '':
-                logging.error(errmsg)
-                return False
-            else:
-                logging.warning("downloaded image!")
-        except IOError:
-            pass
+        """
+        Wait for a long-running command (push, pull). The output
+        is logged line-by-line as it arrives. 
+        """
+        result = process.wait()
+        errmsg = result.stderr.strip()
+        if errmsg != '' or not result.success():
+            logging.error(errmsg)
+            return False
+        else:
+            logging.warning("downloaded image!")
         return True
 
     def push(self, image, registry=None, server=None):
@@ -286,7 +284,7 @@ class DockerCLI(object):
             new_image = image
         push = self.docker + ' ' + self.push_cmd + ' ' + new_image
         logging.warning(push)
-        child = self._execute_cmd(push, server, read_output=False)
+        child = self._execute_cmd(push, server, read_output=False, on_output=self._log_output)
         return self._continuous_print(child, "uploading image...")
 
     def pull(self, image, server=None):
@@ -295,7 +293,7 @@ class DockerCLI(object):
         """
         pull = self.docker + ' ' + self.pull_cmd + ' ' + image
         logging.warning(pull)
-        child = self._execute_cmd(pull, server, read_output=False)
+        child = self._execute_cmd(pull, server, read_output=False, on_output=self._log_output)
         return self._continuous_print(child, "downloading image...")
 
     def commit(self, container, snapshot_name, server=None):
@@ -350,7 +348,7 @@ class DockerCLI(object):
                                  service_type = service_type, 
                                  args = args)
 
-    def run(self, service_type, image, volumes, keydir, keyname, privatekey, open_ports, host_map=None, expose_group=None, hostname=None, default_cmd=None, args=None, lxc_opts=None, server=None, user=None, inspector=None, background=False, simulate=False):
+    def run(self, service_type, image, volumes, keydir, keyname, privatekey, open_ports, host_map=None, expose_group=None, hostname=None, default_cmd=None, args=None, lxc_opts=None, server=None, user=None, inspector=None, background=False, simulate=False, dns=None):
         """
         Start a brand new container
         """
@@ -361,6 +359,11 @@ class DockerCLI(object):
             flags += self.host_flag
             flags += ' %s ' % hostname
 
+        # Specify the DNS server (this is optional)
+        if dns != None:
+            flags += self.dns_flag
+            flags += ' %s ' % dns
+
         # Add all the bind mounts
         if volumes != None:
             for v in volumes.keys():
@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import collections
 import datetime
 import grp
 import importlib
@@ -34,6 +35,14 @@ from ferry.install import *
 from ferry.docker.resolve       import DefaultResolver
 from ferry.docker.docker        import DockerInstance
 from ferry.docker.configfactory import ConfigFactory
+from ferry.fabric.com           import fan_out
+
+# Number of seconds that a newly claimed IP address is left alone by the
+# network reconciliation. The owners of the addresses are only recorded
+# once all the containers have started, and the stack is registered
+# even later, so a stack that is being built (possibly by another API
+# worker) looks just like a leak. 
+RECLAIM_GRACE_PERIOD = 3600
 
 class DockerManager(object):
     SSH_PORT = '22'
@@ -99,6 +108,73 @@ class DockerManager(object):
         """
         self.cluster_collection.remove( {'status':'removed'} )
 
+    def _registered_ips(self):
+        """
+        Get the IP addresses of all the containers that belong
+        to a stack that hasn't been removed. 
+        """
+        service_uuids = []
+        for cluster in self.cluster_collection.find( {'status' : { '$ne' : 'removed' }} ):
+            service_uuids += cluster.get('connectors', [])
+            for b in cluster.get('backends', {}).get('uuids', []):
+                if b.get('storage'):
+                    service_uuids.append(b['storage'])
+                if b.get('compute'):
+                    service_uuids += b['compute']
+
+        ips = set()
+        for service in self.service_collection.find( {'uuid' : { '$in' : service_uuids }} ):
+            for c in service.get('containers', []):
+                ips.add(c.get('internal_ip'))
+        return ips
+
+    def reconcile_network(self):
+        """
+        Free the IP addresses and forwarding rules that don't belong to any
+        container or registered stack (e.g., after a failed build or a crash). 
+        Addresses claimed within the grace period are skipped, since their
+        stack may still be getting built. Returns what was reclaimed. 
+        """
+        network = getattr(self.docker, 'network', None)
+        if not network:
+            return None
+
+        containers = self.docker.cli.list(all=True)
+        if containers is None:
+            logging.warning("could not list containers, skipping network reconciliation")
+            return None
+        containers = set([c[:12] for c in containers])
+        registered = self._registered_ips()
+
+        orphan_ips = []
+        live_ips = set()
+        recent = time.time() - RECLAIM_GRACE_PERIOD
+        for lease in self.mongo['network']['dhcp'].find( {'status' : { '$in' : ['active', 'stopped'] }} ):
+            owner = lease.get('container')
+            if (owner and owner[:12] in containers) or lease['ip'] in registered:
+                live_ips.add(lease['ip'])
+            elif lease.get('claimed', 0) > recent:
+                live_ips.add(lease['ip'])
+            else:
+                orphan_ips.append(lease['ip'])
+
+        orphan_rules = []
+        for rule in self.mongo['network']['nat'].find():
+            if not rule['ip'] in live_ips:
+                orphan_rules.append((rule['ip'], rule['port']))
+
+        if len(orphan_rules) > 0:
+            network.delete_rules(orphan_rules)
+        if len(orphan_ips) > 0:
+            network.free_ips(orphan_ips)
+
+        report = { 'ips' : orphan_ips,
+                   'rules' : ["%s:%s" % (ip, str(port)) for ip, port in orphan_rules] }
+        logging.warning("network reconciliation reclaimed %d IP addresses and %d forwarding rules: %s" % (len(orphan_ips),
+                                                                                                       len(orphan_rules),
+                                                                                                       json.dumps(report)))
+        return report
+
     def _load_class(self, class_name):
         """
         Dynamically load a class
@@ -785,19 +861,32 @@ class DockerManager(object):
 
     def _transfer_config(self, config_dirs):
         """
-        Transfer the configuration to the containers. 
+        Transfer the configuration to the containers. Containers that
+        share the same bundle are handled together, so each distinct
+        bundle is only archived once. 
         """
-        for c in config_dirs:
-            container = c[0]
-            from_dir = c[1]
-            to_dir = c[2]
-            self.docker.copy([container], from_dir, to_dir)
-            logging.warning("transferred config %s -> %s" % (from_dir, to_dir))
+        groups = collections.OrderedDict()
+        for container, bundle, to_dir in config_dirs:
+            k = (bundle.digest(), to_dir)
+            if not k in groups:
+                groups[k] = (bundle, [])
+            groups[k][1].append(container)
+
+        def _transfer(k):
+            bundle, containers = groups[k]
+            self.docker.copy_bundle(containers, bundle, k[1])
+            logging.warning("transferred config %s -> %s (%d containers)" % (bundle.name, k[1], len(containers)))
+        fan_out(_transfer, groups.keys(), self.docker.concurrency)
 
     def _transfer_ip(self, private_key, ips):
         """
         Transfer the hostname/IP addresses to all the containers. 
         """
+        # The network service already resolves the hostnames for
+        # the containers, so there's nothing to transfer. 
+        if getattr(self.docker, 'dns', False):
+            return
+
         with open('/tmp/instances', 'w+') as hosts_file:
             # Each line has the form (private IP, public IP, hostname)
             # We want to use the private IP for the hosts file. 
@@ -815,10 +904,10 @@ class DockerManager(object):
         Since the user normally interacts with these containers by 
         logging in (via ssh), we must place these variables in the profile. 
         """
-        for k in env_vars.keys():
-            logging.warning("transferring env vars")
-            self.docker.cmd(containers, 
-                            "echo export %s=%s >> /etc/profile" % (k, env_vars[k]))
+        logging.warning("transferring env vars")
+        exports = ["echo export %s=%s >> /etc/profile" % (k, env_vars[k]) for k in env_vars.keys()]
+        if len(exports) > 0:
+            self.docker.cmd(containers, " && ".join(exports))
         logging.warning("finished transfer env vars")
 
     def _start_containers(self, cluster_uuid, service_uuid, plan, ctype):
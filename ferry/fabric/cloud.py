@@ -15,13 +15,14 @@
 
 import ferry.install
 from ferry.docker.docker import DockerInstance, DockerCLI
-from ferry.fabric.com import robust_com
+from ferry.fabric.com import robust_com, fan_out, RetryPolicy
+from ferry.fabric.com import read_concurrency_config, read_compress_config, read_debug_dir_config
+from ferry.fabric.ssh import SSHSessionPool
 import importlib
 import inspect
 import json
 import logging
 import re
-from subprocess import Popen, PIPE
 import time
 import yaml
 
@@ -35,6 +36,7 @@ class CloudFabric(object):
         self.bootstrap = bootstrap
         self.cli = DockerCLI()
         self.cli.key = self.launcher._get_host_key()
+        self.cli.sessions = self.sessions
         self.docker_user = self.cli.docker_user
         self.inspector = CloudInspector(self)
 
@@ -70,6 +72,17 @@ class CloudFabric(object):
         # to the network, but controller has direct access. 
         self.proxy = bool(conf["system"]["proxy"])
 
+        # Determine how we should retry failed ssh/scp commands. 
+        self.retry_policy = RetryPolicy.from_config(conf.get('com'))
+        self.sessions = SSHSessionPool.from_config(conf.get('com'))
+        self.concurrency = read_concurrency_config(conf.get('com'))
+        self.compress = read_compress_config(conf.get('com'))
+        self.debug_dir = read_debug_dir_config(conf.get('com'))
+
+        # Hash of the configuration bundle that each container
+        # has received, keyed by (container, directory). 
+        self.bundles = {}
+
         # Check if the launcher supports proxy mode. 
         if self.proxy and not self.launcher.support_proxy():
             logging.error("%s does not support proxy mode" % self.launcher.name)
@@ -108,6 +121,7 @@ class CloudFabric(object):
         Quit the cloud fabric. 
         """
         logging.info("quitting cloud fabric")
+        self.sessions.close_all()
         self.launcher.quit()
 
     def restart(self, cluster_uuid, service_uuid, containers):
@@ -298,9 +312,10 @@ class CloudFabric(object):
         # ferry so that we can restart later. 
         halt = '/service/sbin/startnode halt'
         ferry = 'ferry quit'
-        for c in containers:
+        def _halt(c):
             self.cmd_raw(c.privatekey, c.external_ip, halt, c.default_user)
             self.cmd_raw(self.cli.key, c.manage_ip, ferry, self.launcher.ssh_user)
+        fan_out(_halt, containers, self.concurrency)
 
         # Now go ahead and stop the VMs. 
         self.launcher._stop_stack(cluster_uuid, service_uuid)
@@ -309,37 +324,74 @@ class CloudFabric(object):
         """
         Remove the running instances
         """
+        for c in containers:
+            self._forget_bundles(c)
         self.launcher._delete_stack(cluster_uuid, service_uuid)
 
     def copy(self, containers, from_dir, to_dir):
         """
         Copy over the contents to each container
         """
-        for c in containers:
-            self.copy_raw(c.privatekey, c.external_ip, from_dir, to_dir, c.default_user)
+        fan_out(lambda c: self.copy_raw(c.privatekey, c.external_ip, from_dir, to_dir, c.default_user),
+                containers,
+                self.concurrency)
 
     def copy_raw(self, key, ip, from_dir, to_dir, user):
-        opts = '-o ConnectTimeout=20 -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null'
-        scp = 'scp ' + opts + ' -i ' + key + ' -r ' + from_dir + ' ' + user + '@' + ip + ':' + to_dir
+        scp = self.sessions.scp_cmd(key, ip, user, from_dir, to_dir)
         logging.warning(scp)
-        robust_com(scp)
+        robust_com(scp, policy=self.retry_policy, host=ip)
         
+    def copy_bundle(self, containers, bundle, to_dir, compress=None):
+        """
+        Stream the in-memory configuration bundle to each container. The
+        archive is built once and unpacked into the directory. Containers
+        that already have this exact bundle are skipped. 
+        """
+        digest = bundle.digest()
+        containers = [c for c in containers if self.bundles.get((c.container, to_dir)) != digest]
+        if len(containers) == 0:
+            return
+
+        if compress is None:
+            compress = self.compress
+        if self.debug_dir:
+            logging.warning("config bundle %s saved to %s" % (bundle.name, bundle.dump(self.debug_dir)))
+
+        archive = bundle.archive(compress)
+        def _copy(c):
+            if self.copy_bundle_raw(c.privatekey, c.external_ip, archive, to_dir, c.default_user, compress):
+                self.bundles[(c.container, to_dir)] = digest
+        fan_out(_copy, containers, self.concurrency)
+
+    def _forget_bundles(self, container):
+        for k in self.bundles.keys():
+            if k[0] == container.container:
+                self.bundles.pop(k, None)
+
+    def copy_bundle_raw(self, key, ip, archive, to_dir, user, compress=False):
+        untar = self.sessions.untar_cmd(key, ip, user, to_dir, compress)
+        logging.warning(untar)
+        output, err, success = robust_com(untar, policy=self.retry_policy, host=ip, input=archive)
+        return success
+
     def cmd(self, containers, cmd):
         """
-        Run a command on all the containers and collect the output. 
+        Run a command on all the containers and collect the output. The
+        containers are contacted in parallel. 
         """
         all_output = {}
-        for c in containers:
-            output, _, _ = self.cmd_raw(c.privatekey, c.external_ip, cmd, c.default_user)
+        outputs = fan_out(lambda c: self.cmd_raw(c.privatekey, c.external_ip, cmd, c.default_user),
+                          containers,
+                          self.concurrency)
+        for c, (output, _, _) in zip(containers, outputs):
             if output.strip() != "":
                 all_output[c.host_name] = output.strip()
         return all_output
 
     def cmd_raw(self, key, ip, cmd, user):
-        ip = user + '@' + ip
-        ssh = 'LC_ALL=C && ssh -o ConnectTimeout=20 -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -i ' + key + ' -t -t ' + ip + ' \'%s\'' % cmd
+        ssh = self.sessions.ssh_cmd(key, ip, user, cmd)
         logging.warning(ssh)
-        return robust_com(ssh)
+        return robust_com(ssh, policy=self.retry_policy, host=ip)
 
 class CloudInspector(object):
     def __init__(self, fabric):
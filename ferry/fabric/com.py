@@ -13,38 +13,326 @@
 # limitations under the License.
 #
 
+from ferry.fabric.execute import execute
 import logging
+import Queue
+import random
 import re
-from subprocess import Popen, PIPE
+import sys
+import threading
 import time
 
-# Maximum number of tries to contact. 
+# Maximum number of tries to contact.
 MAX_COM_RETRIES = 10
 
-def robust_com(cmd):
-    # All the possible errors that might happen when
-    # we try to connect via ssh. 
-    route_closed = re.compile('.*No route to host.*', re.DOTALL)
-    conn_closed = re.compile('.*Connection closed.*', re.DOTALL)
-    refused_closed = re.compile('.*Connection refused.*', re.DOTALL)
-    timed_out = re.compile('.*timed out*', re.DOTALL)
-    permission = re.compile('.*Permission denied.*', re.DOTALL)
+# Maximum number of seconds a single remote command may run.
+COM_TIMEOUT = 900
 
+# Error classes. Connection errors usually mean that the host
+# is still booting (or the ssh daemon hasn't started yet). Authentication
+# errors may happen right after boot while the keys are being copied.
+# Everything else means the command itself ran (successfully or not).
+ERROR_CONNECTION = 'connection'
+ERROR_AUTH = 'auth'
+ERROR_COMMAND = 'command'
+
+# All the possible errors that might happen when
+# we try to connect via ssh.
+CONNECTION_ERRORS = [re.compile('.*No route to host.*', re.DOTALL),
+                     re.compile('.*Connection closed.*', re.DOTALL),
+                     re.compile('.*Connection refused.*', re.DOTALL),
+                     re.compile('.*Connection reset.*', re.DOTALL),
+                     re.compile('.*timed out*', re.DOTALL)]
+AUTH_ERRORS = [re.compile('.*Permission denied.*', re.DOTALL)]
+
+def classify_error(err):
+    """
+    Figure out what kind of error (if any) the ssh/scp output represents.
+    """
+    if err:
+        for e in CONNECTION_ERRORS:
+            if e.match(err):
+                return ERROR_CONNECTION
+        for e in AUTH_ERRORS:
+            if e.match(err):
+                return ERROR_AUTH
+    return ERROR_COMMAND
+
+class RetryPolicy(object):
+    """
+    Decide whether and when to retry a failed remote command. Uses
+    exponential backoff with jitter, bounded by an overall deadline.
+    """
+    def __init__(self,
+                 max_tries=MAX_COM_RETRIES,
+                 max_auth_tries=3,
+                 base_delay=2,
+                 max_delay=30,
+                 jitter=0.5,
+                 deadline=300,
+                 failure_threshold=10,
+                 reset_timeout=60):
+        self.max_tries = max_tries
+        self.max_auth_tries = max_auth_tries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.deadline = deadline
+
+        # Circuit breaker settings. After this many consecutive
+        # connection errors, we stop talking to the host for a while.
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+    @staticmethod
+    def from_config(args):
+        """
+        Create a policy from the 'com' section of the Ferry configuration.
+        """
+        policy = RetryPolicy()
+        if args:
+            for k in ['max_tries', 'max_auth_tries', 'base_delay', 'max_delay',
+                      'jitter', 'deadline', 'failure_threshold', 'reset_timeout']:
+                if k in args:
+                    setattr(policy, k, float(args[k]))
+        return policy
+
+    def should_retry(self, error, num_tries, elapsed):
+        if error == ERROR_CONNECTION:
+            max_tries = self.max_tries
+        elif error == ERROR_AUTH:
+            max_tries = self.max_auth_tries
+        else:
+            return False
+
+        if num_tries >= max_tries:
+            return False
+        return elapsed + self.delay(num_tries, jitter=False) < self.deadline
+
+    def delay(self, num_tries, jitter=True):
+        """
+        Number of seconds to wait before the next try.
+        """
+        delay = min(self.base_delay * (2 ** num_tries), self.max_delay)
+        if jitter:
+            delay -= delay * self.jitter * random.random()
+        return delay
+
+DEFAULT_POLICY = RetryPolicy()
+
+# Maximum number of hosts to contact at the same time.
+MAX_CONCURRENCY = 16
+
+def read_concurrency_config(args):
+    """
+    Maximum number of containers to contact at the same time, from
+    the 'com' section of the Ferry configuration. 
+    """
+    if args and 'concurrency' in args:
+        return int(args['concurrency'])
+    return MAX_CONCURRENCY
+
+def read_compress_config(args):
+    """
+    Whether to compress the archives streamed to the containers. 
+    """
+    if args and 'compress' in args:
+        return bool(args['compress'])
+    return False
+
+def read_debug_dir_config(args):
+    """
+    Where to keep a copy of the configuration bundles sent to 
+    the containers (for debugging). By default nothing is kept. 
+    """
+    if args and 'debug_dir' in args:
+        return args['debug_dir']
+    return None
+
+class _HostState(object):
+    """
+    Counters and circuit breaker of a single host. Several threads
+    (e.g., from fan_out) may talk to the same host at once. 
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.retry_time = 0
+        self.consecutive_failures = 0
+        self.open_until = 0
+
+    def is_open(self):
+        with self.lock:
+            return self.open_until > time.time()
+
+    def call(self):
+        with self.lock:
+            self.calls += 1
+
+    def retry(self, delay):
+        with self.lock:
+            self.retries += 1
+            self.retry_time += delay
+
+    def fail(self):
+        with self.lock:
+            self.failures += 1
+
+    def succeed(self):
+        with self.lock:
+            self.consecutive_failures = 0
+
+    def connection_failed(self, policy):
+        """
+        Count a connection error, and open the circuit once there
+        have been too many in a row. Returns whether the circuit opened. 
+        """
+        with self.lock:
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= policy.failure_threshold:
+                self.open_until = time.time() + policy.reset_timeout
+                self.failures += 1
+                return True
+            return False
+
+    def reset(self):
+        with self.lock:
+            self.consecutive_failures = 0
+            self.open_until = 0
+
+    def json(self):
+        with self.lock:
+            return { 'calls' : self.calls,
+                     'retries' : self.retries,
+                     'failures' : self.failures,
+                     'retry_time' : self.retry_time,
+                     'open' : self.open_until > time.time() }
+
+_hosts = {}
+_hosts_lock = threading.Lock()
+
+def _host_state(host):
+    with _hosts_lock:
+        if not host in _hosts:
+            _hosts[host] = _HostState()
+        return _hosts[host]
+
+def com_stats():
+    """
+    Return the number of calls, retries, failures, and time spent
+    retrying for each host.
+    """
+    with _hosts_lock:
+        return dict((h, s.json()) for h, s in _hosts.items())
+
+def reset_host(host):
+    """
+    Close the circuit for this host (e.g., after it has been restarted).
+    """
+    with _hosts_lock:
+        state = _hosts.get(host)
+    if state:
+        state.reset()
+
+def _parse_host(cmd):
+    m = re.search('[\w\-\.]+@([\w\-\.]+)', cmd)
+    if m:
+        return m.group(1)
+    return None
+
+def robust_com(cmd, timeout=COM_TIMEOUT, policy=None, host=None, input=None):
+    """
+    Run the (ssh/scp) command, retrying on connection and authentication
+    errors. Returns the output, error, and whether the command could be
+    run at all. If it couldn't, the output and error are empty. 
+    """
+    if not policy:
+        policy = DEFAULT_POLICY
+    if not host:
+        host = _parse_host(cmd)
+    state = _host_state(host)
+
+    # If this host has been consistently unreachable, don't bother
+    # trying again until the circuit breaker has reset.
+    if state.is_open():
+        logging.error("skipping unreachable host %s" % str(host))
+        state.fail()
+        return "", "", False
+
+    start = time.time()
     num_tries = 0
     while(True):
-        proc = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=True)
-        output = proc.stdout.read()
-        err = proc.stderr.read()
-        if route_closed.match(err) or conn_closed.match(err) or refused_closed.match(err) or timed_out.match(err) or permission.match(err):            
-            if num_tries < MAX_COM_RETRIES:
-                logging.warning("com error, trying again...")
-                num_tries += 1
-                time.sleep(10 * num_tries)
-            else: 
-                logging.error("could not communicate")
-                return None, None, False
-        else:
+        state.call()
+        result = execute(cmd, timeout=timeout, input=input)
+        output = result.stdout
+        err = result.stderr
+        if result.timed_out:
+            logging.error("command timed out")
+            return output, err, False
+
+        error = classify_error(err)
+        if error == ERROR_COMMAND:
             logging.warning("com msg: " + err)
+            state.succeed()
             break
-            
+
+        if error == ERROR_CONNECTION and state.connection_failed(policy):
+            logging.error("marking %s as unreachable" % str(host))
+            return "", "", False
+
+        elapsed = time.time() - start
+        if policy.should_retry(error, num_tries, elapsed):
+            delay = policy.delay(num_tries)
+            logging.warning("com error (%s), trying again in %.1fs..." % (error, delay))
+            num_tries += 1
+            state.retry(delay)
+            time.sleep(delay)
+        else:
+            logging.error("could not communicate (%s)" % error)
+            state.fail()
+            return "", "", False
+
     return output, err, True
+
+def fan_out(fn, items, concurrency=MAX_CONCURRENCY):
+    """
+    Apply the function to each item using a bounded number of threads, and
+    return the results in the same order as the items. 
+    """
+    items = list(items)
+    if concurrency <= 1 or len(items) <= 1:
+        return [fn(i) for i in items]
+
+    results = [None] * len(items)
+    errors = []
+    work = Queue.Queue()
+    for i, item in enumerate(items):
+        work.put((i, item))
+
+    def _worker():
+        while True:
+            try:
+                i, item = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = fn(item)
+            except Exception as e:
+                logging.error("fan out error: " + str(e))
+                errors.append(sys.exc_info())
+
+    workers = []
+    for n in range(min(int(concurrency), len(items))):
+        t = threading.Thread(target=_worker)
+        t.daemon = True
+        t.start()
+        workers.append(t)
+    for t in workers:
+        t.join()
+
+    # Re-raise the first error in the calling thread. 
+    if len(errors) > 0:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
@@ -0,0 +1,252 @@
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import collections
+import logging
+import os
+import signal
+import threading
+import time
+from distutils.spawn import find_executable
+from subprocess import Popen, PIPE
+
+# Maximum number of bytes we keep for each of stdout/stderr. Anything
+# after that is still handed to the callbacks, but is not stored.
+MAX_CAPTURED_OUTPUT = 4 * 1024 * 1024
+
+# How long to wait for the output readers after the process exits.
+# Commands that background a child (e.g., "foo &") may keep the
+# pipes open long after the shell itself has exited.
+READER_GRACE_PERIOD = 2
+
+# How often we check on the process for timeouts and cancellation.
+POLL_INTERVAL = 0.05
+
+# Used to start each command in its own session. A preexec_fn
+# (e.g., os.setsid) isn't safe once several threads are running.
+SETSID = find_executable('setsid')
+
+# Keep some history of recent commands for debugging purposes.
+MAX_HISTORY = 256
+_history = collections.deque(maxlen=MAX_HISTORY)
+_history_lock = threading.Lock()
+
+class ExecResult(object):
+    """
+    Outcome of a single command execution.
+    """
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.stdout = ''
+        self.stderr = ''
+        self.status = None
+        self.duration = 0
+        self.timed_out = False
+        self.cancelled = False
+        self.truncated = False
+
+    def success(self):
+        return self.status == 0 and not self.timed_out and not self.cancelled
+
+    def json(self):
+        return { 'cmd' : self.cmd,
+                 'status' : self.status,
+                 'duration' : self.duration,
+                 'timed_out' : self.timed_out,
+                 'cancelled' : self.cancelled,
+                 'truncated' : self.truncated }
+
+class _StreamReader(threading.Thread):
+    """
+    Drain a pipe line by line so that the child never blocks on a full pipe.
+    """
+    def __init__(self, stream, callback, max_output):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.stream = stream
+        self.callback = callback
+        self.max_output = max_output
+        self.chunks = []
+        self.size = 0
+        self.truncated = False
+        self.lock = threading.Lock()
+
+    def run(self):
+        try:
+            for line in iter(self.stream.readline, ''):
+                with self.lock:
+                    keep = line[:max(self.max_output - self.size, 0)]
+                    if len(keep) > 0:
+                        self.chunks.append(keep)
+                        self.size += len(keep)
+                    if len(keep) < len(line):
+                        self.truncated = True
+
+                if self.callback:
+                    try:
+                        self.callback(line)
+                    except Exception as e:
+                        logging.error("output callback failed: " + str(e))
+        except (IOError, ValueError) as e:
+            # The pipe was closed underneath us (e.g., the process
+            # was killed). Just return what we have.
+            logging.warning(e)
+        finally:
+            try:
+                self.stream.close()
+            except IOError:
+                pass
+
+    def output(self):
+        """
+        The output read so far. The reader may still be running
+        (e.g., if a background child kept the pipe open). 
+        """
+        with self.lock:
+            return ''.join(self.chunks), self.truncated
+
+class _StreamWriter(threading.Thread):
+    """
+    Feed the input to the child and close the pipe afterwards.
+    """
+    def __init__(self, stream, data):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.stream = stream
+        self.data = data
+
+    def run(self):
+        try:
+            self.stream.write(self.data)
+        except IOError as e:
+            # The child exited without reading all the input.
+            logging.warning(e)
+        finally:
+            try:
+                self.stream.close()
+            except IOError:
+                pass
+
+class Execution(object):
+    """
+    A running command. Both the standard output and error are
+    streamed concurrently, so chatty commands cannot deadlock.
+    """
+    def __init__(self, cmd, on_stdout=None, on_stderr=None, max_output=MAX_CAPTURED_OUTPUT, env=None, input=None):
+        self.cmd = cmd
+        self.result = ExecResult(cmd)
+        self._cancel = threading.Event()
+        self._start = time.time()
+
+        # Place the command in its own process group so that a
+        # timeout or cancellation also kills the children of the shell.
+        stdin = None
+        if input is not None:
+            stdin = PIPE
+        args = ['/bin/sh', '-c', cmd]
+        if SETSID:
+            args = [SETSID] + args
+        self.proc = Popen(args,
+                          stdin=stdin,
+                          stdout=PIPE,
+                          stderr=PIPE,
+                          env=env,
+                          close_fds=True)
+        self._out = _StreamReader(self.proc.stdout, on_stdout, max_output)
+        self._err = _StreamReader(self.proc.stderr, on_stderr, max_output)
+        self._out.start()
+        self._err.start()
+        if input is not None:
+            _StreamWriter(self.proc.stdin, input).start()
+
+    def cancel(self):
+        """
+        Ask the command to stop. The command is killed the next
+        time someone waits on it.
+        """
+        self._cancel.set()
+
+    def _kill(self):
+        try:
+            if SETSID:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            else:
+                self.proc.kill()
+        except OSError:
+            pass
+
+    def poll(self):
+        return self.proc.poll()
+
+    def wait(self, timeout=None):
+        """
+        Wait for the command to finish and return the result. If a timeout
+        (in seconds) is given, the command is killed after that long.
+        """
+        deadline = None
+        if timeout:
+            deadline = self._start + timeout
+
+        while self.proc.poll() is None:
+            if self._cancel.is_set():
+                logging.warning("cancelling: " + self.cmd)
+                self.result.cancelled = True
+                self._kill()
+                break
+            elif deadline and time.time() > deadline:
+                logging.warning("timed out after %ss: %s" % (str(timeout), self.cmd))
+                self.result.timed_out = True
+                self._kill()
+                break
+            time.sleep(POLL_INTERVAL)
+
+        self.result.status = self.proc.wait()
+        self._out.join(READER_GRACE_PERIOD)
+        self._err.join(READER_GRACE_PERIOD)
+
+        self.result.stdout, out_truncated = self._out.output()
+        self.result.stderr, err_truncated = self._err.output()
+        self.result.truncated = out_truncated or err_truncated
+        self.result.duration = time.time() - self._start
+        _record(self.result)
+        return self.result
+
+def _record(result):
+    with _history_lock:
+        _history.append(result.json())
+    logging.info("exec (status:%s, %.3fs): %s" % (str(result.status),
+                                                   result.duration,
+                                                   result.cmd))
+
+def history():
+    """
+    Return information (command, exit status, duration) regarding
+    recently executed commands.
+    """
+    with _history_lock:
+        return list(_history)
+
+def spawn(cmd, on_stdout=None, on_stderr=None, max_output=MAX_CAPTURED_OUTPUT, env=None, input=None):
+    """
+    Start the command and return immediately. If input is given,
+    it is written to the standard input of the command.
+    """
+    return Execution(cmd, on_stdout, on_stderr, max_output, env, input)
+
+def execute(cmd, timeout=None, on_stdout=None, on_stderr=None, max_output=MAX_CAPTURED_OUTPUT, env=None, input=None):
+    """
+    Execute the command and wait for it to finish.
+    """
+    return spawn(cmd, on_stdout, on_stderr, max_output, env, input).wait(timeout)
@@ -15,14 +15,16 @@
 
 from ferry.docker.docker import DockerCLI
 from ferry.docker.docker import DockerInspector
-from ferry.fabric.com import robust_com
+from ferry.fabric.com import robust_com, fan_out, RetryPolicy
+from ferry.fabric.com import read_concurrency_config, read_compress_config, read_debug_dir_config
+from ferry.fabric.ssh import SSHSessionPool
+from ferry.fabric.execute import execute
 from ferry.ip.client import DHCPClient
 from ferry.config.system.info import System
 import ferry.install
 import json
 import logging
 import os
-from subprocess import Popen, PIPE
 import time
 import yaml
 
@@ -35,18 +37,36 @@ class LocalFabric(object):
         self.inspector = DockerInspector(self.cli)
         self.bootstrap = bootstrap
 
+        # Determine how we should retry failed ssh/scp commands. 
+        conf = ferry.install.read_ferry_config()
+        self.retry_policy = RetryPolicy.from_config(conf.get('com'))
+        self.sessions = SSHSessionPool.from_config(conf.get('com'))
+        self.concurrency = read_concurrency_config(conf.get('com'))
+        self.compress = read_compress_config(conf.get('com'))
+        self.debug_dir = read_debug_dir_config(conf.get('com'))
+
+        # Hash of the configuration bundle that each container
+        # has received, keyed by (container, directory). 
+        self.bundles = {}
+
         # The system returns information regarding 
         # the instance types. 
         self.system = System()
 
         # Bootstrap mode means that the DHCP network
         # isn't available yet, so we can't use the network. 
+        self.dns = False
         if not bootstrap:
-            self.network = DHCPClient(ferry.install._get_gateway())
+            self.network = DHCPClient(ferry.install._get_gateway(),
+                                      ferry.install.get_network_mode(conf))
+
+            # The network service answers hostname lookups, so
+            # the containers don't need a hosts file. 
+            self.dns = ferry.install.get_dns_enabled(conf)
 
     def _get_host(self):
         cmd = "ifconfig eth0 | grep 'inet addr:' | cut -d: -f2 | awk '{ print $1}'"
-        return Popen(cmd, stdout=PIPE, shell=True).stdout.read().strip()
+        return execute(cmd).stdout.strip()
 
     def get_data_dir(self):
         if 'FERRY_SCRATCH' in os.environ:
@@ -88,6 +108,7 @@ class LocalFabric(object):
         Quit the local fabric. 
         """
         logging.info("quitting local fabric")
+        self.sessions.close_all()
 
     def restart(self, cluster_uuid, service_uuid, containers):
         """
@@ -118,14 +139,21 @@ class LocalFabric(object):
         """
         containers = []
         mounts = {}
-        for c in container_info:
-            # Get a new IP address for this container and construct
-            # a default command. 
-            gw = ferry.install._get_gateway().split("/")[0]
 
+        # Get new IP addresses for the containers and set up
+        # the port forwarding all at once. 
+        gw = ferry.install._get_gateway().split("/")[0]
+        net_info = [c for c in container_info if not 'netenable' in c]
+        ips = iter([])
+        if len(net_info) > 0:
+            ips = iter(self.network.assign_ips(net_info))
+
+        network = []
+        rules = []
+        for c in container_info:
             # Check if we should use the manual LXC option. 
             if not 'netenable' in c:
-                ip = self.network.assign_ip(c)
+                ip = ips.next()
                 lxc_opts = ["lxc.network.type = veth",
                             "lxc.network.ipv4 = %s/24" % ip, 
                             "lxc.network.ipv4.gateway = %s" % gw,
@@ -146,12 +174,23 @@ class LocalFabric(object):
                         dest = s[0]
                     host_map[dest] = [{'HostIp' : '0.0.0.0',
                                        'HostPort' : host}]
-                    self.network.forward_rule('0.0.0.0/0', host, ip, dest)
+                    rules.append(('0.0.0.0/0', host, ip, dest))
                 host_map_keys = host_map.keys()
             else:
+                ip = None
                 lxc_opts = None
                 host_map = None
                 host_map_keys = []
+            network.append((ip, lxc_opts, host_map, host_map_keys))
+
+        if len(rules) > 0:
+            self.network.forward_rules(rules)
+
+        owners = []
+        for c, (ip, lxc_opts, host_map, host_map_keys) in zip(container_info, network):
+            dns = None
+            if ip and self.dns:
+                dns = gw
 
             # Start a container with a specific image, in daemon mode,
             # without TTY, and on a specific port
@@ -171,14 +210,15 @@ class LocalFabric(object):
                                      args= c['args'],
                                      lxc_opts = lxc_opts,
                                      inspector = self.inspector,
-                                     background = False)
+                                     background = False,
+                                     dns = dns)
             if container:
                 container.default_user = self.docker_user
                 containers.append(container)
                 if not 'netenable' in c:
                     container.internal_ip = ip
                     container.external_ip = ip
-                    self.network.set_owner(ip, container.container)
+                    owners.append((ip, container.container, container.host_name, cluster_uuid))
 
                 if 'name' in c:
                     container.name = c['name']
@@ -191,6 +231,9 @@ class LocalFabric(object):
                 # on the containers (otherwise sometimes we get a connection refused)
                 time.sleep(3)
 
+        if len(owners) > 0:
+            self.network.set_owners(owners)
+
         # Check if we need to set the file permissions
         # for the mounted volumes. 
         for c, i in mounts.items():
@@ -213,10 +256,13 @@ class LocalFabric(object):
         """
         Remove the running instances
         """
+        # Drop all the leases and forwarding rules at once. 
+        ips = [c.internal_ip for c in containers if c.internal_ip]
+        if len(ips) > 0:
+            self.network.release_ips(ips)
+
         for c in containers:
-            for p in c.ports.keys():
-                self.network.delete_rule(c.internal_ip, p)
-            self.network.free_ip(c.internal_ip)
+            self._forget_bundles(c)
             self.cli.remove(c.container)
 
     def snapshot(self, containers, cluster_uuid, num_snapshots):
@@ -255,40 +301,78 @@ class LocalFabric(object):
         Safe stop the containers. 
         """
         cmd = '/service/sbin/startnode halt'
-        for c in containers:
-            self.cmd_raw(c.privatekey, c.internal_ip, cmd, c.default_user)
+        fan_out(lambda c: self.cmd_raw(c.privatekey, c.internal_ip, cmd, c.default_user),
+                containers,
+                self.concurrency)
 
     def copy(self, containers, from_dir, to_dir):
         """
         Copy over the contents to each container
         """
-        for c in containers:
-            self.copy_raw(c.privatekey, c.internal_ip, from_dir, to_dir, c.default_user)
+        fan_out(lambda c: self.copy_raw(c.privatekey, c.internal_ip, from_dir, to_dir, c.default_user),
+                containers,
+                self.concurrency)
 
     def copy_raw(self, key, ip, from_dir, to_dir, user):
         if key:
-            opts = '-o ConnectTimeout=20 -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null'
-            scp = 'scp ' + opts + ' -i ' + key + ' -r ' + from_dir + ' ' + user + '@' + ip + ':' + to_dir
+            scp = self.sessions.scp_cmd(key, ip, user, from_dir, to_dir)
             logging.warning(scp)
-            robust_com(scp)
+            robust_com(scp, policy=self.retry_policy, host=ip)
+
+    def copy_bundle(self, containers, bundle, to_dir, compress=None):
+        """
+        Stream the in-memory configuration bundle to each container. The
+        archive is built once and unpacked into the directory. Containers
+        that already have this exact bundle are skipped. 
+        """
+        digest = bundle.digest()
+        containers = [c for c in containers if self.bundles.get((c.container, to_dir)) != digest]
+        if len(containers) == 0:
+            return
+
+        if compress is None:
+            compress = self.compress
+        if self.debug_dir:
+            logging.warning("config bundle %s saved to %s" % (bundle.name, bundle.dump(self.debug_dir)))
+
+        archive = bundle.archive(compress)
+        def _copy(c):
+            if self.copy_bundle_raw(c.privatekey, c.internal_ip, archive, to_dir, c.default_user, compress):
+                self.bundles[(c.container, to_dir)] = digest
+        fan_out(_copy, containers, self.concurrency)
+
+    def _forget_bundles(self, container):
+        for k in self.bundles.keys():
+            if k[0] == container.container:
+                self.bundles.pop(k, None)
+
+    def copy_bundle_raw(self, key, ip, archive, to_dir, user, compress=False):
+        if key:
+            untar = self.sessions.untar_cmd(key, ip, user, to_dir, compress)
+            logging.warning(untar)
+            output, err, success = robust_com(untar, policy=self.retry_policy, host=ip, input=archive)
+            return success
+        return False
 
     def cmd(self, containers, cmd):
         """
-        Run a command on all the containers and collect the output. 
+        Run a command on all the containers and collect the output. The
+        containers are contacted in parallel. 
         """
         all_output = {}
-        for c in containers:
-            output = self.cmd_raw(c.privatekey, c.internal_ip, cmd, c.default_user)
+        outputs = fan_out(lambda c: self.cmd_raw(c.privatekey, c.internal_ip, cmd, c.default_user),
+                          containers,
+                          self.concurrency)
+        for c, output in zip(containers, outputs):
             if output.strip() != "":
                 all_output[c.host_name] = output.strip()
         return all_output
 
     def cmd_raw(self, key, ip, cmd, user):
         if key:
-            ip = user + '@' + ip
-            ssh = 'LC_ALL=C && ssh -o ConnectTimeout=20 -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -i ' + key + ' -t -t ' + ip + ' \'%s\'' % cmd
+            ssh = self.sessions.ssh_cmd(key, ip, user, cmd)
             logging.warning(ssh)
-            out, _, _ = robust_com(ssh)
+            out, _, _ = robust_com(ssh, policy=self.retry_policy, host=ip)
             return out
         else:
             return ''
@@ -0,0 +1,197 @@
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from ferry.fabric.execute import execute
+import hashlib
+import logging
+import os
+import threading
+import time
+
+# Where the ssh control sockets live. Keep this path short, since
+# unix sockets are limited to ~100 characters.
+DEFAULT_CONTROL_DIR = '/tmp/ferry/ssh'
+
+# Maximum number of open master connections.
+MAX_SESSIONS = 64
+
+# Number of seconds a master connection may stay idle.
+IDLE_TIMEOUT = 300
+
+# Number of seconds to wait while establishing a master connection.
+CONNECT_TIMEOUT = 30
+
+SSH_OPTS = '-o ConnectTimeout=20 -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null'
+
+class _Session(object):
+    def __init__(self, key, ip, user, path):
+        self.key = key
+        self.ip = ip
+        self.user = user
+        self.path = path
+        self.last_used = 0
+        self.lock = threading.Lock()
+
+class SSHSessionPool(object):
+    """
+    Keep persistent, multiplexed ssh connections for each (host, user, key)
+    so that consecutive ssh/scp commands do not each pay for a new
+    TCP connection and key exchange.
+    """
+    def __init__(self,
+                 control_dir=DEFAULT_CONTROL_DIR,
+                 max_sessions=MAX_SESSIONS,
+                 idle_timeout=IDLE_TIMEOUT):
+        self.control_dir = control_dir
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def from_config(args):
+        """
+        Create a pool from the 'com' section of the Ferry configuration.
+        """
+        pool = SSHSessionPool()
+        if args:
+            if 'ssh_sessions' in args:
+                pool.max_sessions = int(args['ssh_sessions'])
+            if 'ssh_idle' in args:
+                pool.idle_timeout = int(args['ssh_idle'])
+        return pool
+
+    def _control_path(self, key, ip, user):
+        h = hashlib.md5("%s:%s:%s" % (key, user, ip)).hexdigest()[:16]
+        return os.path.join(self.control_dir, h)
+
+    def _ensure_control_dir(self):
+        if not os.path.isdir(self.control_dir):
+            try:
+                os.makedirs(self.control_dir)
+                os.chmod(self.control_dir, 0700)
+            except OSError as e:
+                logging.warning("could not create ssh control dir: " + str(e))
+
+    def _evict(self):
+        """
+        Forget about idle sessions (their master connection exits on its
+        own) and close the least recently used ones if we are over the cap.
+        """
+        now = time.time()
+        evict = []
+        with self.lock:
+            for k, s in self.sessions.items():
+                if now - s.last_used > self.idle_timeout:
+                    del self.sessions[k]
+
+            if len(self.sessions) > self.max_sessions:
+                lru = sorted(self.sessions.items(), key=lambda i: i[1].last_used)
+                for k, s in lru[:len(self.sessions) - self.max_sessions]:
+                    del self.sessions[k]
+                    evict.append(s)
+
+        # Let any commands still using the session finish. 
+        for s in evict:
+            self._close(s, 'stop')
+
+    def _close(self, session, action='exit'):
+        logging.warning("closing ssh session %s@%s" % (session.user, session.ip))
+        cmd = 'ssh -o ControlPath=%s -O %s %s@%s' % (session.path, action, session.user, session.ip)
+        execute(cmd, timeout=CONNECT_TIMEOUT)
+
+    def _is_alive(self, session):
+        cmd = 'ssh -o ControlPath=%s -O check %s@%s' % (session.path, session.user, session.ip)
+        return execute(cmd, timeout=CONNECT_TIMEOUT).status == 0
+
+    def _connect(self, session):
+        """
+        Start a background master connection. The output is sent to
+        /dev/null since the master outlives this command.
+        """
+        self._ensure_control_dir()
+        cmd = 'ssh %s -i %s -o ControlMaster=yes -o ControlPath=%s -o ControlPersist=%d -f -N %s@%s < /dev/null > /dev/null 2>&1' % (SSH_OPTS,
+                                                                                                                                        session.key,
+                                                                                                                                        session.path,
+                                                                                                                                        self.idle_timeout,
+                                                                                                                                        session.user,
+                                                                                                                                        session.ip)
+        result = execute(cmd, timeout=CONNECT_TIMEOUT)
+        return result.success()
+
+    def session(self, key, ip, user):
+        """
+        Get the control path of a live master connection, establishing
+        one if necessary. Returns None if the host can't be reached
+        (e.g., it is still booting).
+        """
+        k = (key, ip, user)
+        with self.lock:
+            if not k in self.sessions:
+                self.sessions[k] = _Session(key, ip, user, self._control_path(key, ip, user))
+            s = self.sessions[k]
+
+        with s.lock:
+            now = time.time()
+            if s.last_used == 0 or now - s.last_used > self.idle_timeout or not os.path.exists(s.path):
+                if not os.path.exists(s.path) or not self._is_alive(s):
+                    if not self._connect(s):
+                        logging.warning("could not open ssh session %s@%s" % (user, ip))
+                        with self.lock:
+                            self.sessions.pop(k, None)
+                        return None
+            s.last_used = now
+
+        self._evict()
+        return s.path
+
+    def opts(self, key, ip, user):
+        """
+        Options that make ssh/scp reuse the master connection.
+        """
+        path = self.session(key, ip, user)
+        if path:
+            return SSH_OPTS + ' -o ControlMaster=no -o ControlPath=' + path
+        else:
+            return SSH_OPTS
+
+    def ssh_cmd(self, key, ip, user, cmd):
+        return 'LC_ALL=C && ssh ' + self.opts(key, ip, user) + ' -i ' + key + ' -t -t ' + user + '@' + ip + ' \'%s\'' % cmd
+
+    def scp_cmd(self, key, ip, user, from_dir, to_dir):
+        return 'scp ' + self.opts(key, ip, user) + ' -i ' + key + ' -r ' + from_dir + ' ' + user + '@' + ip + ':' + to_dir
+
+    def untar_cmd(self, key, ip, user, to_dir, compress=False):
+        """
+        Unpack a tar archive read from stdin into the directory. 
+        """
+        z = ''
+        if compress:
+            z = 'z'
+        unpack = 'mkdir -p %s && tar -C %s --no-same-owner -x%sf -' % (to_dir, to_dir, z)
+        return 'ssh ' + self.opts(key, ip, user) + ' -i ' + key + ' ' + user + '@' + ip + ' \'%s\'' % unpack
+
+    def close(self, key, ip, user):
+        with self.lock:
+            s = self.sessions.pop((key, ip, user), None)
+        if s:
+            self._close(s)
+
+    def close_all(self):
+        with self.lock:
+            sessions = self.sessions.values()
+            self.sessions = {}
+        for s in sessions:
+            self._close(s)
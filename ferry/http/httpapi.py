@@ -52,6 +52,8 @@ def _stack_worker():
             _allocate_snapshot_worker(payload["_uuid"], payload)
         elif payload["_action"] == "manage":
             _manage_stack_worker(payload["_uuid"], payload["_manage"], payload["_key"])
+        elif payload["_action"] == "reconcile":
+            docker.reconcile_network()
             
         time.sleep(2)
 
@@ -60,6 +62,34 @@ _new_stack_worker = threading2.Thread(target=_stack_worker)
 _new_stack_worker.daemon = True
 _new_stack_worker.start()
 
+# How often (in seconds) to look for leaked IP addresses and
+# forwarding rules. A value of 0 only checks at startup. 
+RECONCILE_INTERVAL = 600
+
+def _get_reconcile_interval():
+    conf = ferry.install.read_ferry_config()
+    if conf.get('network') and 'reconcile' in conf['network']:
+        return int(conf['network']['reconcile'])
+    return RECONCILE_INTERVAL
+
+def _reconcile_timer():
+    """
+    Periodically reconcile the network state. This goes through the
+    stack worker so that it doesn't run while this worker is building
+    a stack. Other workers may be, so recently claimed addresses are
+    left alone. 
+    """
+    interval = _get_reconcile_interval()
+    while(True):
+        _new_queue.put({"_action" : "reconcile"})
+        if interval <= 0:
+            break
+        time.sleep(interval)
+
+_reconcile_worker = threading2.Thread(target=_reconcile_timer)
+_reconcile_worker.daemon = True
+_reconcile_worker.start()
+
 def _allocate_backend_from_snapshot(cluster_uuid, payload, key_name):
     """
     Allocate the backend from a snapshot. 
@@ -25,6 +25,7 @@ import os.path
 import pwd
 import re
 import shutil
+import socket
 import stat
 import struct
 import sys
@@ -32,18 +33,19 @@ import time
 import uuid
 import yaml
 from distutils import spawn
-from ferry.ip.client import DHCPClient
+from ferry.ip.client import DHCPClient, MODE_HTTP, MODE_LOCAL
 from ferry.config.mongo.mongoconfig import *
+from ferry.fabric.execute import execute
 from ferry.fabric.local import LocalFabric
 from string import Template
 from subprocess import Popen, PIPE
 
 def _get_gateway():
     cmd = "LC_MESSAGES=C ifconfig ferry0 | grep 'inet addr:' | cut -d: -f2 | awk '{ print $1}'"
-    gw = Popen(cmd, stdout=PIPE, shell=True).stdout.read().strip()
+    gw = execute(cmd).stdout.strip()
     
     cmd = "LC_MESSAGES=C ifconfig ferry0 | grep 'inet addr:' | cut -d: -f4 | awk '{ print $1}'"
-    netmask = Popen(cmd, stdout=PIPE, shell=True).stdout.read().strip()
+    netmask = execute(cmd).stdout.strip()
     mask = map(int, netmask.split("."))
     cidr = 1
     if mask[3] == 0:
@@ -55,12 +57,12 @@ def _get_gateway():
 def _create_bridge():
     # Check if the Ferry bridge already exists. 
     # If not go ahead and create a new bridge. 
-    check = Popen("ifconfig ferry0 2> /dev/null", stdout=PIPE, shell=True).stdout.read().strip()
+    check = execute("ifconfig ferry0 2> /dev/null").stdout.strip()
     if check == "":
         logging.warning("Creating Ferry bridge 172.18.42.1/16")
-        Popen("brctl addbr ferry0", stdout=PIPE, shell=True).stdout.read().strip()
-        Popen("ip addr add 172.18.42.1/16 dev ferry0", stdout=PIPE, shell=True).stdout.read().strip()
-        Popen("ip link set dev ferry0 up", stdout=PIPE, shell=True).stdout.read().strip()
+        execute("brctl addbr ferry0")
+        execute("ip addr add 172.18.42.1/16 dev ferry0")
+        execute("ip link set dev ferry0 up")
 
 def _get_download_url():
     if 'DOWNLOAD_URL' in os.environ:
@@ -142,11 +144,11 @@ def _supported_tuple(tuple_string, tuple_min):
     return ver >= tuple_min, ver
 
 def _get_docker_version():
-    output = Popen("(docker --version 2>/dev/null) | awk '{print $3}'", stdout=PIPE, shell=True).stdout.read()
+    output = execute("(docker --version 2>/dev/null) | awk '{print $3}'").stdout
     return _supported_tuple(output.strip(), (1, 2, 0))
 
 def _supported_docker():
-    output = Popen("which docker 2>/dev/null", stdout=PIPE, shell=True).stdout.read()
+    output = execute("which docker 2>/dev/null").stdout
     if output.strip() == "":
         return False
 
@@ -154,16 +156,16 @@ def _supported_docker():
     return supported
 
 def _supported_lxc():
-    output = Popen("which lxc-start 2>/dev/null", stdout=PIPE, shell=True).stdout.read()
+    output = execute("which lxc-start 2>/dev/null").stdout
     if output.strip() == "":
         return False
 
-    output = Popen("(lxc-version 2>/dev/null || lxc-start --version) | sed 's/.* //'", stdout=PIPE, shell=True).stdout.read()
+    output = execute("(lxc-version 2>/dev/null || lxc-start --version) | sed 's/.* //'").stdout
     supported, _ = _supported_tuple(output.strip(), (0, 7, 5))
     return supported
 
 def _supported_bridge():
-    output = Popen("which brctl 2>/dev/null", stdout=PIPE, shell=True).stdout.read()
+    output = execute("which brctl 2>/dev/null").stdout
     if output.strip() == "":
         return False
     else:
@@ -216,6 +218,7 @@ DEFAULT_MONGO_DB=DOCKER_DIR + '/mongo'
 DEFAULT_MONGO_LOG=DOCKER_DIR + '/mongolog'
 DEFAULT_REGISTRY_DB=DOCKER_DIR + '/registry'
 DEFAULT_DOCKER_LOG=DOCKER_DIR + '/docker.log'
+SSH_TIMEOUT=60
 
 def _recursive_merge(dict1, dict2):
     """
@@ -250,6 +253,52 @@ def read_ferry_config():
     _recursive_merge(system, user)
     return system
 
+def _wait_for_port(ip, port, timeout=30):
+    """
+    Wait until something is listening on the port. 
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.connect((ip, port))
+            return True
+        except socket.error:
+            time.sleep(0.1)
+        finally:
+            s.close()
+    return False
+
+def get_network_mode(conf):
+    """
+    Determine whether the network (IP addresses, port forwarding) is
+    managed by the separate DHCP service or within the API server itself. 
+    """
+    if conf.get('network') and 'mode' in conf['network']:
+        return conf['network']['mode']
+    return MODE_HTTP
+
+def get_dns_enabled(conf):
+    """
+    Determine whether the network service should answer hostname
+    lookups for the containers (instead of pushing hosts files). 
+    """
+    if conf.get('network') and 'dns' in conf['network']:
+        return bool(conf['network']['dns'])
+    return True
+
+def get_lease_cache(conf):
+    """
+    Determine whether the network service may keep the IP leases in
+    memory. This is only safe if a single process manages the network,
+    so by default it is turned off when several API workers do. 
+    """
+    if conf.get('network') and 'cache' in conf['network']:
+        return bool(conf['network']['cache'])
+    if get_network_mode(conf) == MODE_LOCAL and conf.get('web') and 'workers' in conf['web']:
+        return int(conf['web']['workers']) <= 1
+    return True
+
 class Installer(object):
     def __init__(self, cli=None):
         self.network = DHCPClient()
@@ -418,7 +467,7 @@ class Installer(object):
 
     def _check_image_installed(self, image_name):
         cmd = DOCKER_CMD + ' -H=' + DOCKER_SOCK + ' inspect %s 2> /dev/null' % image_name
-        output = Popen(cmd, stdout=PIPE, shell=True).stdout.read()
+        output = execute(cmd).stdout
         if output.strip() == '[]':
             return False
         else:
@@ -430,9 +479,9 @@ class Installer(object):
         """
         for c in config_dirs:
             container = c[0]
-            from_dir = c[1]
+            bundle = c[1]
             to_dir = c[2]
-            self.fabric.copy([container], from_dir, to_dir)
+            self.fabric.copy_bundle([container], bundle, to_dir)
 
     def _read_public_key(self, private_key):
         s = private_key.split("/")
@@ -548,19 +597,29 @@ class Installer(object):
         # Sleep a little while to let Mongo start receiving.
         time.sleep(2)
 
-        # Start the DHCP server
-        logging.warning("starting dhcp server")
-        # cmd = 'gunicorn -t 3600 -b 127.0.0.1:5000 -w 1 ferry.ip.dhcp:app &'
-        cmd = 'python %s/ip/dhcp.py 127.0.0.1 5000  &' % FERRY_HOME
-        Popen(cmd, stdout=PIPE, shell=True, env=my_env)
-        time.sleep(2)
-
-        # Reserve the Mongo IP.
-        self.network.reserve_ip(ip)
-
         # Start the Ferry HTTP server. Read in the web configuration
         # so that we know how many workers to start, etc. 
         workers, bind, port = self._get_worker_info()
+
+        # Restore the forwarding rules once, before anyone else
+        # starts managing the network. 
+        cmd = 'python %s/ip/nat.py' % FERRY_HOME
+        if not execute(cmd, env=my_env).success():
+            logging.error("could not restore the forwarding rules")
+
+        # Start the DHCP server. In local mode the API server
+        # manages the network itself, so there's nothing to start. 
+        if get_network_mode(self.config) != MODE_LOCAL:
+            logging.warning("starting dhcp server")
+            # cmd = 'gunicorn -t 3600 -b 127.0.0.1:5000 -w 1 ferry.ip.dhcp:app &'
+            cmd = 'python %s/ip/dhcp.py 127.0.0.1 5000  &' % FERRY_HOME
+            Popen(cmd, stdout=PIPE, shell=True, env=my_env)
+            if not _wait_for_port('127.0.0.1', 5000):
+                logging.error("dhcp server did not start")
+
+            # Reserve the Mongo IP.
+            self.network.reserve_ip(ip)
+
         logging.warning("starting API servers on (%s:%s) and (mongo:%s)" % (bind, port, ip))
         # cmd = 'gunicorn -e FERRY_HOME=%s -t 3600 -w %d -b %s:%s ferry.http.httpapi:app &' % (FERRY_HOME, workers, bind, port)
         cmd = 'export FERRY_HOME=%s && python %s/http/httpapi.py %s %s &' % (FERRY_HOME, FERRY_HOME, bind, port)
@@ -569,7 +628,7 @@ class Installer(object):
     def _force_stop_web(self):
         logging.warning("stopping docker http servers")
         cmd = 'pkill -f gunicorn'
-        Popen(cmd, stdout=PIPE, shell=True)
+        execute(cmd)
 
     def stop_web(self, key):
         # Shutdown the mongo instance
@@ -580,29 +639,27 @@ class Installer(object):
 
             cmd = 'LC_ALL=C && ssh -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -i %s root@%s /service/sbin/startnode stop' % (key, ip)
             logging.warning(cmd)
-            output = Popen(cmd, stdout=PIPE, shell=True).stdout.read()
+            output = execute(cmd, timeout=SSH_TIMEOUT).stdout
             logging.warning(output)
             cmd = 'LC_ALL=C && ssh -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -i %s root@%s /service/sbin/startnode halt' % (key, ip)
             logging.warning(cmd)
-            output = Popen(cmd, stdout=PIPE, shell=True).stdout.read()
+            output = execute(cmd, timeout=SSH_TIMEOUT).stdout
             logging.warning(output)
             os.remove('/tmp/ferry/mongodb.ip')
 
         # Kill all the gunicorn instances. 
         logging.warning("stopping http servers")
         cmd = 'ps -eaf | grep httpapi | awk \'{print $2}\' | xargs kill -15'
-        Popen(cmd, stdout=PIPE, shell=True)
+        execute(cmd)
         cmd = 'ps -eaf | grep ferry.ip.dhcp | awk \'{print $2}\' | xargs kill -15'
-        Popen(cmd, stdout=PIPE, shell=True)
+        execute(cmd)
 
     def _clean_web(self):
         docker = DOCKER_CMD + ' -H=' + DOCKER_SOCK
         cmd = docker + ' ps | grep ferry/mongodb | awk \'{print $1}\' | xargs ' + docker + ' stop '
         logging.warning("cleaning previous mongo resources")
         logging.warning(cmd)
-        child = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=True)
-        child.stdout.read()
-        child.stderr.read()
+        execute(cmd)
 
     def _copytree(self, src, dst):
         for item in os.listdir(src):
@@ -701,7 +758,7 @@ class Installer(object):
     def _check_dockerimage(self, image, repo):
         qualified = repo + '/' + image
         cmd = DOCKER_CMD + ' -H=' + DOCKER_SOCK + ' inspect ' + qualified + ' 2> /dev/null'
-        output = Popen(cmd, stdout=PIPE, shell=True).stdout.read()
+        output = execute(cmd).stdout
         if output.strip() == '[]':
             return image
         else:
@@ -766,29 +823,25 @@ class Installer(object):
                     return base[-1]
         return base
 
-    def _continuous_print(self, process, on_client=True):
-        while True:
-            try:
-                out = process.stdout.read(15)
-                if out == '':
-                    break
-                else:
-                    if on_client:
-                        sys.stdout.write(out)
-                        sys.stdout.flush()
-                    else:
-                        logging.warning("downloading image...")
-            except IOError as e:
-                logging.warning(e)
-
-        try:
-            errmsg = process.stderr.readline()
-            if errmsg and errmsg != '':
-                logging.warning(errmsg)
+    def _continuous_print(self, cmd, on_client=True):
+        """
+        Execute a long-running command (pull, build) and print
+        the output line-by-line as it arrives. 
+        """
+        def _print_output(line):
+            if on_client:
+                sys.stdout.write(line)
+                sys.stdout.flush()
             else:
-                logging.warning("downloaded image!")
-        except IOError:
-            pass
+                logging.warning("downloading image...")
+
+        result = execute(cmd, on_stdout=_print_output)
+        errmsg = result.stderr.strip()
+        if errmsg != '':
+            logging.warning(errmsg)
+        else:
+            logging.warning("downloaded image!")
+        return result
 
     def _pull_image(self, image, tag=None, on_client=True):
         if not tag:
@@ -797,27 +850,25 @@ class Installer(object):
             cmd = DOCKER_CMD + ' -H=' + DOCKER_SOCK + ' pull %s:%s' % (image, tag)
 
         logging.warning(cmd)
-        child = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=True)
-        self._continuous_print(child, on_client=on_client)
+        self._continuous_print(cmd, on_client=on_client)
 
         # Now tag the image with the 'latest' tag. 
         if tag and tag != 'latest':
             cmd = DOCKER_CMD + ' -H=' + DOCKER_SOCK + ' tag' + ' %s:%s %s:%s' % (image, tag, image, 'latest')
             logging.warning(cmd)
-            Popen(cmd, stdout=PIPE, shell=True)
+            execute(cmd)
         
     def _compile_image(self, image, repo, image_dir, build=False):
         # Now build the image. 
         if build:
             cmd = DOCKER_CMD + ' -H=' + DOCKER_SOCK + ' build --rm=true -t' + ' %s/%s %s' % (repo, image, image_dir)
             logging.warning(cmd)
-            child = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=True)
-            self._continuous_print(child)
+            self._continuous_print(cmd)
 
             # Now tag the image. 
             cmd = DOCKER_CMD + ' -H=' + DOCKER_SOCK + ' tag' + ' %s/%s %s/%s:%s' % (repo, image, repo, image, ferry.__version__)
             logging.warning(cmd)
-            child = Popen(cmd, stdout=PIPE, shell=True)
+            execute(cmd)
         else:
             # Just pull the image from the public repo. 
             image_name = "%s/%s" % (repo, image)
@@ -827,14 +878,14 @@ class Installer(object):
         for a in alternatives:
             cmd = DOCKER_CMD + ' -H=' + DOCKER_SOCK + ' tag' + ' %s/%s:%s %s/%s:%s' % (repo, image, ferry.__version__, repo, a, ferry.__version__)
             logging.warning(cmd)
-            child = Popen(cmd, stdout=PIPE, shell=True)
+            execute(cmd)
             cmd = DOCKER_CMD + ' -H=' + DOCKER_SOCK + ' tag' + ' %s/%s:latest %s/%s:latest' % (repo, image, repo, a)
             logging.warning(cmd)
-            child = Popen(cmd, stdout=PIPE, shell=True)
+            execute(cmd)
 
     def _clean_images(self):
         cmd = DOCKER_CMD + ' -H=' + DOCKER_SOCK + ' | grep none | awk \'{print $1}\' | xargs ' + DOCKER_CMD + ' -H=' + DOCKER_SOCK + ' rmi'
-        Popen(cmd, stdout=PIPE, shell=True)
+        execute(cmd)
 
     def _is_parent_dir(self, pdir, cdir):
         pdirs = pdir.split("/")
@@ -857,7 +908,7 @@ class Installer(object):
     def _is_running_btrfs(self):
         logging.warning("checking for btrfs")
         cmd = 'cat /etc/mtab | grep btrfs | awk \'{print $2}\''
-        output = Popen(cmd, stdout=PIPE, shell=True).stdout.read()
+        output = execute(cmd).stdout
         if output.strip() != "":
             dirs = output.strip().split("\n")
             for d in dirs:
@@ -923,7 +974,7 @@ class Installer(object):
         if force or self._docker_running():
             logging.warning("stopping docker daemon")
             cmd = 'pkill -f ' + DOCKER_CMD
-            Popen(cmd, stdout=PIPE, shell=True)
+            execute(cmd)
             try:
                 os.remove('/var/run/ferry.sock')
             except OSError:
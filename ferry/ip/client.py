@@ -15,53 +15,170 @@
 
 import json
 import logging
+import os
 import requests
 
 DHCP_SERVER = 'http://localhost:5000'
+
+# Talk to the DHCP service over HTTP (default), or
+# manage the network directly within this process. 
+MODE_HTTP = 'http'
+MODE_LOCAL = 'local'
+
 class DHCPClient(object):
-    def __init__(self, cidr_block=None):
+    def __init__(self, cidr_block=None, mode=MODE_HTTP):
+        self.dhcp = None
+        if mode == MODE_LOCAL:
+            # Only import the service when we actually need it. 
+            from ferry.ip.dhcp import get_dhcp
+            self.dhcp = get_dhcp()
+
+            # Normally the installer reserves the Mongo IP once the
+            # DHCP service is up. Since there's no service, do it here. 
+            self.dhcp.reserve_ip(os.environ['MONGODB'])
+            if cidr_block:
+                self.dhcp.assign_cidr(cidr_block)
+            return
+
+        # Reuse the same (keep-alive) connection for all the requests. 
+        self.session = requests.Session()
         if cidr_block:
             payload = { 'cidr' : cidr_block }
-            res = requests.post(DHCP_SERVER + '/cidr', data=payload)
+            res = self.session.post(DHCP_SERVER + '/cidr', data=payload)
 
     def assign_ip(self, container):
+        if self.dhcp:
+            return self.dhcp.assign_ip(container)
+
         payload = { 'container' : json.dumps(container) }
-        res = requests.get(DHCP_SERVER + '/ip', params=payload)
+        res = self.session.get(DHCP_SERVER + '/ip', params=payload)
         j = json.loads(res.text)
         return j['ip']
 
+    def assign_ips(self, containers):
+        if self.dhcp:
+            return self.dhcp.assign_ips(containers)
+
+        # The server only needs to know the container ID (in
+        # case it's being restarted), so keep the request small. 
+        containers = [dict((k, c[k]) for k in ['container'] if k in c) for c in containers]
+        payload = { 'containers' : json.dumps(containers) }
+        res = self.session.get(DHCP_SERVER + '/ips', params=payload)
+        j = json.loads(res.text)
+        return j['ips']
+
     def reserve_ip(self, ip):
+        if self.dhcp:
+            return self.dhcp.reserve_ip(ip)
+
         payload = { 'ip' : ip }
-        res = requests.put(DHCP_SERVER + '/ip', data=payload)
+        res = self.session.put(DHCP_SERVER + '/ip', data=payload)
+
+    def set_owner(self, ip, container, hostname=None, cluster=None):
+        if self.dhcp:
+            return self.dhcp.set_owner(ip, container, hostname, cluster)
 
-    def set_owner(self, ip, container):
         payload = { 'args' : json.dumps({ 'ip' : ip,
-                                          'container' : container}) }
-        requests.post(DHCP_SERVER + '/node', data=payload)
+                                          'container' : container,
+                                          'hostname' : hostname,
+                                          'cluster' : cluster }) }
+        self.session.post(DHCP_SERVER + '/node', data=payload)
+
+    def set_owners(self, owners):
+        """
+        Set the owners of several IP addresses. Each owner is
+        an (ip, container, hostname, cluster) tuple. 
+        """
+        owners = [{ 'ip' : ip,
+                    'container' : container,
+                    'hostname' : hostname,
+                    'cluster' : cluster } for ip, container, hostname, cluster in owners]
+        if self.dhcp:
+            return self.dhcp.set_owners(owners)
+
+        payload = { 'args' : json.dumps(owners) }
+        self.session.post(DHCP_SERVER + '/nodes', data=payload)
 
     def random_port(self):
-        res = requests.get(DHCP_SERVER + '/port')
+        if self.dhcp:
+            return self.dhcp.random_port()
+
+        res = self.session.get(DHCP_SERVER + '/port')
         return res.text
 
     def forward_rule(self, source_ip, source_port, dest_ip, dest_port):
+        if self.dhcp:
+            return self.dhcp.forward_rule(source_ip, source_port, dest_ip, dest_port)
+
         payload = { 'src_ip' : source_ip,
                     'src_port' : source_port,
                     'dest_ip' : dest_ip,
                     'dest_port' : dest_port }
-        requests.post(DHCP_SERVER + '/port', data={'args': json.dumps(payload)})
+        self.session.post(DHCP_SERVER + '/port', data={'args': json.dumps(payload)})
 
     def delete_rule(self, dest_ip, dest_port):
+        if self.dhcp:
+            return self.dhcp.delete_rule(dest_ip, dest_port)
+
         payload = { 'dest_ip' : dest_ip,
                     'dest_port' : dest_port }
-        requests.delete(DHCP_SERVER + '/port', data={'args': json.dumps(payload)})
+        self.session.delete(DHCP_SERVER + '/port', data={'args': json.dumps(payload)})
+
+    def forward_rules(self, rules):
+        if self.dhcp:
+            return self.dhcp.forward_rules([{ 'src_ip' : source_ip,
+                                             'src_port' : source_port,
+                                             'dest_ip' : dest_ip,
+                                             'dest_port' : dest_port } for source_ip, source_port, dest_ip, dest_port in rules])
+
+        payload = [{ 'src_ip' : source_ip,
+                     'src_port' : source_port,
+                     'dest_ip' : dest_ip,
+                     'dest_port' : dest_port } for source_ip, source_port, dest_ip, dest_port in rules]
+        self.session.post(DHCP_SERVER + '/ports', data={'args': json.dumps(payload)})
+
+    def delete_rules(self, rules):
+        if self.dhcp:
+            return self.dhcp.delete_rules([{ 'dest_ip' : dest_ip,
+                                            'dest_port' : dest_port } for dest_ip, dest_port in rules])
+
+        payload = [{ 'dest_ip' : dest_ip,
+                     'dest_port' : dest_port } for dest_ip, dest_port in rules]
+        self.session.delete(DHCP_SERVER + '/ports', data={'args': json.dumps(payload)})
 
     def clean_rules(self):
-        requests.delete(DHCP_SERVER + '/ports')
+        if self.dhcp:
+            return self.dhcp.clean_rules()
+
+        self.session.delete(DHCP_SERVER + '/ports')
 
     def stop_ip(self, ip):
+        if self.dhcp:
+            return self.dhcp.stop_ip(ip)
+
         payload = { 'ip' : ip }
-        requests.post(DHCP_SERVER + '/ip', data=payload)
+        self.session.post(DHCP_SERVER + '/ip', data=payload)
 
     def free_ip(self, ip):
+        if self.dhcp:
+            return self.dhcp.free_ip(ip)
+
         payload = { 'ip' : ip }
-        requests.delete(DHCP_SERVER + '/ip', data=payload)
+        self.session.delete(DHCP_SERVER + '/ip', data=payload)
+
+    def free_ips(self, ips):
+        if self.dhcp:
+            return self.dhcp.free_ips(ips)
+
+        payload = { 'ips' : json.dumps(ips) }
+        self.session.delete(DHCP_SERVER + '/ips', data=payload)
+
+    def release_ips(self, ips):
+        """
+        Free the IP addresses along with all their forwarding rules. 
+        """
+        if self.dhcp:
+            return self.dhcp.release_ips(ips)
+
+        payload = { 'ips' : json.dumps(ips) }
+        self.session.delete(DHCP_SERVER + '/leases', data=payload)
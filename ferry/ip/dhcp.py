@@ -18,243 +18,620 @@ import logging
 import os
 from flask import Flask, request
 from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from ferry.ip.dns import DNSResponder
 from ferry.ip.nat import NAT
+from ferry.ip.pool import IPPool, find_and_modify
 import sys
+import threading
+import time
 from tornado.wsgi import WSGIContainer
 from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
 
+def synchronized(fn):
+    """
+    Only let one thread at a time modify the network state. 
+    """
+    def _synchronized(self, *args, **kwargs):
+        with self.lock:
+            return fn(self, *args, **kwargs)
+    _synchronized.__name__ = fn.__name__
+    _synchronized.__doc__ = fn.__doc__
+    return _synchronized
+
+# Lease fields that belong to the container. 
+OWNER_FIELDS = { 'container' : '', 'hostname' : '', 'cluster' : '' }
+
+# Lease fields cleared when the address is freed. The claim time lets
+# the network reconciliation leave stacks that are still being built alone. 
+HOLDER_FIELDS = dict(OWNER_FIELDS, claimed='')
+
 class DHCP(object):
-    def __init__(self):
-        self.free_ips = []
-        self.reserved_ips = []
+    """
+    Hand out IP addresses to the containers. The lease collection in Mongo
+    is the source of truth, and every allocation is an atomic find-and-modify,
+    so several processes can safely share the same leases. 
+
+    With the cache enabled, the leases are also kept in memory to answer
+    lookups (e.g., DNS queries) without going to Mongo, and new addresses
+    come from the in-memory pools instead of find-and-modify. This is only
+    safe if this is the only process modifying the leases. 
+    """
+    def __init__(self, cache=True):
+        self.lock = threading.RLock()
+        self.cache = cache
+        self.pools = []
         self.ips = {}
-        self.num_ips = 1
-        self.num_addrs = 0
+        self.owners = {}
+        self.names = {}
+        self.dns = None
         self.nat = NAT()
         self._init_state_db()
 
+    @synchronized
     def assign_cidr(self, cidr_block):
-        if self.num_addrs == 0:
-            self.cidr_collection.insert( { 'cidr' : cidr_block } )
-            self._parse_cidr(cidr_block)
-
-    def _parse_cidr(self, cidr_block):
-        self.gw_ip, self.prefix = self._parse_cidr_address(cidr_block)
-        addr = map(int, self.gw_ip.split("."))
-        if self.prefix == 24:
-            self.latest_ip = "%d.%d.%d.0" % (addr[0], addr[1], addr[2])
-        elif self.prefix == 16:
-            self.latest_ip = "%d.%d.0.0" % (addr[0], addr[1])
-        self.num_addrs = 2**(32 - self.prefix)
+        """
+        Add a new address pool. Addresses are allocated from the
+        pools in the order that they were added. 
+        """
+        for pool in self.pools:
+            if pool.cidr == cidr_block:
+                return
+        pool = self._add_pool(cidr_block)
+        if self.cache:
+            self._rebuild_pools([pool])
+        if not self.cidr_collection.find_one( { 'cidr' : cidr_block } ):
+            try:
+                self.cidr_collection.insert( { 'cidr' : cidr_block,
+                                               'next' : pool.first } )
+            except DuplicateKeyError:
+                # Another process added the pool first. 
+                pass
+
+    def _add_pool(self, cidr_block):
+        pool = IPPool(cidr_block)
+        self.pools.append(pool)
+        self._start_dns(pool.gw_ip)
+        return pool
+
+    def _start_dns(self, gw_ip):
+        """
+        Answer hostname lookups from the containers on the gateway. 
+        """
+        from ferry.install import read_ferry_config, get_dns_enabled
+        if not self.dns and get_dns_enabled(read_ferry_config()):
+            try:
+                self.dns = DNSResponder(self, gw_ip)
+                self.dns.start()
+            except Exception as e:
+                logging.error("could not start dns: " + str(e))
+                self.dns = None
+
+    def _find_pool(self, ip):
+        for pool in self.pools:
+            if pool.contains(ip):
+                return pool
+        return None
 
     def _init_state_db(self):
         self.mongo = MongoClient(os.environ['MONGODB'], 27017, connectTimeoutMS=6000)
         self.dhcp_collection = self.mongo['network']['dhcp']
         self.cidr_collection = self.mongo['network']['cidr']
 
-        cidr = self.cidr_collection.find_one()
-        if cidr:
+        # The unique indices are what make concurrent allocation safe. 
+        try:
+            self.dhcp_collection.create_index('ip', unique=True)
+            self.dhcp_collection.create_index([('status', 1), ('freed', 1)])
+            self.dhcp_collection.create_index('container')
+            self.cidr_collection.create_index('cidr', unique=True)
+        except OperationFailure as e:
+            logging.error("could not create lease indices: " + str(e))
+
+        for cidr in self.cidr_collection.find():
             logging.warning("recovering network gateway: " + str(cidr['cidr']))
-            self._parse_cidr(cidr['cidr'])
+            pool = self._add_pool(cidr['cidr'])
+            if not 'next' in cidr:
+                self._init_next(pool)
 
-        all_ips = self.dhcp_collection.find()
-        if all_ips:
+        if self.cache:
             logging.warning("recovering assigned IP addresses")
-            for ip_status in all_ips:
-                ip = ip_status['ip']
-                status = ip_status['status']
-                self.num_ips += 1
-                self.ips[ip] = { 'status' : status }
-
-                if status == 'free':
-                    self.free_ips.append(ip)
-                else:
-                    self.ips[ip]['container'] = ip_status['container']
+            for lease in self.dhcp_collection.find( { 'status' : { '$in' : ['active', 'stopped'] } } ):
+                self._cache_lease(lease)
+            self._rebuild_pools(self.pools)
 
-                self._recover_latest_ip(ip)
+    def _rebuild_pools(self, pools):
+        """
+        Recover the allocation state of the in-memory pools from the leases. 
+        """
+        used = []
+        seen = []
+        for lease in self.dhcp_collection.find( {}, { 'ip' : True, 'status' : True, 'reserved' : True } ):
+            seen.append(lease['ip'])
+            if lease.get('status') in ['active', 'stopped']:
+                used.append(lease['ip'])
+            if lease.get('reserved'):
+                for pool in pools:
+                    pool.reserve(lease['ip'])
+        for pool in pools:
+            pool.rebuild(used, seen)
+
+    def _init_next(self, pool):
+        """
+        Leases used to be allocated in memory, so older pools don't
+        record where the untouched addresses start. 
+        """
+        next = pool.first
+        for lease in self.dhcp_collection.find( {}, { 'ip' : True } ):
+            offset = pool.offset(lease['ip'])
+            if offset is not None and offset >= next:
+                next = offset + 1
+        self.cidr_collection.update( { 'cidr' : pool.cidr, 'next' : { '$exists' : False } },
+                                     { '$set' : { 'next' : next } } )
+
+    def _cache_lease(self, lease):
+        if self.cache:
+            self._uncache_lease(lease['ip'])
+            self.ips[lease['ip']] = dict((k, lease.get(k)) for k in ['status', 'container', 'hostname', 'cluster'])
+            self._index_owner(lease['ip'])
+
+    def _uncache_lease(self, ip):
+        if ip in self.ips:
+            self._unindex_owner(ip)
+            del self.ips[ip]
+
+    def _index_owner(self, ip):
+        lease = self.ips[ip]
+        if lease.get('container'):
+            self.owners[lease['container']] = ip
+        if lease.get('hostname'):
+            self.names[(lease.get('cluster'), lease['hostname'].lower())] = ip
+
+    def _unindex_owner(self, ip):
+        lease = self.ips.get(ip, {})
+        container = lease.get('container')
+        if container and self.owners.get(container) == ip:
+            del self.owners[container]
+        if lease.get('hostname'):
+            name = (lease.get('cluster'), lease['hostname'].lower())
+            if self.names.get(name) == ip:
+                del self.names[name]
+
+    def _claim_free(self):
+        """
+        Claim the address that has been free the longest. 
+        """
+        lease = find_and_modify(self.dhcp_collection,
+                                { 'status' : 'free', 'reserved' : { '$ne' : True } },
+                                { '$set' : { 'status' : 'active', 'claimed' : time.time() },
+                                  '$unset' : { 'freed' : '' } },
+                                sort = [('freed', 1)])
+        if lease:
+            return lease['ip']
+        return None
+
+    def _claim_offsets(self, pool, num):
+        """
+        Move the pool's high-water mark forward, and return the
+        offsets that now belong to us. 
+        """
+        cidr = find_and_modify(self.cidr_collection,
+                               { 'cidr' : pool.cidr, 'next' : { '$lte' : pool.last } },
+                               { '$inc' : { 'next' : num } },
+                               new = False)
+        if cidr:
+            return range(cidr['next'], min(cidr['next'] + num, pool.last + 1))
+        return []
 
-    def _recover_latest_ip(self, ip):
-        l = map(int, self.latest_ip.split("."))
-        s = map(int, ip.split("."))
+    def _claim_new(self, ip):
+        """
+        Create the lease for an untouched address. This fails if some
+        other process got there first, or if the address is reserved. 
+        """
+        try:
+            self.dhcp_collection.insert( { 'ip' : ip,
+                                           'status' : 'active',
+                                           'claimed' : time.time() } )
+            return True
+        except DuplicateKeyError:
+            return False
+
+    def _alloc_ips(self, num):
+        """
+        Allocate addresses from the in-memory pools, and record
+        the leases with a single write. 
+        """
+        ips = []
+        for pool in self.pools:
+            while len(ips) < num:
+                ip = pool.alloc()
+                if not ip:
+                    break
+                ips.append(ip)
 
-        for i in [0, 1, 2, 3]:
-            if s[i] > l[i]:
-                self.latest_ip = ip
-                break
-            elif l[i] > s[i]:
+        now = time.time()
+        self._bulk_update([( { 'ip' : ip },
+                             { '$set' : { 'status' : 'active', 'claimed' : now },
+                               '$unset' : { 'freed' : '' } } ) for ip in ips],
+                          upsert = True)
+        return ips
+
+    def _claim_ips(self, num):
+        """
+        Claim addresses, preferring ones that were used before. 
+        """
+        if self.cache:
+            ips = self._alloc_ips(num)
+            if len(ips) < num:
+                logging.error("no more IP addresses available")
+            return ips
+
+        ips = []
+        while len(ips) < num:
+            ip = self._claim_free()
+            if not ip:
                 break
-                
-    def _parse_cidr_address(self, block):
-        s = block.split("/")
-        return s[0], int(s[1])
-
-    def _increment_ip(self):
-        if self.num_ips < self.num_addrs:
-            s = map(int, self.latest_ip.split("."))
-            for i in [3, 2, 1, 0]:
-                if s[i] < 255:
-                    s[i] += 1
+            ips.append(ip)
+
+        for pool in self.pools:
+            while len(ips) < num:
+                offsets = self._claim_offsets(pool, num - len(ips))
+                if len(offsets) == 0:
                     break
-                else:
-                    s[i] = 0
-
-            # Make sure we skip over the gateway IP. 
-            self.latest_ip = "%d.%d.%d.%d" % (s[0], s[1], s[2], s[3])
-            if self.latest_ip == self.gw_ip:
-                return self._increment_ip()
-            elif self.latest_ip in self.reserved_ips:
-                return self._increment_ip()
-            else:
-                self.num_ips += 1
-                return self.latest_ip
-
-    def _get_new_ip(self):
-        if len(self.free_ips) > 0:
-            return self.free_ips.pop(0)
-        else:
-            return self._increment_ip()
+                for offset in offsets:
+                    ip = pool.address(offset)
+                    if ip and self._claim_new(ip):
+                        ips.append(ip)
 
+        if len(ips) < num:
+            logging.error("no more IP addresses available")
+        return ips
+
+    def _claim_owned(self, container):
+        """
+        Re-activate the address of a stopped container. With the cache
+        enabled, the owner index finds the address without a query. 
+        """
+        if self.cache:
+            ip = self.owners.get(container)
+            if not ip:
+                return None
+            lease = dict(self.ips[ip], ip=ip)
+            if lease['status'] != 'active':
+                lease['status'] = 'active'
+                self.dhcp_collection.update( { 'ip' : ip },
+                                             { '$set' : { 'status' : 'active' } } )
+            return lease
+        return find_and_modify(self.dhcp_collection,
+                               { 'container' : container, 'status' : { '$ne' : 'free' } },
+                               { '$set' : { 'status' : 'active' } })
+
+    @synchronized
     def random_port(self):
         """
         Get a random port
         """
         return self.nat.random_port()
 
+    @synchronized
     def clean_rules(self):
         """
         Clean all rules
         """
         self.nat._clear_nat()
 
+    @synchronized
     def delete_rule(self, dest_ip, dest_port):
         """
         Delete port forwarding
         """
         self.nat.delete_rule(dest_ip, dest_port)
 
+    @synchronized
     def forward_rule(self, source_ip, source_port, dest_ip, dest_port):
         """
         Port forwarding
         """
         self.nat.forward_rule(source_ip, source_port, dest_ip, dest_port)
 
+    @synchronized
     def stop_ip(self, ip):
         """
-        Store the container's IP for future use. 
+        Store the container's IP for future use. The container
+        keeps ownership so that it gets the same IP on restart. 
         """
-        self.ips[ip]['status'] = 'stopped'
-        self.dhcp_collection.update( { 'ip' : ip },
-                                     { '$set' : self.ips[ip] },
-                                     upsert = True )
+        lease = find_and_modify(self.dhcp_collection,
+                                { 'ip' : ip, 'status' : { '$ne' : 'free' } },
+                                { '$set' : { 'status' : 'stopped' } })
+        if lease:
+            self._cache_lease(lease)
 
+    @synchronized
     def reserve_ip(self, ip):
         """
         Reserve an IP. This basically takes this IP out of commission. 
         """
-        self.reserved_ips.append(ip)
+        self.dhcp_collection.update( { 'ip' : ip },
+                                     { '$set' : { 'reserved' : True } },
+                                     upsert = True )
+        for pool in self.pools:
+            pool.reserve(ip)
 
+    @synchronized
     def assign_ip(self, container):
         """
         Assign a new IP address. If the container is on the stopped list
         then re-assign the same IP address. 
         """
-        if 'container' in container:
-            for k in self.ips.keys():
-                v = self.ips[k]
-                if v['container'] == container['container']:
-                    self.ips[k]['status'] = 'active'
-                    self.dhcp_collection.update( { 'ip' : k },
-                                                 { '$set' : { 'status' : 'active' }} )
-                                                 
-                    return k
-            
-        new_ip = self._get_new_ip()
-        self.ips[new_ip] = { 'status': 'active',
-                             'container': None }
-        self.dhcp_collection.update( { 'ip' : new_ip },
-                                     { '$set' : self.ips[new_ip]},
-                                     upsert = True )
-        return new_ip
+        return self.assign_ips([container])[0]
 
+    @synchronized
+    def assign_ips(self, containers):
+        """
+        Assign IP addresses to several containers at once. 
+        """
+        ips = [None] * len(containers)
+        for i, c in enumerate(containers):
+            if c.get('container'):
+                lease = self._claim_owned(c['container'])
+                if lease:
+                    self._cache_lease(lease)
+                    ips[i] = lease['ip']
+
+        missing = [i for i, ip in enumerate(ips) if not ip]
+        for i, ip in zip(missing, self._claim_ips(len(missing))):
+            self._cache_lease( { 'ip' : ip, 'status' : 'active' } )
+            ips[i] = ip
+        return ips
+
+    @synchronized
     def free_ip(self, ip):
         """
         Container is being removed and the IP address should be freed. 
         """
-        self.free_ips.append(ip)
-        self.ips[ip] = { 'status': 'free' }
-        self.dhcp_collection.update( { 'ip' : ip },
-                                     { '$set' : self.ips[ip] } )
+        self.free_ips([ip])
 
-    def set_owner(self, ip, container):
+    @synchronized
+    def free_ips(self, ips):
         """
-        Set the owner of this IP address. 
+        Free several IP addresses at once. 
         """
-        self.ips[ip]['container'] = container
+        for ip in ips:
+            self._uncache_lease(ip)
+            if self.cache:
+                pool = self._find_pool(ip)
+                if pool:
+                    pool.free(ip)
+        if len(ips) > 0:
+            self.dhcp_collection.update( { 'ip' : { '$in' : ips } },
+                                         { '$set' : { 'status' : 'free', 'freed' : time.time() },
+                                           '$unset' : HOLDER_FIELDS },
+                                         multi = True )
+
+    @synchronized
+    def release_ips(self, ips):
+        """
+        Tear down the network of a stack: delete the forwarding rules
+        to these IP addresses and free the addresses. 
+        """
+        if len(ips) > 0:
+            self.nat.delete_ip_rules(ips)
+            self.free_ips(ips)
+
+    def _owner(self, ip, container, hostname=None, cluster=None):
+        # Hostnames are case insensitive. 
+        if hostname:
+            hostname = hostname.lower()
+        owner = { 'container' : container,
+                  'hostname' : hostname,
+                  'cluster' : cluster }
+        if ip in self.ips:
+            lease = dict(self.ips[ip], ip=ip)
+            lease.update(owner)
+            self._cache_lease(lease)
+        return owner
+
+    @synchronized
+    def set_owner(self, ip, container, hostname=None, cluster=None):
+        """
+        Set the owner of this IP address. The hostname is used to
+        answer DNS queries from the other containers in the cluster. 
+        """
+        owner = self._owner(ip, container, hostname, cluster)
         self.dhcp_collection.update( { 'ip' : ip },
-                                     { '$set' : { 'container' : container}} )
+                                     { '$set' : owner } )
+
+    @synchronized
+    def set_owners(self, owners):
+        """
+        Set the owners of several IP addresses at once. 
+        """
+        updates = []
+        for o in owners:
+            owner = self._owner(o['ip'], o['container'], o.get('hostname'), o.get('cluster'))
+            updates.append(( { 'ip' : o['ip'] }, { '$set' : owner } ))
+        self._bulk_update(updates)
+
+    def _bulk_update(self, updates, upsert=False):
+        """
+        Apply the (query, update) pairs with a single bulk write
+        if the driver supports it. 
+        """
+        if len(updates) == 0:
+            return
+        if hasattr(self.dhcp_collection, 'initialize_unordered_bulk_op'):
+            bulk = self.dhcp_collection.initialize_unordered_bulk_op()
+            for query, update in updates:
+                if upsert:
+                    bulk.find(query).upsert().update_one(update)
+                else:
+                    bulk.find(query).update_one(update)
+            bulk.execute()
+        else:
+            for query, update in updates:
+                self.dhcp_collection.update(query, update, upsert=upsert)
+
+    def _lease(self, ip):
+        if self.cache:
+            return self.ips.get(ip)
+        return self.dhcp_collection.find_one( { 'ip' : ip, 'status' : { '$ne' : 'free' } } )
+
+    @synchronized
+    def resolve(self, source_ip, host_name):
+        """
+        Find the IP address of the host in the same cluster
+        as the container asking. 
+        """
+        source = self._lease(source_ip)
+        if not source:
+            return None
+        if self.cache:
+            return self.names.get((source.get('cluster'), host_name))
+
+        lease = self.dhcp_collection.find_one( { 'cluster' : source.get('cluster'),
+                                                 'hostname' : host_name,
+                                                 'status' : { '$ne' : 'free' } } )
+        if lease:
+            return lease['ip']
+        return None
+
+    @synchronized
+    def reverse(self, source_ip, ip):
+        """
+        Find the hostname of the IP address, as long as it's in
+        the same cluster as the container asking. 
+        """
+        lease = self._lease(ip)
+        source = self._lease(source_ip)
+        if lease and source and lease.get('cluster') == source.get('cluster'):
+            return lease.get('hostname')
+        return None
+
+    @synchronized
+    def forward_rules(self, rules):
+        """
+        Add several port forwarding rules at once. 
+        """
+        self.nat.forward_rules(rules)
+
+    @synchronized
+    def delete_rules(self, rules):
+        """
+        Delete several port forwarding rules at once. 
+        """
+        self.nat.delete_rules(rules)
+
+_dhcp = None
+_dhcp_lock = threading.Lock()
+
+def get_dhcp():
+    """
+    Get the DHCP instance shared by everyone in this process. 
+    """
+    from ferry.install import read_ferry_config, get_lease_cache
+    global _dhcp
+    with _dhcp_lock:
+        if not _dhcp:
+            _dhcp = DHCP(cache=get_lease_cache(read_ferry_config()))
+        return _dhcp
 
-dhcp = DHCP()
 app = Flask(__name__)
 
 @app.route('/cidr', methods=['POST'])
 def assign_cidr():
     cidr = request.form['cidr']
-    dhcp.assign_cidr(cidr)
+    get_dhcp().assign_cidr(cidr)
     return ""
 
 @app.route('/ip', methods=['GET'])
 def assign_ip():
     container = json.loads(request.args['container'])
-    ip = dhcp.assign_ip(container)
+    ip = get_dhcp().assign_ip(container)
     return json.dumps( { 'ip' : ip } )
 
+@app.route('/ips', methods=['GET'])
+def assign_ips():
+    containers = json.loads(request.args['containers'])
+    ips = get_dhcp().assign_ips(containers)
+    return json.dumps( { 'ips' : ips } )
+
 @app.route('/ip', methods=['POST'])
 def stop_ip():
     ip = request.form['ip']
-    dhcp.stop_ip(ip)
+    get_dhcp().stop_ip(ip)
     return ""
 
 @app.route('/ip', methods=['PUT'])
 def reserve_ip():
     ip = request.form['ip']
-    dhcp.reserve_ip(ip)
+    get_dhcp().reserve_ip(ip)
     return ""
 
 @app.route('/port', methods=['GET'])
 def random_port():
-    return dhcp.random_port()
+    return get_dhcp().random_port() or ""
 
 @app.route('/port', methods=['POST'])
 def forward_rule():
     args = json.loads(request.form['args'])
-    dhcp.forward_rule(args['src_ip'], args['src_port'], args['dest_ip'], args['dest_port'])
+    get_dhcp().forward_rule(args['src_ip'], args['src_port'], args['dest_ip'], args['dest_port'])
     return ""
 
 @app.route('/port', methods=['DELETE'])
 def delete_rule():
     args = json.loads(request.form['args'])
-    dhcp.delete_rule(args['dest_ip'], args['dest_port'])
+    get_dhcp().delete_rule(args['dest_ip'], args['dest_port'])
+    return ""
+
+@app.route('/ports', methods=['POST'])
+def forward_rules():
+    rules = json.loads(request.form['args'])
+    get_dhcp().forward_rules(rules)
     return ""
 
 @app.route('/ports', methods=['DELETE'])
 def clean_rules():
-    dhcp.clean_rules()
+    # With arguments, only delete those rules. Otherwise
+    # clear out all the rules. 
+    if 'args' in request.form:
+        get_dhcp().delete_rules(json.loads(request.form['args']))
+    else:
+        get_dhcp().clean_rules()
     return ""
 
 @app.route('/ip', methods=['DELETE'])
 def free_ip():
     ip = request.form['ip']
-    dhcp.free_ip(ip)
+    get_dhcp().free_ip(ip)
+    return ""
+
+@app.route('/ips', methods=['DELETE'])
+def free_ips():
+    ips = json.loads(request.form['ips'])
+    get_dhcp().free_ips(ips)
+    return ""
+
+@app.route('/leases', methods=['DELETE'])
+def release_ips():
+    ips = json.loads(request.form['ips'])
+    get_dhcp().release_ips(ips)
     return ""
 
 @app.route('/node', methods=['POST'])
 def set_owner():
     args = json.loads(request.form['args'])
-    dhcp.set_owner(args['ip'], args['container'])
+    get_dhcp().set_owner(args['ip'], args['container'], args.get('hostname'), args.get('cluster'))
+    return ""
+
+@app.route('/nodes', methods=['POST'])
+def set_owners():
+    owners = json.loads(request.form['args'])
+    get_dhcp().set_owners(owners)
     return ""
 
 if __name__ == '__main__':
+    # Recover the network state before accepting any requests. 
+    get_dhcp()
     http_server = HTTPServer(WSGIContainer(app))
     http_server.listen(port=int(sys.argv[2]),
                        address=sys.argv[1])
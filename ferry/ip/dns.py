@@ -0,0 +1,228 @@
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import random
+import socket
+import struct
+import threading
+import time
+
+DNS_PORT = 53
+
+# Number of seconds clients may cache our answers. Keep this
+# short since addresses get reused once a stack is removed.
+DNS_TTL = 5
+
+# Number of seconds to wait for the upstream resolver.
+UPSTREAM_TIMEOUT = 3
+
+# Maximum number of queries waiting on the upstream resolver. Queries
+# beyond that are dropped (the clients will try again).
+MAX_PENDING = 1024
+
+DEFAULT_UPSTREAM = '8.8.8.8'
+
+TYPE_A = 1
+TYPE_PTR = 12
+CLASS_IN = 1
+
+def _upstream_resolver():
+    """
+    Use the same resolver as the host.
+    """
+    try:
+        with open('/etc/resolv.conf', 'r') as f:
+            for line in f.readlines():
+                s = line.split()
+                if len(s) > 1 and s[0] == 'nameserver':
+                    return s[1]
+    except IOError as e:
+        logging.warning(e)
+    return DEFAULT_UPSTREAM
+
+def _parse_question(packet):
+    """
+    Read the name, type, and class of the first question, along with
+    the offset of the end of the question.
+    """
+    labels = []
+    i = 12
+    while True:
+        n = ord(packet[i])
+        if n == 0:
+            i += 1
+            break
+        elif n & 0xc0:
+            # Compressed names aren't used in questions.
+            raise ValueError("unexpected pointer in question")
+        labels.append(packet[i + 1:i + 1 + n])
+        i += 1 + n
+    qtype, qclass = struct.unpack("!HH", packet[i:i + 4])
+    return '.'.join(labels).lower(), qtype, qclass, i + 4
+
+def _encode_name(name):
+    return ''.join([chr(len(l)) + l for l in name.split('.') if l != '']) + '\x00'
+
+def _reply(packet, end, answers):
+    """
+    Construct a reply with the given resource records. The question
+    is copied over as is, and the answers point back to its name.
+    """
+    qid, flags = struct.unpack("!HH", packet[:4])
+    flags = 0x8000 | 0x0400 | (flags & 0x0100) | 0x0080
+    header = struct.pack("!HHHHHH", qid, flags, 1, len(answers), 0, 0)
+    body = ''
+    for rtype, rdata in answers:
+        body += struct.pack("!HHHIH", 0xc00c, rtype, CLASS_IN, DNS_TTL, len(rdata)) + rdata
+    return header + packet[12:end] + body
+
+def _reverse_ip(name):
+    """
+    Turn a reverse lookup name (4.3.2.1.in-addr.arpa) into an IP.
+    """
+    s = name.split('.')
+    if len(s) == 6 and name.endswith('.in-addr.arpa'):
+        return '.'.join(reversed(s[:4]))
+    return None
+
+class DNSResponder(object):
+    """
+    Answer hostname (and reverse) lookups for the containers. Names are
+    resolved within the stack of the container that is asking, since
+    different stacks reuse the same hostnames. Everything else is
+    passed on to the upstream resolver through a single socket.
+
+    The resolver must implement resolve(source_ip, hostname) and
+    reverse(source_ip, ip), and return None for unknown names.
+    """
+    def __init__(self, resolver, address, port=DNS_PORT, upstream=None):
+        self.resolver = resolver
+        self.address = address
+        self.port = port
+        self.upstream = upstream or _upstream_resolver()
+        self.sock = None
+        self.upstream_sock = None
+
+        # Forwarded queries by the ID we sent upstream. Each one
+        # records the original ID, the client, and when it was sent.
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+
+    def start(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.address, self.port))
+        self.upstream_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.upstream_sock.connect((self.upstream, DNS_PORT))
+        logging.warning("dns listening on %s:%d (upstream %s)" % (self.address, self.port, self.upstream))
+
+        for target in [self._serve, self._relay]:
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+
+    def _serve(self):
+        while True:
+            try:
+                packet, client = self.sock.recvfrom(512)
+            except socket.error as e:
+                logging.warning(e)
+                continue
+
+            try:
+                reply = self._answer(packet, client[0])
+            except Exception as e:
+                logging.warning("dns: could not parse query from %s: %s" % (client[0], str(e)))
+                continue
+
+            if reply:
+                self.sock.sendto(reply, client)
+            else:
+                self._forward(packet, client)
+
+    def _answer(self, packet, source_ip):
+        """
+        Answer the query if it is about one of our containers.
+        """
+        name, qtype, qclass, end = _parse_question(packet)
+        if qclass != CLASS_IN:
+            return None
+
+        if qtype == TYPE_PTR:
+            ip = _reverse_ip(name)
+            host_name = ip and self.resolver.reverse(source_ip, ip)
+            if host_name:
+                return _reply(packet, end, [(TYPE_PTR, _encode_name(host_name))])
+            return None
+
+        ip = self.resolver.resolve(source_ip, name)
+        if ip is None:
+            return None
+        elif qtype == TYPE_A:
+            return _reply(packet, end, [(TYPE_A, socket.inet_aton(ip))])
+        else:
+            # The name exists, but we only have IPv4 addresses.
+            return _reply(packet, end, [])
+
+    def _expire(self, now):
+        for qid, (_, _, sent) in self.pending.items():
+            if now - sent > UPSTREAM_TIMEOUT:
+                del self.pending[qid]
+
+    def _forward(self, packet, client):
+        """
+        Send the query upstream under a fresh ID, so that the reply can be
+        matched to the client even if several clients use the same IDs.
+        """
+        now = time.time()
+        with self.pending_lock:
+            if len(self.pending) >= MAX_PENDING:
+                self._expire(now)
+                if len(self.pending) >= MAX_PENDING:
+                    logging.warning("dns: too many pending queries, dropping query from " + client[0])
+                    return
+
+            qid = random.randint(0, 0xffff)
+            while qid in self.pending:
+                qid = random.randint(0, 0xffff)
+            self.pending[qid] = (packet[:2], client, now)
+
+        try:
+            self.upstream_sock.send(struct.pack("!H", qid) + packet[2:])
+        except socket.error as e:
+            logging.warning("dns: upstream error: " + str(e))
+            with self.pending_lock:
+                self.pending.pop(qid, None)
+
+    def _relay(self):
+        """
+        Hand the upstream replies back to the clients that asked.
+        """
+        while True:
+            try:
+                reply = self.upstream_sock.recv(4096)
+            except socket.error as e:
+                logging.warning("dns: upstream error: " + str(e))
+                continue
+            if len(reply) < 12:
+                continue
+
+            qid = struct.unpack("!H", reply[:2])[0]
+            with self.pending_lock:
+                query = self.pending.pop(qid, None)
+            if query:
+                orig_id, client, _ = query
+                self.sock.sendto(orig_id + reply[2:], client)
@@ -13,67 +13,407 @@
 # limitations under the License.
 #
 
+import fcntl
 import logging
 import os
+import re
+import threading
+import time
+from ferry.fabric.execute import execute
+from ferry.ip.pool import find_and_modify, parse_port_ranges
 from pymongo import MongoClient
-from subprocess import Popen, PIPE
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+# Maximum number of seconds to wait for a single iptables call. 
+IPTABLES_TIMEOUT = 30
+
+# Host ports used for port forwarding. Stay clear of
+# the ephemeral port range used for outgoing connections. 
+DEFAULT_PORT_RANGES = '1000-32767'
+
+# Ports used by the Ferry servers themselves. 
+RESERVED_PORTS = [4000, 5000]
+
+# Number of seconds to remember which ports are bound on the host. 
+HOST_PORT_TTL = 5
+
+# Number of seconds that a port handed out by random_port stays
+# claimed without a forwarding rule (e.g., if the rule failed). 
+PORT_CLAIM_TTL = 600
+
+def _host_ports():
+    """
+    Get the TCP ports that are listening on the host. 
+    """
+    ports = set()
+    for f in ['/proc/net/tcp', '/proc/net/tcp6']:
+        try:
+            with open(f, 'r') as proc:
+                for line in proc.readlines()[1:]:
+                    s = line.split()
+                    # State '0A' means that the socket is listening. 
+                    if len(s) > 3 and s[3] == '0A':
+                        ports.add(int(s[1].split(':')[-1], 16))
+        except IOError as e:
+            logging.warning(e)
+    return ports
+
+# Serializes the changes to the Ferry rules across processes (e.g.,
+# the API workers in local network mode). 
+NAT_LOCK = '/tmp/ferry/nat.lock'
+
+_nat_lock = threading.local()
+
+def exclusive(fn):
+    """
+    Only let one process at a time change the forwarding rules. The
+    lock covers both the Mongo and the iptables changes, so a sync
+    always sees the rules that other processes have added. 
+    """
+    def _exclusive(self, *args, **kwargs):
+        if getattr(_nat_lock, 'depth', 0) > 0:
+            return fn(self, *args, **kwargs)
+
+        if not os.path.isdir(os.path.dirname(NAT_LOCK)):
+            try:
+                os.makedirs(os.path.dirname(NAT_LOCK))
+            except OSError:
+                # Someone else created it first. 
+                pass
+        with open(NAT_LOCK, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            _nat_lock.depth = 1
+            try:
+                return fn(self, *args, **kwargs)
+            finally:
+                _nat_lock.depth = 0
+                fcntl.flock(f, fcntl.LOCK_UN)
+    _exclusive.__name__ = fn.__name__
+    _exclusive.__doc__ = fn.__doc__
+    return _exclusive
+
+# All the port forwarding rules live in this chain. 
+FERRY_CHAIN = 'FERRY_CHAIN'
+
+# Send traffic destined to the host through the Ferry chain. These
+# are written the same way that iptables-save prints them. 
+JUMP_RULES = ['-A OUTPUT ! -d 127.0.0.0/8 -m addrtype --dst-type LOCAL -j FERRY_CHAIN',
+              '-A PREROUTING -m addrtype --dst-type LOCAL -j FERRY_CHAIN']
+
+def _dnat_rule(source_ip, source_port, dest_ip, dest_port):
+    return '-A FERRY_CHAIN -d %s -p tcp --dport %s -j DNAT --to-destination %s:%s' % (source_ip, str(source_port), dest_ip, str(dest_port))
+
+def _forward_rule(dest_ip, dest_port):
+    return '-I FORWARD 1 ! -i ferry0 -o ferry0 -p tcp --dport %s -d %s -j ACCEPT' % (str(dest_port), dest_ip)
+
+def _delete(line):
+    """
+    Turn a rule printed by iptables-save into a delete. 
+    """
+    return '-D' + line[2:]
+
+class _IPTablesState(object):
+    """
+    The Ferry rules that are currently installed, according to iptables-save. 
+    DNAT rules are keyed by (source port, dest IP, dest port) and
+    FORWARD rules by (dest IP, dest port). 
+    """
+    DPORT = re.compile('--dport (\d+)')
+    TO_DEST = re.compile('--to-destination ([\d\.]+):(\d+)')
+    DEST = re.compile('-d ([\d\.]+)(/32)? ')
+
+    def __init__(self, output):
+        self.jumps = []
+        self.dnat = {}
+        self.forward = {}
+
+        table = None
+        for line in output.splitlines():
+            line = line.strip()
+            if line.startswith('*'):
+                table = line[1:]
+            elif table == 'nat':
+                if line.startswith('-A FERRY_CHAIN '):
+                    port = self.DPORT.search(line)
+                    dest = self.TO_DEST.search(line)
+                    if port and dest:
+                        self.dnat[(port.group(1), dest.group(1), dest.group(2))] = line
+                elif line.startswith('-A ') and line.endswith('-j FERRY_CHAIN'):
+                    self.jumps.append(line)
+            elif table == 'filter':
+                if line.startswith('-A FORWARD ') and '-o ferry0' in line and line.endswith('-j ACCEPT'):
+                    port = self.DPORT.search(line)
+                    dest = self.DEST.search(line)
+                    if port and dest:
+                        self.forward[(dest.group(1), port.group(1))] = line
 
 class NAT(object):
+    """
+    Forward host ports to the containers. The host ports are claimed
+    with atomic updates in Mongo, so several processes can safely hand
+    them out. A port is 'claimed' once it's handed out, 'active' once it
+    has a forwarding rule, and 'bound' if something else on the host
+    turned out to be listening on it. 
+    """
     def __init__(self):
-        self._current_port = 999
-        self.reserved_ports = [4000, 5000]
+        self.reserved_ports = RESERVED_PORTS
+        self.port_ranges = self._get_port_ranges()
+        self._host_ports = set()
+        self._host_ports_time = 0
         self._init_state_db()
-        self._clear_nat()
-        self._init_nat()
-        self._repop_nat()
+
+    def _get_port_ranges(self):
+        """
+        Read the host port ranges from the 'network' section
+        of the Ferry configuration. 
+        """
+        from ferry.install import read_ferry_config
+        conf = read_ferry_config()
+        if conf.get('network') and 'ports' in conf['network']:
+            return parse_port_ranges(conf['network']['ports'])
+        return parse_port_ranges(DEFAULT_PORT_RANGES)
+
+    def _bound_ports(self):
+        """
+        Ports bound on the host. The set is only replaced
+        when the cache expires. 
+        """
+        now = time.time()
+        if now - self._host_ports_time > HOST_PORT_TTL:
+            self._host_ports = _host_ports()
+            self._host_ports_time = now
+        return self._host_ports
         
     def _init_state_db(self):
         self.mongo = MongoClient(os.environ['MONGODB'], 27017, connectTimeoutMS=6000)
         self.nat_collection = self.mongo['network']['nat']
+        self.port_collection = self.mongo['network']['ports']
+        self.range_collection = self.mongo['network']['port_ranges']
+
+        # The unique indices are what make concurrent allocation safe. 
+        try:
+            self.port_collection.create_index('port', unique=True)
+            self.port_collection.create_index([('status', 1), ('freed', 1)])
+            self.range_collection.create_index([('low', 1), ('high', 1)], unique=True)
+        except OperationFailure as e:
+            logging.error("could not create port indices: " + str(e))
+
+        for low, high in self.port_ranges:
+            if not self.range_collection.find_one( { 'low' : low, 'high' : high } ):
+                try:
+                    self.range_collection.insert( { 'low' : low,
+                                                    'high' : high,
+                                                    'next' : low } )
+                except DuplicateKeyError:
+                    # Another process added the range first. 
+                    pass
+        self._recover_ports()
+
+    def _recover_ports(self):
+        """
+        Rules used to be saved without claiming their ports, so
+        make sure that those ports are marked as active. 
+        """
+        ports = [int(r['src_port']) for r in self.nat_collection.find( {}, { 'src_port' : True } )]
+        self._activate_ports(ports)
+
+    def _in_range(self, port):
+        for low, high in self.port_ranges:
+            if port >= low and port <= high:
+                return True
+        return False
+
+    def _claim_free(self, now):
+        """
+        Claim the port that has been free the longest. Ports that were
+        bound on the host are only checked again once the cached host
+        ports have expired, and claims that never got a rule expire. 
+        """
+        port = find_and_modify(self.port_collection,
+                               { '$or' : [ { 'status' : 'free' },
+                                           { 'status' : 'bound', 'freed' : { '$lt' : now - HOST_PORT_TTL } },
+                                           { 'status' : 'claimed', 'claimed' : { '$lt' : now - PORT_CLAIM_TTL } } ] },
+                               { '$set' : { 'status' : 'claimed', 'claimed' : now },
+                                 '$unset' : { 'freed' : '' } },
+                               sort = [('freed', 1)])
+        if port:
+            return port['port']
+        return None
+
+    def _claim_new(self, now):
+        """
+        Move the high-water mark of the ranges forward until we
+        get an untouched port. 
+        """
+        for low, high in self.port_ranges:
+            while True:
+                r = find_and_modify(self.range_collection,
+                                    { 'low' : low, 'high' : high, 'next' : { '$lte' : high } },
+                                    { '$inc' : { 'next' : 1 } },
+                                    new = False)
+                if not r:
+                    break
+                port = r['next']
+                if port in self.reserved_ports:
+                    continue
+                try:
+                    self.port_collection.insert( { 'port' : port,
+                                                   'status' : 'claimed',
+                                                   'claimed' : now } )
+                    return port
+                except DuplicateKeyError:
+                    # A rule asked for this specific port. 
+                    pass
+        return None
+
+    def _activate_ports(self, ports):
+        """
+        Mark the ports as used by forwarding rules. Ports that weren't
+        handed out by us (e.g., the user asked for them) are added. 
+        """
+        if len(ports) == 0:
+            return
+        self.port_collection.update( { 'port' : { '$in' : ports } },
+                                     { '$set' : { 'status' : 'active' },
+                                       '$unset' : { 'claimed' : '', 'freed' : '' } },
+                                     multi = True )
+        known = set(p['port'] for p in self.port_collection.find( { 'port' : { '$in' : ports } }, { 'port' : True } ))
+        for port in ports:
+            if not port in known:
+                self.port_collection.update( { 'port' : port },
+                                             { '$set' : { 'status' : 'active' } },
+                                             upsert = True )
+
+    def _free_ports(self, ports, status=None):
+        """
+        Return the ports so that they can be handed out again. Ports
+        outside of the configured ranges are forgotten. 
+        """
+        ports = [int(p) for p in ports]
+        recycled = [p for p in ports if self._in_range(p)]
+        if len(recycled) > 0:
+            query = { 'port' : { '$in' : recycled } }
+            if status:
+                query['status'] = status
+            self.port_collection.update(query,
+                                        { '$set' : { 'status' : 'free', 'freed' : time.time() },
+                                          '$unset' : { 'claimed' : '' } },
+                                        multi = True )
 
+        others = [p for p in ports if not self._in_range(p)]
+        if len(others) > 0:
+            self.port_collection.remove( { 'port' : { '$in' : others } } )
 
+    def _execute_iptables(self, cmd, input=None):
+        result = execute(cmd, timeout=IPTABLES_TIMEOUT, input=input)
+        if not result.success():
+            logging.warning("iptables (%s): %s" % (str(result.status), result.stderr.strip()))
+        return result
+
+    def _current_state(self):
+        return _IPTablesState(self._execute_iptables('iptables-save').stdout)
+
+    def _apply(self, nat, filter):
+        """
+        Apply all the changes with a single iptables-restore. Each
+        table is committed atomically. Other (non-Ferry) rules are
+        left alone. 
+        """
+        batch = []
+        if len(nat) > 0:
+            batch += ['*nat'] + nat + ['COMMIT']
+        if len(filter) > 0:
+            batch += ['*filter'] + filter + ['COMMIT']
+        if len(batch) == 0:
+            return True
+
+        batch = '\n'.join(batch) + '\n'
+        logging.warning(batch)
+        return self._execute_iptables('iptables-restore --noflush', batch).success()
+
+    def _sync_nat(self, rules):
+        """
+        Make the installed rules match the given rules. Declaring the
+        chain creates it, or flushes it if it already exists. 
+        """
+        current = self._current_state()
+        nat = [':%s - [0:0]' % FERRY_CHAIN]
+        filter = []
+
+        # Make sure the jump rules are installed exactly once. 
+        installed = []
+        for line in current.jumps:
+            if line in JUMP_RULES and not line in installed:
+                installed.append(line)
+            else:
+                nat.append(_delete(line))
+        nat += [l for l in JUMP_RULES if not l in installed]
+
+        dnat = set()
+        forward = {}
+        for source_ip, source_port, dest_ip, dest_port in rules:
+            line = _dnat_rule(source_ip, source_port, dest_ip, dest_port)
+            if not line in dnat:
+                dnat.add(line)
+                nat.append(line)
+            forward[(dest_ip, str(dest_port))] = _forward_rule(dest_ip, dest_port)
+
+        for k, line in current.forward.items():
+            if not k in forward:
+                filter.append(_delete(line))
+        for k, line in forward.items():
+            if not k in current.forward:
+                filter.append(line)
+
+        return self._apply(nat, filter)
+
+    @exclusive
     def _clear_nat(self):
         logging.warning("clearing nat")
-        
-        cmds = ['iptables -t nat -D PREROUTING -m addrtype --dst-type LOCAL -j FERRY_CHAIN',
-                'iptables -t nat -D OUTPUT -m addrtype --dst-type LOCAL ! --dst 127.0.0.0/8 -j FERRY_CHAIN',
-                'iptables -t nat -D OUTPUT -m addrtype --dst-type LOCAL -j FERRY_CHAIN',
-                'iptables -t nat -D OUTPUT -j FERRY_CHAIN',
-                'iptables -t nat -F FERRY_CHAIN',
-                'iptables -t nat -D PREROUTING -j FERRY_CHAIN',
-                'iptables -t nat -X FERRY_CHAIN']
-        for c in cmds:
-            logging.warning(c)
-            Popen(c, shell=True)
-
-    def _init_nat(self):
+        self._sync_nat([])
+
+    @exclusive
+    def sync(self):
+        """
+        Reinstall the saved rules (e.g., after the host restarted). This
+        flushes the Ferry chain, so it should only run once when the
+        network service starts, not every time a NAT is created. 
+        """
         logging.warning("init nat")
-        cmds = ['iptables -t nat -N FERRY_CHAIN',
-                'iptables -t nat -A OUTPUT -m addrtype --dst-type LOCAL ! --dst 127.0.0.0/8 -j FERRY_CHAIN',
-                'iptables -t nat -A PREROUTING  -m addrtype --dst-type LOCAL -j FERRY_CHAIN']
-        for c in cmds:
-            logging.warning(c)
-            Popen(c, shell=True)
-
-    def _repop_nat(self):
-        rules = self.nat_collection.find()
-        for r in rules:
-            self._save_nat(r['src_ip'], r['src_port'],r['ip'], r['port'])
+        rules = [(r['src_ip'], r['src_port'], r['ip'], r['port']) for r in self.nat_collection.find()]
+        self._sync_nat(rules)
                               
-    def _save_nat(self, source_ip, source_port, dest_ip, dest_port):
-        cmds = ['iptables -I FORWARD 1 ! -i ferry0 -o ferry0  -p tcp --dport %s -d %s -j ACCEPT' % (str(dest_port), dest_ip),
-                'iptables -t nat -A FERRY_CHAIN -d %s -p tcp --dport %s -j DNAT --to-destination %s:%s' % (source_ip, str(source_port), dest_ip, str(dest_port))]
-        for c in cmds:
-            logging.warning(c)
-            Popen(c, shell=True)
-
-    def _delete_nat(self, source_ip, source_port, dest_ip, dest_port):
-        cmds = ['iptables -D FORWARD ! -i ferry0 -o ferry0  -p tcp --dport %s -d %s -j ACCEPT' % (str(dest_port), dest_ip),
-                'iptables -t nat -D FERRY_CHAIN -d %s -p tcp --dport %s -j DNAT --to-destination %s:%s' % (source_ip, str(source_port), dest_ip, str(dest_port))]
-                
-        for c in cmds:
-            logging.warning(c)
-            Popen(c, shell=True)
+    def _save_nat(self, rules):
+        """
+        Install the (source IP, source port, dest IP, dest port) rules that
+        aren't already installed. 
+        """
+        current = self._current_state()
+        nat = []
+        filter = []
+        for source_ip, source_port, dest_ip, dest_port in rules:
+            if not (str(source_port), dest_ip, str(dest_port)) in current.dnat:
+                nat.append(_dnat_rule(source_ip, source_port, dest_ip, dest_port))
+            if not (dest_ip, str(dest_port)) in current.forward:
+                filter.append(_forward_rule(dest_ip, dest_port))
+        return self._apply(nat, filter)
+
+    def _delete_nat(self, rules):
+        """
+        Remove the (source IP, source port, dest IP, dest port) rules
+        that are installed. 
+        """
+        current = self._current_state()
+        nat = []
+        filter = []
+        for source_ip, source_port, dest_ip, dest_port in rules:
+            k = (str(source_port), dest_ip, str(dest_port))
+            if k in current.dnat:
+                nat.append(_delete(current.dnat[k]))
+            k = (dest_ip, str(dest_port))
+            if k in current.forward:
+                filter.append(_delete(current.forward[k]))
+        return self._apply(nat, filter)
 
     def _save_forwarding_rule(self, source_ip, source_port, dest_ip, dest_port):
         self.nat_collection.insert({ 'ip' : dest_ip,
@@ -86,12 +426,26 @@ class NAT(object):
                                       'port' : dest_port } )
 
     def random_port(self):
+        """
+        Get an unused host port. The port stays claimed until it's
+        used in a forwarding rule (or the claim expires). 
+        """
+        now = time.time()
+        host_ports = self._bound_ports()
         while True:
-            port = self._current_port
-            self._current_port += 1
-            if not port in self.reserved_ports:
+            port = self._claim_free(now) or self._claim_new(now)
+            if not port:
+                logging.error("no more host ports available")
+                return None
+            if not port in host_ports:
                 return str(port)
 
+            # Something else is listening on this port. Set it
+            # aside until the cached host ports are refreshed. 
+            self.port_collection.update( { 'port' : port },
+                                         { '$set' : { 'status' : 'bound', 'freed' : now },
+                                           '$unset' : { 'claimed' : '' } } )
+
     def has_rule(self, dest_ip, dest_port):
         rule = self.nat_collection.find_one( { 'ip' : dest_ip,
                                                'port' : dest_port } )
@@ -100,6 +454,7 @@ class NAT(object):
         else:
             return None, None
 
+    @exclusive
     def delete_rule(self, dest_ip, dest_port):
         """
         Delete the forwarding rule. 
@@ -107,23 +462,98 @@ class NAT(object):
         src_ip, src_port = self.has_rule(dest_ip, dest_port)
         if src_ip:
             self._delete_forwarding_rule(dest_ip, dest_port)
-            self._delete_nat(src_ip, src_port, dest_ip, dest_port)
+            self._delete_nat([(src_ip, src_port, dest_ip, dest_port)])
+            self._free_ports([src_port])
         else:
             logging.warning("no such dest %s:%s" % (dest_ip, dest_port))
 
+    @exclusive
     def forward_rule(self, source_ip, source_port, dest_ip, dest_port):
         """
         Add a new forwarding rule. 
         """
-        if source_port in self.reserved_ports:
-            logging.warning("cannot use reserved port " + source_port)
+        if int(source_port) in self.reserved_ports:
+            logging.warning("cannot use reserved port " + str(source_port))
             return False
 
         src_ip, src_port = self.has_rule(dest_ip, dest_port)
         if not src_ip:
+            self._activate_ports([int(source_port)])
             self._save_forwarding_rule(source_ip, source_port, dest_ip, dest_port)
-            self._save_nat(source_ip, source_port, dest_ip, dest_port)
+            self._save_nat([(source_ip, source_port, dest_ip, dest_port)])
             return True
         else:
-            logging.warning("port " + source_port + " already reserved")
+            logging.warning("port " + str(source_port) + " already reserved")
+            self._free_ports([source_port], status='claimed')
             return False
+
+    def _find_rules(self, rules):
+        """
+        Look up the existing rules for the (dest_ip, dest_port) pairs
+        with a single query. 
+        """
+        if len(rules) == 0:
+            return {}
+        query = { '$or' : [ { 'ip' : r['dest_ip'], 'port' : r['dest_port'] } for r in rules ] }
+        existing = {}
+        for r in self.nat_collection.find(query):
+            existing[(r['ip'], r['port'])] = r
+        return existing
+
+    @exclusive
+    def forward_rules(self, rules):
+        """
+        Add several forwarding rules. The rules are all saved
+        with a single write. 
+        """
+        existing = self._find_rules(rules)
+        new_rules = []
+        unused = []
+        for r in rules:
+            k = (r['dest_ip'], r['dest_port'])
+            if int(r['src_port']) in self.reserved_ports:
+                logging.warning("cannot use reserved port " + str(r['src_port']))
+            elif k in existing:
+                logging.warning("port " + str(r['src_port']) + " already reserved")
+                unused.append(r['src_port'])
+            else:
+                existing[k] = r
+                new_rules.append(r)
+
+        if len(unused) > 0:
+            self._free_ports(unused, status='claimed')
+        if len(new_rules) > 0:
+            self._activate_ports([int(r['src_port']) for r in new_rules])
+            self.nat_collection.insert([{ 'ip' : r['dest_ip'],
+                                          'port' : r['dest_port'],
+                                          'src_ip' : r['src_ip'],
+                                          'src_port' : r['src_port'] } for r in new_rules])
+            self._save_nat([(r['src_ip'], r['src_port'], r['dest_ip'], r['dest_port']) for r in new_rules])
+
+    @exclusive
+    def delete_rules(self, rules):
+        """
+        Delete several forwarding rules. The rules are all removed
+        with a single write. 
+        """
+        existing = self._find_rules(rules)
+        if len(existing) > 0:
+            self.nat_collection.remove( { '$or' : [ { 'ip' : ip, 'port' : port } for ip, port in existing.keys() ] } )
+            self._delete_nat([(r['src_ip'], r['src_port'], r['ip'], r['port']) for r in existing.values()])
+            self._free_ports([r['src_port'] for r in existing.values()])
+
+    @exclusive
+    def delete_ip_rules(self, ips):
+        """
+        Delete all the forwarding rules to these IP addresses with
+        a single write and a single iptables batch. 
+        """
+        rules = list(self.nat_collection.find( { 'ip' : { '$in' : ips } } ))
+        if len(rules) > 0:
+            self.nat_collection.remove( { 'ip' : { '$in' : ips } } )
+            self._delete_nat([(r['src_ip'], r['src_port'], r['ip'], r['port']) for r in rules])
+            self._free_ports([r['src_port'] for r in rules])
+
+if __name__ == '__main__':
+    # Restore the forwarding rules before the network service starts. 
+    NAT().sync()
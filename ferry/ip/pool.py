@@ -0,0 +1,209 @@
+# Copyright 2014 OpenCore LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import collections
+import socket
+import struct
+
+def ip_to_int(ip):
+    return struct.unpack("!I", socket.inet_aton(ip))[0]
+
+def int_to_ip(n):
+    return socket.inet_ntoa(struct.pack("!I", n))
+
+def find_and_modify(collection, query, update, sort=None, new=True):
+    """
+    Atomically update a single document and return it (or the original
+    if 'new' is False). Returns None if nothing matched. 
+    """
+    if hasattr(collection, 'find_one_and_update'):
+        return collection.find_one_and_update(query, update, sort=sort, return_document=new)
+    return collection.find_and_modify(query, update, sort=sort, new=new)
+
+def parse_cidr(block):
+    """
+    Split a CIDR block (e.g., 10.1.0.1/16) into the address and prefix.
+    """
+    s = block.split("/")
+    return s[0], int(s[1])
+
+class IPPool(object):
+    """
+    Addresses of a single CIDR block. Maps the addresses to positions
+    within the block (and back) while skipping the network, broadcast,
+    and gateway addresses. 
+
+    The pool can also allocate the addresses itself. Allocation state is
+    kept in a bitmap (one bit per address), freed addresses are recycled
+    in FIFO order, and untouched addresses are handed out from a high-water
+    mark. Allocating, freeing, and reserving are all (amortized) O(1).
+    """
+    def __init__(self, cidr_block):
+        self.cidr = cidr_block
+        self.gw_ip, self.prefix = parse_cidr(cidr_block)
+        if self.prefix < 0 or self.prefix > 32:
+            raise ValueError("invalid prefix length: " + cidr_block)
+
+        self.size = 2**(32 - self.prefix)
+        self.network = ip_to_int(self.gw_ip) & ~(self.size - 1) & 0xffffffff
+
+        # Don't hand out the network and broadcast addresses
+        # unless the block is too small to have them.
+        if self.size > 2:
+            self.first = 1
+            self.last = self.size - 2
+        else:
+            self.first = 0
+            self.last = self.size - 1
+
+        self.used = bytearray((self.size + 7) // 8)
+        self.reserved = set()
+        self.recycled = collections.deque()
+        self.next = self.first
+        self.num_used = 0
+
+        # Make sure we skip over the gateway IP.
+        self.reserve(self.gw_ip)
+
+    def _test(self, offset):
+        return self.used[offset >> 3] & (1 << (offset & 7))
+
+    def _set(self, offset):
+        self.used[offset >> 3] |= (1 << (offset & 7))
+
+    def _clear(self, offset):
+        self.used[offset >> 3] &= ~(1 << (offset & 7)) & 0xff
+
+    def _available(self, offset):
+        return not self._test(offset) and not offset in self.reserved
+
+    def contains(self, ip):
+        return self.offset(ip) is not None
+
+    def offset(self, ip):
+        """
+        Position of the address within the block, or None
+        if the address is outside the block. 
+        """
+        offset = ip_to_int(ip) - self.network
+        if offset < 0 or offset >= self.size:
+            return None
+        return offset
+
+    def address(self, offset):
+        """
+        The address at this position, or None if it may not be
+        handed out (e.g., it's the gateway). 
+        """
+        if offset < self.first or offset > self.last or offset in self.reserved:
+            return None
+        return int_to_ip(self.network + offset)
+
+    def is_used(self, ip):
+        offset = self.offset(ip)
+        return offset is not None and bool(self._test(offset))
+
+    def num_free(self):
+        reserved = [o for o in self.reserved if not self._test(o) and o >= self.first and o <= self.last]
+        return self.last - self.first + 1 - self.num_used - len(reserved)
+
+    def alloc(self):
+        """
+        Allocate an address. Returns None if the pool is exhausted.
+        """
+        # Prefer previously freed addresses. These may have been
+        # reserved since they were freed, so just skip over those.
+        while len(self.recycled) > 0:
+            offset = self.recycled.popleft()
+            if self._available(offset):
+                return self._take(offset)
+
+        while self.next <= self.last:
+            offset = self.next
+            self.next += 1
+            if self._available(offset):
+                return self._take(offset)
+        return None
+
+    def _take(self, offset):
+        self._set(offset)
+        self.num_used += 1
+        return int_to_ip(self.network + offset)
+
+    def free(self, ip):
+        """
+        Return the address to the pool. Freeing an address that is
+        not allocated is ignored.
+        """
+        offset = self.offset(ip)
+        if offset is not None and self._test(offset):
+            self._clear(offset)
+            self.num_used -= 1
+            if not offset in self.reserved:
+                self.recycled.append(offset)
+
+    def reserve(self, ip):
+        """
+        Take the address out of commission. If the address is currently
+        in use, it is not handed out again once it is freed. 
+        """
+        offset = self.offset(ip)
+        if offset is not None:
+            self.reserved.add(offset)
+
+    def mark_used(self, ip):
+        """
+        Mark the address as allocated (e.g., while recovering state).
+        """
+        offset = self.offset(ip)
+        if offset is not None and not self._test(offset):
+            self._set(offset)
+            self.num_used += 1
+            if offset >= self.next:
+                self.next = offset + 1
+
+    def rebuild(self, used_ips, seen_ips=None):
+        """
+        Recover the pool from the recorded addresses. Addresses that
+        were previously handed out but are no longer in use are recycled.
+        """
+        for ip in seen_ips or []:
+            offset = self.offset(ip)
+            if offset is not None and offset >= self.next:
+                self.next = offset + 1
+        for ip in used_ips:
+            self.mark_used(ip)
+
+        self.recycled.clear()
+        for offset in xrange(self.first, self.next):
+            if self._available(offset):
+                self.recycled.append(offset)
+
+def parse_port_ranges(spec):
+    """
+    Parse port ranges (e.g., '1000-3999,5001-9999') into a list
+    of (low, high) pairs. A list of ranges is also accepted. 
+    """
+    if isinstance(spec, basestring):
+        spec = spec.split(",")
+    ranges = []
+    for r in spec:
+        s = str(r).strip().split("-")
+        low = int(s[0])
+        high = int(s[-1])
+        if low < 1 or high > 65535 or low > high:
+            raise ValueError("invalid port range: " + str(r))
+        ranges.append((low, high))
+    return sorted(ranges)